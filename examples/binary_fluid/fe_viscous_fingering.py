@@ -1,39 +1,54 @@
 #!/usr/bin/python
 
 import numpy as np
-from sailfish import geo, lb_binary
-
-class GeoFEFinger(geo.LBMGeo3D):
-
-    def define_nodes(self):
-        hz, hy, hx = np.mgrid[0:self.lat_nz, 0:self.lat_ny, 0:self.lat_nx]
-        self.set_geo(np.logical_or(hz == 0, hz == self.lat_nz-1), self.NODE_WALL)
-
-    def init_fields(self):
-        hz, hy, hx = np.mgrid[0:self.lat_nz, 0:self.lat_ny, 0:self.lat_nx]
-
-        a = 100.0 - 8.0 * np.cos(2.0 * np.pi * hy / self.lat_ny)
-        b = 200.0 - 8.0 * np.cos(2.0 * np.pi * hy / self.lat_ny)
-
-        self.sim.rho[:] = 1.0
-        self.sim.phi[:] = 1.0
-        self.sim.phi[np.logical_or(hx <= a, hx >= b)] = -1.0
-
-class FEFingerSim(lb_binary.BinaryFluidFreeEnergy):
-
-    filename = 'fe_fingering'
-
-    def __init__(self, geo_class, defaults={}):
-
-        settings = {'bc_velocity': 'equilibrium', 'verbose': True, 'lat_nx': 640,
-                    'lat_ny': 101, 'lat_nz': 37, 'grid': 'D3Q19',
-                    'tau_a': 4.5, 'tau_b': 0.6, 'tau_phi': 1.0, 'kappa': 9.18e-5,
-                    'Gamma': 25.0, 'A': 1.41e-4, 'lambda_': 0.0, 'model': 'femrt',
-                    'periodic_x': True, 'periodic_y': True, 'scr_scale': 1,
-                    'periodic_z': True}
-        settings.update(defaults)
-
-        lb_binary.BinaryFluidFreeEnergy.__init__(self, geo_class, options=[], defaults=settings)
+from sailfish.geo import LBGeometry3D
+from sailfish.geo_block import Subdomain3D
+from sailfish.controller import LBSimulationController
+from sailfish.lb_binary import BinaryFluidFreeEnergy
+from sailfish.lb_single import LBForcedSim
+
+
+class FingeringDomain(Subdomain3D):
+    def boundary_conditions(self, hx, hy, hz):
+        self.set_node(np.logical_or(hz == 0, hz == self.gz-1), self.NODE_WALL)
+
+    def initial_conditions(self, sim, hx, hy, hz):
+        a = 100.0 - 8.0 * np.cos(2.0 * np.pi * hy / self.gy)
+        b = 200.0 - 8.0 * np.cos(2.0 * np.pi * hy / self.gy)
+
+        sim.rho[:] = 1.0
+        sim.phi[:] = 1.0
+        sim.phi[np.logical_or(hx <= a, hx >= b)] = -1.0
+
+
+class FingeringFESim(BinaryFluidFreeEnergy, LBForcedSim):
+    subdomain = FingeringDomain
+
+    @classmethod
+    def update_defaults(cls, defaults):
+        defaults.update({
+            'lat_nx': 640,
+            'lat_ny': 101,
+            'lat_nz': 37,
+            'grid': 'D3Q19',
+            'tau_a': 4.5,
+            'tau_b': 0.6,
+            'tau_phi': 1.0,
+            'kappa': 9.18e-5,
+            'Gamma': 25.0,
+            'A': 1.41e-4,
+            'model': 'femrt',
+            'periodic_x': True,
+            'periodic_y': True,
+            'periodic_z': True})
+
+    @classmethod
+    def add_options(cls, group, dim):
+        BinaryFluidFreeEnergy.add_options(group, dim)
+        LBForcedSim.add_options(group, dim)
+
+    def __init__(self, config):
+        super(FingeringFESim, self).__init__(config)
 
         self.add_body_force((3.0e-5, 0.0, 0.0), grid=0, accel=False)
 
@@ -42,6 +57,6 @@ class FEFingerSim(lb_binary.BinaryFluidFreeEnergy):
         self.use_force_for_eq(None, 0)
         self.use_force_for_eq(0, 1)
 
+
 if __name__ == '__main__':
-    sim = FEFingerSim(GeoFEFinger)
-    sim.run()
+    LBSimulationController(FingeringFESim, LBGeometry3D).run()
@@ -1,71 +1,70 @@
 #!/usr/bin/python
 """A low Reynolds number flow of a drop through a capillary channel."""
 
-import numpy
-from sailfish import geo, lb_binary
+import numpy as np
+from sailfish.geo import LBGeometry2D
+from sailfish.geo_block import Subdomain2D
+from sailfish.controller import LBSimulationController
+from sailfish.lb_binary import ShanChenBinary
+from sailfish.lb_single import LBForcedSim
 
-class GeoSC(geo.LBMGeo2D):
-    maxv = 0.005
 
-    def define_nodes(self):
-        chan_diam = 32 * self.lat_ny / 200.0
-        chan_len = 200 * self.lat_ny / 200.0
+class CapillaryDomain(Subdomain2D):
+    max_v = 0.005
 
-        hy, hx = numpy.mgrid[0:self.lat_ny, 0:self.lat_nx]
+    def boundary_conditions(self, hx, hy):
+        chan_diam = 32 * self.gy / 200.0
+        chan_len = 200 * self.gy / 200.0
+        rem_y = (self.gy - chan_diam) / 2
 
-        geometry = numpy.zeros(list(reversed(self.shape)), dtype=numpy.bool)
-        rem_y = (self.lat_ny - chan_diam) / 2
-
-        geometry[0,:] = True
-        geometry[self.lat_ny-1,:] = True
-
-        geometry[numpy.logical_and(
+        geometry = np.logical_or(hy == 0, hy == self.gy-1)
+        geometry = np.logical_or(geometry, np.logical_and(
                     hy < rem_y,
-                    hy < rem_y - (numpy.abs((hx - self.lat_nx/2)) - chan_len/2)
-                )] = True
-
-        geometry[numpy.logical_and(
-                    (self.lat_ny - hy) < rem_y,
-                    (self.lat_ny - hy) < rem_y - (numpy.abs((hx - self.lat_nx/2)) - chan_len/2)
-                )] = True
-
-        self.set_geo_from_bool_array(geometry)
-
-    def init_fields(self):
-
-        drop_diam = 30 * self.lat_ny / 200.0
-
-        hy, hx = numpy.mgrid[0:self.lat_ny, 0:self.lat_nx]
-
-        self.sim.rho[:] = 1.0
-        self.sim.phi[:] = 0.124
-        self.sim.rho[(hx - drop_diam * 2) ** 2 + (hy - self.lat_ny / 2.0)**2 < drop_diam**2] = 0.124
-        self.sim.phi[(hx - drop_diam * 2) ** 2 + (hy - self.lat_ny / 2.0)**2 < drop_diam**2] = 1.0
-
-    def get_reynolds(self, viscosity):
-        return int(self.lat_ny * self.maxv/viscosity)
-
-
-class SCSim(lb_binary.ShanChenBinary):
-    filename = 'sc_instability_2d'
-
-    def __init__(self, geo_class):
-        lb_binary.ShanChenBinary.__init__(self, geo_class, options=[],
-                              defaults={'bc_velocity': 'equilibrium', 'verbose': True, 'lat_nx': 640,
-                                'lat_ny': 200, 'grid': 'D2Q9', 'G': -1.2,
-                                'visc': 0.166666666666, 'periodic_x': True, 'periodic_y': True, 'scr_scale': 1})
-
-        self.options.tau_phi = self.get_tau()
-
-        f1 = self.geo_class.maxv * (8.0 * self.options.visc) / self.options.lat_ny
-
+                    hy < rem_y - (np.abs((hx - self.gx/2)) - chan_len/2)))
+        geometry = np.logical_or(geometry, np.logical_and(
+                    (self.gy - hy) < rem_y,
+                    (self.gy - hy) < rem_y - (np.abs((hx - self.gx/2)) - chan_len/2)))
+
+        self.set_node(geometry, self.NODE_WALL)
+
+    def initial_conditions(self, sim, hx, hy):
+        drop_diam = 30 * self.gy / 200.0
+        drop_map = ((hx - drop_diam * 2) ** 2 +
+                (hy - self.gy / 2.0)**2 < drop_diam**2)
+
+        sim.rho[:] = 1.0
+        sim.phi[:] = 0.124
+        sim.rho[drop_map] = 0.124
+        sim.phi[drop_map] = 1.0
+
+
+class CapillarySCSim(ShanChenBinary, LBForcedSim):
+    subdomain = CapillaryDomain
+
+    @classmethod
+    def update_defaults(cls, defaults):
+        defaults.update({
+            'lat_nx': 640,
+            'lat_ny': 200,
+            'grid': 'D2Q9',
+            'G': -1.2,
+            'visc': 1.0 / 6.0,
+            'tau_phi': 1.0,
+            'periodic_x': True,
+            'periodic_y': True})
+
+    @classmethod
+    def add_options(cls, group, dim):
+        ShanChenBinary.add_options(group, dim)
+        LBForcedSim.add_options(group, dim)
+
+    def __init__(self, config):
+        super(CapillarySCSim, self).__init__(config)
+
+        f1 = CapillaryDomain.max_v * (8.0 * config.visc) / config.lat_ny
         self.add_body_force((f1, 0.0), grid=0)
         self.add_body_force((f1, 0.0), grid=1)
 
-        self.add_iter_hook(100, self.average_dens, every=True)
-
-    def average_dens(self):
-        print self.iter_, numpy.average(self.rho), numpy.average(self.phi)
 
-sim = SCSim(GeoSC)
-sim.run()
+if __name__ == '__main__':
+    LBSimulationController(CapillarySCSim, LBGeometry2D).run()
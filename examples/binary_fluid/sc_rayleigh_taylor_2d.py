@@ -1,36 +1,51 @@
 #!/usr/bin/python
 
 import numpy as np
-from sailfish import geo, lb_binary
+from sailfish.geo import LBGeometry2D
+from sailfish.geo_block import Subdomain2D
+from sailfish.controller import LBSimulationController
+from sailfish.lb_binary import ShanChenBinary
+from sailfish.lb_single import LBForcedSim
 
-class GeoSC(geo.LBMGeo2D):
 
-    def define_nodes(self):
-        hy, hx = np.mgrid[0:self.lat_ny, 0:self.lat_nx]
-        self.set_geo(np.logical_or(hy == 0, hy == self.lat_ny-1), self.NODE_WALL)
+class RayleighTaylorDomain(Subdomain2D):
+    def boundary_conditions(self, hx, hy):
+        self.set_node(np.logical_or(hy == 0, hy == self.gy-1), self.NODE_WALL)
 
-    def init_fields(self):
-        hy, hx = np.mgrid[0:self.lat_ny, 0:self.lat_nx]
+    def initial_conditions(self, sim, hx, hy):
+        sim.rho[:] = np.random.rand(*sim.rho.shape) / 100.0
+        sim.phi[:] = np.random.rand(*sim.phi.shape) / 100.0
 
-        self.sim.rho[:] = np.random.rand(*self.sim.rho.shape) / 100.0
-        self.sim.phi[:] = np.random.rand(*self.sim.phi.shape) / 100.0
+        sim.rho[(hy <= self.gy/2)] += 1.0
+        sim.phi[(hy <= self.gy/2)] = 1e-4
 
-        self.sim.rho[(hy <= self.lat_ny/2)] += 1.0
-        self.sim.phi[(hy <= self.lat_ny/2)] = 1e-4
+        sim.rho[(hy > self.gy/2)] = 1e-4
+        sim.phi[(hy > self.gy/2)] += 1.0
 
-        self.sim.rho[(hy > self.lat_ny/2)] = 1e-4
-        self.sim.phi[(hy > self.lat_ny/2)] += 1.0
 
-class SCSim(lb_binary.ShanChenBinary):
-    filename = 'sc_instability_2d'
+class RayleighTaylorSCSim(ShanChenBinary, LBForcedSim):
+    subdomain = RayleighTaylorDomain
 
-    def __init__(self, geo_class):
-        lb_binary.ShanChenBinary.__init__(self, geo_class, options=[],
-                                defaults={'bc_velocity': 'equilibrium', 'verbose': True, 'lat_nx': 640, #1280,
-                                'lat_ny': 400, 'grid': 'D2Q9', 'G': -1.2,
-                                'visc': 0.166666666666, 'periodic_x': True, 'scr_scale': 1})
-        self.options.tau_phi = self.get_tau()
-        self.add_body_force((0.0, -0.15 / self.options.lat_ny), grid=1)
+    @classmethod
+    def update_defaults(cls, defaults):
+        defaults.update({
+            'lat_nx': 640,
+            'lat_ny': 400,
+            'grid': 'D2Q9',
+            'G': -1.2,
+            'visc': 1.0 / 6.0,
+            'tau_phi': 1.0,
+            'periodic_x': True})
 
-sim = SCSim(GeoSC)
-sim.run()
+    @classmethod
+    def add_options(cls, group, dim):
+        ShanChenBinary.add_options(group, dim)
+        LBForcedSim.add_options(group, dim)
+
+    def __init__(self, config):
+        super(RayleighTaylorSCSim, self).__init__(config)
+        self.add_body_force((0.0, -0.15 / config.lat_ny), grid=1)
+
+
+if __name__ == '__main__':
+    LBSimulationController(RayleighTaylorSCSim, LBGeometry2D).run()
@@ -1,28 +1,37 @@
 #!/usr/bin/python
 
-import numpy
-from sailfish import geo, lb_binary
+import numpy as np
+from sailfish.geo import LBGeometry2D
+from sailfish.geo_block import Subdomain2D
+from sailfish.controller import LBSimulationController
+from sailfish.lb_binary import ShanChenBinary
 
 
-class GeoSC(geo.LBMGeo2D):
-    def init_fields(self):
-        self.sim.rho[:] = numpy.random.rand(*self.sim.rho.shape) / 1000
-        self.sim.phi[:] = numpy.random.rand(*self.sim.phi.shape) / 1000
-        self.sim.rho[:] += 1.0
-        self.sim.phi[:] += 1.0
+class SeparationDomain(Subdomain2D):
+    def initial_conditions(self, sim, hx, hy):
+        sim.rho[:] = 1.0 + np.random.rand(*sim.rho.shape) / 1000
+        sim.phi[:] = 1.0 + np.random.rand(*sim.phi.shape) / 1000
 
-class SCSim(lb_binary.ShanChenBinary):
-    filename = 'sc_separation_2d'
+    def boundary_conditions(self, hx, hy):
+        pass
+
+
+class SeparationSCSim(ShanChenBinary):
+    subdomain = SeparationDomain
+
+    @classmethod
+    def update_defaults(cls, defaults):
+        defaults.update({
+            'lat_nx': 256,
+            'lat_ny': 256,
+            'grid': 'D2Q9',
+            'G': -1.2,
+            'visc': 1.0 / 6.0,
+            'tau_phi': 1.0,
+            'periodic_x': True,
+            'periodic_y': True,
+            'every': 5})
 
-    def __init__(self, geo_class, defaults={}):
-        settings = {'bc_velocity': 'equilibrium', 'verbose': True, 'lat_nx': 256,
-                    'lat_ny': 256, 'grid': 'D2Q9', 'G': -1.2,
-                    'visc': 0.166666666666, 'periodic_x': True, 'periodic_y': True, 'every': 5,
-                    'scr_scale': 1}
-        settings.update(defaults)
-        lb_binary.ShanChenBinary.__init__(self, geo_class, options=[], defaults=settings)
-        self.options.tau_phi = self.get_tau()
 
 if __name__ == '__main__':
-    sim = SCSim(GeoSC)
-    sim.run()
+    LBSimulationController(SeparationSCSim, LBGeometry2D).run()
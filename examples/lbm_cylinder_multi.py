@@ -47,6 +47,15 @@ class CylinderBlock(Subdomain2D):
 
         cylinder_map = np.square(hx - x0) + np.square(hy - y0) < diam**2 / 4.0
         self.set_node(cylinder_map, self.NODE_WALL)
+        # Measure the drag and lift forces (enabled with --force_every).
+        self.set_force_object('cylinder', cylinder_map)
+
+        # Sample the wake of the cylinder to measure the shedding frequency
+        # (enabled with --probe_every).
+        if self.config.vertical:
+            self.set_probe('wake', (hx == x0) & (hy == y0 + 2 * diam))
+        else:
+            self.set_probe('wake', (hx == x0 + 2 * diam) & (hy == y0))
 
     def initial_conditions(self, sim, hx, hy):
         sim.rho[:] = 1.0
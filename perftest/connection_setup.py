@@ -0,0 +1,160 @@
+#!/usr/bin/python -u
+
+"""Measures the time required to set up connections between blocks.
+
+Usage: perftest/connection_setup.py [-r REPEAT]
+
+For every face size, two blocks are connected and the time required to
+create the LBConnection objects and to compute the transfer indices of
+the nodes with partial distributions is reported.
+
+For every block decomposition, the time required to find and connect
+neighboring blocks of a globally periodic domain is reported.
+"""
+
+import sys
+import time
+import numpy as np
+
+from optparse import OptionParser
+
+from sailfish import sym
+from sailfish.block_runner import BlockRunner
+from sailfish.backend_dummy import DummyBackend
+from sailfish.config import LBConfig
+from sailfish.controller import LBGeometryProcessor
+from sailfish.geo import LBGeometry2D, LBGeometry3D
+from sailfish.geo_block import SubdomainSpec2D, SubdomainSpec3D
+from sailfish.lb_base import LBSim
+
+# (grid, face size)
+cases = [
+    (sym.D2Q9, (512,)),
+    (sym.D2Q9, (4096,)),
+    (sym.D3Q19, (128, 128)),
+    (sym.D3Q19, (512, 512)),
+]
+
+depth = 16
+
+# (grid, number of blocks along every axis)
+geometry_cases = [
+    (sym.D2Q9, (32, 32)),
+    (sym.D2Q9, (100, 100)),
+    (sym.D3Q19, (10, 10, 10)),
+    (sym.D3Q19, (22, 22, 22)),
+]
+
+# Size of a single block along every axis, in geometry benchmarks.
+block_size = 8
+
+
+class _Logger(object):
+    def debug(self, *args):
+        pass
+
+
+class _Backend(DummyBackend):
+    def alloc_async_host_buf(self, shape, dtype):
+        return np.zeros(shape, dtype=dtype)
+
+
+def _make_config():
+    config = LBConfig()
+    config.parse()
+    config.precision = 'single'
+    config.block_size = 64
+    config.logger = _Logger()
+    return config
+
+def _make_blocks(face):
+    """Returns two blocks connected along the X axis, with the second block
+    shifted by a single node along the remaining axes so that partial
+    nodes are present on every edge of the face."""
+    if len(face) == 1:
+        b1 = SubdomainSpec2D((0, 0), (depth, face[0]), envelope_size=1, id_=0)
+        b2 = SubdomainSpec2D((depth, 1), (depth, face[0]), envelope_size=1,
+                id_=1)
+    else:
+        b1 = SubdomainSpec3D((0, 0, 0), (depth,) + face, envelope_size=1,
+                id_=0)
+        b2 = SubdomainSpec3D((depth, 1, 1), (depth,) + face, envelope_size=1,
+                id_=1)
+    return b1, b2
+
+def run_case(config, grid, face):
+    b1, b2 = _make_blocks(face)
+
+    t0 = time.time()
+    b1.connect(b2, grid=grid)
+    t_conn = time.time() - t0
+
+    config.lat_nx = b2.end_location[0]
+    config.lat_ny = b2.end_location[1]
+    if b1.dim == 3:
+        config.lat_nz = b2.end_location[2]
+
+    sim = LBSim(config)
+    sim.grids = [grid]
+    b1.set_actual_size(1)
+    runner = BlockRunner(sim, b1, output=None, backend=_Backend(),
+            quit_event=None)
+    runner._init_shape()
+
+    face_id, b_id = b1.connecting_blocks()[0]
+    cpair = b1.get_connection(face_id, b_id)
+    t0 = time.time()
+    runner._get_partial_dst_indices(face_id, cpair)
+    t_idx = time.time() - t0
+
+    return t_conn, t_idx, cpair.dst.partial_nodes
+
+def run_geometry_case(config, grid, blocks):
+    dim = len(blocks)
+    config.grid = grid.__name__
+    config.lat_nx, config.lat_ny = [x * block_size for x in blocks[0:2]]
+    config.periodic_x = config.periodic_y = True
+    if dim == 3:
+        config.lat_nz = blocks[2] * block_size
+        config.periodic_z = True
+        geo = LBGeometry3D(config)
+        spec_cls = SubdomainSpec3D
+    else:
+        geo = LBGeometry2D(config)
+        spec_cls = SubdomainSpec2D
+
+    specs = []
+    for pos in np.ndindex(*blocks):
+        spec = spec_cls([x * block_size for x in pos], [block_size] * dim)
+        spec.set_actual_size(1)
+        specs.append(spec)
+
+    t0 = time.time()
+    LBGeometryProcessor(specs, dim, geo).transform(config)
+    return time.time() - t0, len(specs)
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option('-r', '--repeat', dest='repeat', type='int', help='number of runs of every test', default=3)
+    options, args = parser.parse_args()
+    # Do not let LBConfig parse the options of this script.
+    sys.argv = sys.argv[0:1]
+
+    config = _make_config()
+    print '%-8s %-12s %10s %12s %12s' % ('grid', 'face', 'partial',
+            'connect [s]', 'indices [s]')
+    for grid, face in cases:
+        results = [run_case(config, grid, face) for i in range(options.repeat)]
+        print '%-8s %-12s %10d %12.4f %12.4f' % (grid.__name__,
+                'x'.join(str(x) for x in face), results[0][2],
+                min(x[0] for x in results), min(x[1] for x in results))
+
+    print
+    print '%-8s %-12s %10s %12s' % ('grid', 'blocks', 'total', 'connect [s]')
+    for grid, blocks in geometry_cases:
+        results = [run_geometry_case(config, grid, blocks) for i in
+                range(options.repeat)]
+        print '%-8s %-12s %10d %12.4f' % (grid.__name__,
+                'x'.join(str(x) for x in blocks), results[0][1],
+                min(x[0] for x in results))
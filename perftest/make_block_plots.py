@@ -1,75 +1,110 @@
 #!/usr/bin/python
+
+# Usage: perftest/make_block_plots.py [--db=FILE] [--summary] <output_dir> [test_name_prefix ...]
+#
+# Plots the MLUPS of performance tests stored in the results database as
+# a function of the block size, using the runs from the most recent block
+# size scan (run_tests.py --block_scan) of every test.
+
+import json
 import os
-import numpy as np
-import matplotlib
-import glob
 from optparse import OptionParser
 
+import matplotlib
 matplotlib.use('cairo')
 import matplotlib.pyplot as plt
 
 from matplotlib.font_manager import FontProperties
 font = FontProperties(size='xx-small')
 
-def make_plot(file):
+from tests import ResultDB, DEFAULT_DB
+
+
+def block_scans(runs):
+    """Returns a dict mapping test names to lists of (block size, mean MLUPS)
+    tuples.
+
+    Only runs with an explicitly set block size are taken into account.  For
+    every test, the runs of the most recently tested revision are used.
+    Runs with a configuration differing in anything other than the block
+    size are treated as separate tests.
+    """
+    groups = {}
+    for run in runs:
+        if 'block_size' not in run.config:
+            continue
+        config = dict(run.config)
+        block_size = config.pop('block_size')
+        key = (run.test, run.machine, run.backend,
+                json.dumps(config, sort_keys=True))
+        groups.setdefault(key, []).append((run.revision, block_size,
+            run.mlups_total))
+
+    names = {}
+    for key in sorted(groups):
+        names.setdefault(key[0], []).append(key)
+
+    scans = {}
+    for test, keys in names.iteritems():
+        for i, key in enumerate(keys):
+            name = test if len(keys) == 1 else '{0}_{1}'.format(test, i)
+            last_revision = groups[key][-1][0]
+            mlups = {}
+            for revision, block_size, value in groups[key]:
+                if revision == last_revision:
+                    mlups.setdefault(block_size, []).append(value)
+            scans[name] = [(bs, sum(x) / len(x)) for bs, x in
+                    sorted(mlups.iteritems())]
+    return scans
+
+def make_plot(name, scan):
     fig = plt.figure()
-    subplot(file, fig)
+    subplot(name, scan, fig)
 
-def subplot(file, fig, num=111):
+def subplot(name, scan, fig, num=111):
     if type(num) is tuple:
         ax1 = fig.add_subplot(*num)
     else:
         ax1 = fig.add_subplot(num)
-    ax2 = ax1.twinx()
 
-    fname = os.path.basename(file)
-    dat = np.loadtxt(file)
+    block_sizes = [x[0] for x in scan]
 
     ax1.grid('on')
-
-    ax1.bar(dat[:,0]-5, dat[:,1], 10)
+    ax1.bar([x - 5 for x in block_sizes], [x[1] for x in scan], 10)
     ax1.set_xlabel('block size')
     ax1.set_ylabel('MLUPS')
+    ax1.xaxis.set_ticks(block_sizes)
+    ax1.set_title(name)
 
-    ax2.bar(dat[:,0]+7, dat[:,2], 10, color='r')
-    ax2.set_ylabel('occupancy')
-    ax2.xaxis.set_ticks(dat[:,0])
-
-    ax2.set_title(fname)
-
-def make_summary(path):
-    files = list(sorted(glob.glob(os.path.join(path, '*'))))
-
+def make_summary(scans):
     cols = 2
-    rows = len(files) / cols
+    rows = (len(scans) + cols - 1) / cols
     fig = plt.figure(figsize=(9 * cols, rows * 5))
 
-    for i, file in enumerate(files):
-        subplot(file, fig, (rows, cols, i))
+    for i, (name, scan) in enumerate(sorted(scans.iteritems())):
+        subplot(name, scan, fig, (rows, cols, i + 1))
 
     fig.subplots_adjust(left=0.05, bottom=0.015, right=0.95, top=0.985)
     return plt
 
 if __name__ == '__main__':
     parser = OptionParser()
+    parser.add_option('--db', dest='db', help='results database', default=DEFAULT_DB)
     parser.add_option('--summary', dest='summary', help='generate a single output file', action='store_true', default=False)
     options, args = parser.parse_args()
 
     output = args[0]
-    path = args[1]
+    scans = block_scans(ResultDB(options.db).runs(args[1:]))
 
     if options.summary:
-        plot = make_summary(path)
-        plot.savefig(os.path.join(output, 'block_summary.pdf'))#,
-#                bbox_inches='tight')
+        plot = make_summary(scans)
+        plot.savefig(os.path.join(output, 'block_summary.pdf'))
     else:
-        for file in glob.glob(os.path.join(path, '*')):
-            print file
+        for name, scan in sorted(scans.iteritems()):
+            print name
 
-            make_plot(file)
+            make_plot(name, scan)
 
-            fname = os.path.basename(file)
-            plt.savefig(os.path.join(output, fname) + '.pdf')
+            plt.savefig(os.path.join(output, name) + '.pdf')
             plt.clf()
             plt.cla()
-
@@ -1,97 +1,72 @@
 #!/usr/bin/python -u
 
+# Usage: perftest/make_plots.py [--db=FILE] <output.pdf> [test_name_prefix ...]
+#
+# Plots the MLUPS of performance tests stored in the results database as
+# a function of the tested revision.  Runs of a test with different
+# fingerprints (machine, backend or configuration) are plotted separately.
+
 import os
-import sys
-import matplotlib
-import glob
-from collections import namedtuple, deque
+from optparse import OptionParser
 
+import matplotlib
 matplotlib.use('cairo')
 import matplotlib.pyplot as plt
 
 from matplotlib.font_manager import FontProperties
 font = FontProperties(size='xx-small')
 
-output = sys.argv[1]
-path = sys.argv[2]
-files = []
-
-if len(sys.argv) > 3:
-    for prefix in sys.argv[3:]:
-        files.extend(glob.glob(os.path.join(path, prefix + '*')))
-else:
-    files.extend(glob.glob(os.path.join(path, '*')))
-
-data = {}
-data2 = {}
-ids = set()
-
-TestRes = namedtuple('TestRes', 'time mlups')
-
-for file in files:
-    fname = os.path.basename(file)
-    data[fname] = {}
-    with open(file) as fp:
-        for line in fp:
-            id, testtime, mlups = line.split()
-            mlups = float(mlups)
-            testtime = float(testtime)
-            ids.add(id)
-
-            # If there are multiple tests, take the average of the performance
-            # value and keep the latest time.
-            if id in data[fname]:
-                data[fname][id] = TestRes(testtime, 0.5 * (mlups + data[fname][id].mlups))
-            else:
-                data[fname][id] = TestRes(testtime, mlups)
-
-for k, v in data.items():
-    data[k] = deque(sorted(v.items(), key=lambda x: x[1].time))
-    data2[k] = list(data[k])
-
-done = False
-ordered_ids = []
-
-while not done:
-    min_ = sys.maxint
-    kmin = None
-
-    for k, v in data.iteritems():
-        try:
-            if v[0][1].time < min_:
-                kmin = v[0][0]
-                min_ = v[0][1].time
-        except IndexError:
-            pass
-
-    if kmin is None:
-        break
-
-    ordered_ids.append(kmin)
-    for k, v in data.iteritems():
-        try:
-            if v[0][0] == kmin:
-                v.popleft()
-        except IndexError:
-            pass
-
-id2idx = dict(map(reversed, enumerate(ordered_ids)))
-
-for name, v in sorted(data2.items()):
-    xvec = []
-    yvec = []
-
-    for id, testres in v:
-        xvec.append(id2idx[id])
-        yvec.append(testres.mlups)
-
-    plt.plot(xvec, yvec, '.-', label=name)
-
-plt.gca().yaxis.grid(True)
-plt.gca().xaxis.grid(True)
-
-plt.xlabel('time (arbitrary units, higher values represent newer commits)')
-plt.ylabel('MLUPS')
-plt.legend(loc='upper left', prop=font)
-#plt.show()
-plt.savefig(os.path.join(output), format='pdf')
+from tests import ResultDB, DEFAULT_DB
+
+
+def revision_series(runs):
+    """Groups runs by test and fingerprint.
+
+    :returns: list of revisions in the order in which they were first
+        tested, and a dict mapping (test, fingerprint) pairs to lists of
+        (revision index, mean MLUPS) tuples
+    """
+    revisions = []
+    mlups = {}
+    for run in runs:
+        if run.revision not in revisions:
+            revisions.append(run.revision)
+        mlups.setdefault((run.test, run.fingerprint), {}).setdefault(
+                revisions.index(run.revision), []).append(run.mlups_total)
+
+    # If there are multiple runs of a test at the same revision, take the
+    # average of their performance.
+    series = {}
+    for key, values in mlups.iteritems():
+        series[key] = [(idx, sum(x) / len(x)) for idx, x in
+                sorted(values.iteritems())]
+    return revisions, series
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option('--db', dest='db', help='results database', default=DEFAULT_DB)
+    options, args = parser.parse_args()
+
+    output = args[0]
+    runs = ResultDB(options.db).runs(args[1:])
+    revisions, series = revision_series(runs)
+
+    fingerprints = {}
+    for test, fingerprint in series:
+        fingerprints.setdefault(test, []).append(fingerprint)
+
+    for (test, fingerprint), values in sorted(series.items()):
+        label = test
+        if len(fingerprints[test]) > 1:
+            label = '{0} ({1})'.format(test, fingerprint[:8])
+        plt.plot([x[0] for x in values], [x[1] for x in values], '.-',
+                label=label)
+
+    plt.gca().yaxis.grid(True)
+    plt.gca().xaxis.grid(True)
+
+    plt.xlabel('revision (higher values represent newer commits)')
+    plt.ylabel('MLUPS')
+    plt.legend(loc='upper left', prop=font)
+    plt.savefig(os.path.join(output), format='pdf')
@@ -1,21 +1,42 @@
 #!/usr/bin/python
 
-import numpy as np
-from sailfish import geo, lbm
+from sailfish.geo_block import Subdomain2D, Subdomain3D
+from sailfish.lb_single import LBFluidSim
 
-class TestGeo2D(geo.LBMGeo2D):
-    def init_fields(self):
-        self.sim.rho[:] = 1.0
+class TestBlock2D(Subdomain2D):
+    def boundary_conditions(self, hx, hy):
+        pass
 
-class TestGeo3D(geo.LBMGeo3D):
-    def init_fields(self):
-        self.sim.rho[:] = 1.0
+    def initial_conditions(self, sim, hx, hy):
+        sim.rho[:] = 1.0
 
-class TestSim(lbm.FluidLBMSim):
-    def __init__(self, geo_class, defaults={}):
-        settings = {'visc': 0.166666666666, 'periodic_x': True, 'periodic_y': True, 'periodic_z': True}
-        settings.update(defaults)
-        super(TestSim, self).__init__(geo_class, defaults=settings)
 
-if __name__ == '__main__':
-    TestSim(TestGeo2D).run()
+class TestBlock3D(Subdomain3D):
+    def boundary_conditions(self, hx, hy, hz):
+        pass
+
+    def initial_conditions(self, sim, hx, hy, hz):
+        sim.rho[:] = 1.0
+
+
+class TestSim2D(LBFluidSim):
+    subdomain = TestBlock2D
+
+    @classmethod
+    def update_defaults(cls, defaults):
+        defaults.update({
+            'visc': 0.166666666666,
+            'periodic_x': True,
+            'periodic_y': True})
+
+
+class TestSim3D(LBFluidSim):
+    subdomain = TestBlock3D
+
+    @classmethod
+    def update_defaults(cls, defaults):
+        defaults.update({
+            'visc': 0.166666666666,
+            'periodic_x': True,
+            'periodic_y': True,
+            'periodic_z': True})
@@ -1,91 +1,54 @@
 #!/usr/bin/python -u
 
-# Usage: perftest/run_tests.py <testsuite_name>
+# Usage: perftest/run_tests.py <testsuite_name> [test_name ...]
 
-from examples import lbm_ldc
-from examples import lbm_poiseuille
-from examples import lbm_poiseuille_3d
-from examples import sc_phase_separation
-from examples.binary_fluid import sc_separation_2d
-from examples.binary_fluid import fe_separation_2d
-from examples.binary_fluid import fe_viscous_fingering
+import sys
+
+from examples import lbm_cylinder_multi
+from examples import lbm_ldc_multi
+from examples import lbm_ldc_multi_3d
+from examples import lbm_sphere_multi_3d
 
 from models import single_fluid
-from models import binary_fluid
 
-from tests import run_suite
+from tests import run_suite, DEFAULT_DB
 
 from optparse import OptionParser
 
 model_tests = {
     'd2q9_bgk': {
         'options': {'lat_nx': 512, 'lat_ny': 512, 'model': 'bgk', 'grid': 'D2Q9'},
-        'run': lambda settings: single_fluid.TestSim(single_fluid.TestGeo2D, settings),
+        'sim': single_fluid.TestSim2D,
     },
 
     'd2q9_mrt': {
         'options': {'lat_nx': 512, 'lat_ny': 512, 'model': 'mrt', 'grid': 'D2Q9'},
-        'run': lambda settings: single_fluid.TestSim(single_fluid.TestGeo2D, settings),
+        'sim': single_fluid.TestSim2D,
     },
 
     'd3q13_mrt': {
         'options': {'lat_nx': 512, 'lat_ny': 32, 'lat_nz': 32, 'model': 'mrt', 'grid': 'D3Q13'},
-        'run': lambda settings: single_fluid.TestSim(single_fluid.TestGeo3D, settings),
+        'sim': single_fluid.TestSim3D,
     },
 
     'd3q15_bgk': {
         'options': {'lat_nx': 512, 'lat_ny': 32, 'lat_nz': 32, 'model': 'bgk', 'grid': 'D3Q15'},
-        'run': lambda settings: single_fluid.TestSim(single_fluid.TestGeo3D, settings),
+        'sim': single_fluid.TestSim3D,
     },
 
     'd3q15_mrt': {
         'options': {'lat_nx': 512, 'lat_ny': 32, 'lat_nz': 32, 'model': 'mrt', 'grid': 'D3Q15'},
-        'run': lambda settings: single_fluid.TestSim(single_fluid.TestGeo3D, settings),
+        'sim': single_fluid.TestSim3D,
     },
 
     'd3q19_bgk': {
         'options': {'lat_nx': 512, 'lat_ny': 32, 'lat_nz': 32, 'model': 'bgk', 'grid': 'D3Q19'},
-        'run': lambda settings: single_fluid.TestSim(single_fluid.TestGeo3D, settings),
+        'sim': single_fluid.TestSim3D,
     },
 
     'd3q19_mrt': {
         'options': {'lat_nx': 512, 'lat_ny': 32, 'lat_nz': 32, 'model': 'mrt', 'grid': 'D3Q19'},
-        'run': lambda settings: single_fluid.TestSim(single_fluid.TestGeo3D, settings),
-    },
-
-    'bin_d2q9_sc': {
-        'options': {'lat_nx': 512, 'lat_ny': 512, 'model': 'bgk', 'grid': 'D2Q9'},
-        'run': lambda settings: binary_fluid.SCTestSim(binary_fluid.TestGeo2D, settings),
-    },
-
-    'bin_d2q9_fe_bgk': {
-        'options': {'lat_nx': 512, 'lat_ny': 512, 'model': 'bgk', 'grid': 'D2Q9'},
-        'run': lambda settings: binary_fluid.FETestSim(binary_fluid.TestGeo2D, settings),
-    },
-
-    'bin_d2q9_fe_mrt': {
-        'options': {'lat_nx': 512, 'lat_ny': 512, 'model': 'femrt', 'grid': 'D2Q9'},
-        'run': lambda settings: binary_fluid.FETestSim(binary_fluid.TestGeo2D, settings),
-    },
-
-    'bin_d3q15_sc': {
-        'options': {'lat_nx': 512, 'lat_ny': 32, 'lat_nz': 32, 'model': 'bgk', 'grid': 'D3Q15'},
-        'run': lambda settings: binary_fluid.SCTestSim(binary_fluid.TestGeo3D, settings),
-    },
-
-    'bin_d3q19_sc': {
-        'options': {'lat_nx': 512, 'lat_ny': 32, 'lat_nz': 32, 'model': 'bgk', 'grid': 'D3Q19'},
-        'run': lambda settings: binary_fluid.SCTestSim(binary_fluid.TestGeo3D, settings),
-    },
-
-    'bin_d3q19_fe': {
-        'options': {'lat_nx': 512, 'lat_ny': 32, 'lat_nz': 32, 'model': 'bgk', 'grid': 'D3Q19'},
-        'run': lambda settings: binary_fluid.FETestSim(binary_fluid.TestGeo3D, settings),
-    },
-
-    'bin_d3q19_fe_mrt': {
-        'options': {'lat_nx': 512, 'lat_ny': 32, 'lat_nz': 32, 'model': 'femrt', 'grid': 'D3Q19'},
-        'run': lambda settings: binary_fluid.FETestSim(binary_fluid.TestGeo3D, settings),
+        'sim': single_fluid.TestSim3D,
     },
 }
 
@@ -93,72 +56,38 @@ model_tests = {
 example_tests = {
     '2d_ldc_small': {
         'options': {'lat_nx': 128, 'lat_ny': 128},
-        'run': lambda settings: lbm_ldc.LDCSim(lbm_ldc.LBMGeoLDC, settings),
+        'sim': lbm_ldc_multi.LDCSim,
+        'geo': lbm_ldc_multi.LDCGeometry,
     },
 
     '2d_ldc_large': {
         'options': {'lat_nx': 1024, 'lat_ny': 1024},
-        'run': lambda settings: lbm_ldc.LDCSim(lbm_ldc.LBMGeoLDC, settings),
-    },
-
-    '2d_poiseuille_small': {
-        'options': {'lat_nx': 128, 'lat_ny': 128},
-        'run': lambda settings: lbm_poiseuille.LPoiSim(lbm_poiseuille.LBMGeoPoiseuille, defaults=settings),
-    },
-
-    '2d_poiseuille_large': {
-        'options': {'lat_nx': 1024, 'lat_ny': 1024},
-        'run': lambda settings: lbm_poiseuille.LPoiSim(lbm_poiseuille.LBMGeoPoiseuille, defaults=settings),
+        'sim': lbm_ldc_multi.LDCSim,
+        'geo': lbm_ldc_multi.LDCGeometry,
     },
 
-    '3d_poiseuille_d3q13': {
-        'options': {'lat_nx': 128, 'lat_ny': 128, 'lat_nz': 128, 'grid': 'D3Q13'},
-        'run': lambda settings: lbm_poiseuille_3d.LPoiSim(lbm_poiseuille_3d.LBMGeoPoiseuille, defaults=settings),
+    '2d_ldc_4blocks': {
+        'options': {'lat_nx': 1024, 'lat_ny': 1024, 'blocks': 4},
+        'sim': lbm_ldc_multi.LDCSim,
+        'geo': lbm_ldc_multi.LDCGeometry,
     },
 
-    '3d_poiseuille_d3q15': {
-        'options': {'lat_nx': 128, 'lat_ny': 128, 'lat_nz': 128, 'grid': 'D3Q15'},
-        'run': lambda settings: lbm_poiseuille_3d.LPoiSim(lbm_poiseuille_3d.LBMGeoPoiseuille, defaults=settings),
+    '2d_cylinder': {
+        'options': {'lat_nx': 1024, 'lat_ny': 256},
+        'sim': lbm_cylinder_multi.CylinderSimulation,
+        'geo': lbm_cylinder_multi.CylinderGeometry,
     },
 
-    '3d_poiseuille_d3q19': {
+    '3d_ldc_d3q19': {
         'options': {'lat_nx': 128, 'lat_ny': 128, 'lat_nz': 128, 'grid': 'D3Q19'},
-        'run': lambda settings: lbm_poiseuille_3d.LPoiSim(lbm_poiseuille_3d.LBMGeoPoiseuille, defaults=settings),
-    },
-
-    '2d_sc_phase_sep_small': {
-        'options': {'lat_nx': 128, 'lat_ny': 128},
-        'run': lambda settings: sc_phase_separation.SCSim(sc_phase_separation.GeoSC, defaults=settings),
+        'sim': lbm_ldc_multi_3d.LDCSim,
+        'geo': lbm_ldc_multi_3d.LDCGeometry,
     },
 
-    '2d_sc_phase_sep_large': {
-        'options': {'lat_nx': 1024, 'lat_ny': 1024},
-        'run': lambda settings: sc_phase_separation.SCSim(sc_phase_separation.GeoSC, defaults=settings),
-    },
-
-    '2d_bin_sc_phase_sep_small': {
-        'options': {'lat_nx': 128, 'lat_ny': 128},
-        'run': lambda settings: sc_separation_2d.SCSim(sc_separation_2d.GeoSC, defaults=settings),
-    },
-
-    '2d_bin_sc_phase_sep_large': {
-        'options': {'lat_nx': 1024, 'lat_ny': 1024},
-        'run': lambda settings: sc_separation_2d.SCSim(sc_separation_2d.GeoSC, defaults=settings),
-    },
-
-    '2d_bin_fe_sep_small': {
-        'options': {'lat_nx': 128, 'lat_ny': 128},
-        'run': lambda settings: fe_separation_2d.FESim(fe_separation_2d.GeoFE, defaults=settings),
-    },
-
-    '2d_bin_fe_sep_large': {
-        'options': {'lat_nx': 1024, 'lat_ny': 1024},
-        'run': lambda settings: fe_separation_2d.FESim(fe_separation_2d.GeoFE, defaults=settings),
-    },
-
-    '3d_bin_fe_fingering': {
-        'options': {'lat_nx': 448, 'lat_ny': 48, 'lat_nz': 38},
-        'run': lambda settings: fe_viscous_fingering.FEFingerSim(fe_viscous_fingering.GeoFEFinger, defaults=settings),
+    '3d_sphere': {
+        'options': {},
+        'sim': lbm_sphere_multi_3d.SphereSimulation,
+        'geo': lbm_sphere_multi_3d.SphereGeometry,
     },
 }
 
@@ -167,11 +96,25 @@ if __name__ == '__main__':
     parser = OptionParser()
     parser.add_option('-b', '--block_scan', dest='block_scan', help='perform a scan over block sizes', action='store_true', default=False)
     parser.add_option('-d', '--double', dest='double', help='run tests in double precision', action='store_true', default=False)
+    parser.add_option('--db', dest='db', help='results database', default=DEFAULT_DB)
+    parser.add_option('-r', '--repeat', dest='repeat', type='int', help='number of runs of every test', default=3)
+    parser.add_option('--history', dest='history', type='int', help='number of past runs to compare with', default=10)
+    parser.add_option('--alpha', dest='alpha', type='float', help='significance level for regressions', default=0.01)
+    parser.add_option('--min_drop', dest='min_drop', type='float', help='minimum relative MLUPS drop reported as a regression', default=0.02)
     options, args = parser.parse_args()
 
     suite = globals()[args[0]]
 
     if options.block_scan:
-        run_suite(suite, args[1:], block_sizes=[32 * x for x in  range(1,9)], double=options.double)
+        block_sizes = [32 * x for x in range(1, 9)]
     else:
-        run_suite(suite, args[1:], double=options.double)
+        block_sizes = None
+
+    regressions = run_suite(suite, args[1:], options.db, block_sizes=block_sizes,
+            double=options.double, repeat=options.repeat,
+            history=options.history, alpha=options.alpha,
+            min_drop=options.min_drop)
+
+    if regressions:
+        print 'Performance regressions detected in: %s' % ', '.join(regressions)
+        sys.exit(1)
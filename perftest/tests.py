@@ -1,98 +1,271 @@
-import git
+"""Runs performance tests and keeps their results in a SQLite database.
+
+Every test is run in the benchmark mode of LBSimulationController.  The
+TimingInfo records of all blocks are stored together with fingerprints of
+the machine, the compute backend and the simulation configuration, so that
+only comparable results are used to detect performance regressions.
+"""
+
+import hashlib
+import json
+import math
 import os
+import platform
+import sqlite3
+import subprocess
 import sys
 import time
+from collections import namedtuple
 
-import pycuda
-import pycuda.autoinit
-import pycuda.driver
+from sailfish.controller import LBSimulationController
 
-repo = git.Repo('.')
-head = repo.commits()[0]
+DEFAULT_DB = os.path.join('perftest', 'results', 'perf.sqlite')
 
-def run_test(name, test_suite, block_sizes, double=False):
-    global head
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    test TEXT,
+    timestamp REAL,
+    revision TEXT,
+    machine TEXT,
+    backend TEXT,
+    config TEXT,
+    fingerprint TEXT,
+    mlups_total REAL,
+    mlups_comp REAL
+);
+CREATE INDEX IF NOT EXISTS runs_fingerprint ON runs (test, fingerprint);
+CREATE TABLE IF NOT EXISTS timings (
+    run_id INTEGER REFERENCES runs(id),
+    block_id INTEGER,
+    nodes INTEGER,
+    comp REAL, bulk REAL, bnd REAL, coll REAL, data REAL,
+    recv REAL, send REAL, wait REAL, total REAL
+);
+"""
 
-    # Default settings.
-    defaults = {
-        'benchmark': True,
-        'quiet': True,
-        'verbose': False,
-        'max_iters': 10000,
-        'every': 1000
-    }
+Run = namedtuple('Run', 'id test revision machine backend config fingerprint '
+        'mlups_total mlups_comp')
 
-    print '* %s' % name
+# Settings used for all tests, unless overridden by the test itself.
+defaults = {
+    'mode': 'benchmark',
+    'quiet': True,
+    'verbose': False,
+    'max_iters': 10000,
+    'every': 1000,
+}
+
+
+def git_revision():
+    """Returns the ID of the current git commit, or an empty string."""
+    try:
+        p = subprocess.Popen(['git', 'rev-parse', 'HEAD'],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, _ = p.communicate()
+    except OSError:
+        return ''
+    if p.returncode != 0:
+        return ''
+    return out.strip()
+
+def machine_fingerprint(settings):
+    return json.dumps({
+        'node': platform.node(),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'gpus': settings.get('gpus', 0)}, sort_keys=True)
+
+def backend_fingerprint(settings):
+    versions = {}
+    for module in ('pycuda', 'pyopencl'):
+        try:
+            versions[module] = __import__(module).VERSION_TEXT
+        except (ImportError, AttributeError):
+            pass
+    return json.dumps({
+        'backends': settings.get('backends', 'cuda,opencl'),
+        'versions': versions}, sort_keys=True)
+
+def config_fingerprint(settings):
+    return json.dumps(settings, sort_keys=True)
+
+def summarize(timing_infos, blocks):
+    """Returns the total effective and computational MLUPS."""
+    mlups_total = 0.0
+    mlups_comp = 0.0
+    for ti in timing_infos:
+        block = blocks[ti.block_id]
+        mlups_total += block.num_nodes / ti.total * 1e-6
+        mlups_comp += block.num_nodes / ti.comp * 1e-6
+    return mlups_total, mlups_comp
+
+
+class ResultDB(object):
+    """Stores results of performance tests."""
+
+    def __init__(self, path=DEFAULT_DB):
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript(_SCHEMA)
+
+    def add_run(self, test, settings, timing_infos, blocks, revision):
+        machine = machine_fingerprint(settings)
+        backend = backend_fingerprint(settings)
+        config = config_fingerprint(settings)
+        fingerprint = hashlib.sha1(machine + backend + config).hexdigest()
+        mlups_total, mlups_comp = summarize(timing_infos, blocks)
+
+        cur = self.conn.execute('INSERT INTO runs (test, timestamp, revision, '
+                'machine, backend, config, fingerprint, mlups_total, '
+                'mlups_comp) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (test, time.time(), revision, machine, backend, config,
+                 fingerprint, mlups_total, mlups_comp))
+        run_id = cur.lastrowid
+        for ti in timing_infos:
+            self.conn.execute('INSERT INTO timings VALUES '
+                    '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (run_id, ti.block_id, blocks[ti.block_id].num_nodes,
+                     ti.comp, ti.bulk, ti.bnd, ti.coll, ti.data, ti.recv,
+                     ti.send, ti.wait, ti.total))
+        self.conn.commit()
+        return run_id, fingerprint, mlups_total
+
+    def history(self, test, fingerprint, before_id, limit):
+        """Returns MLUPS of at most `limit` most recent runs of a test with
+        the same fingerprint that were stored before run `before_id`."""
+        cur = self.conn.execute('SELECT mlups_total FROM runs WHERE test = ? '
+                'AND fingerprint = ? AND id < ? ORDER BY id DESC LIMIT ?',
+                (test, fingerprint, before_id, limit))
+        return [x[0] for x in cur.fetchall()]
+
+    def runs(self, prefixes=()):
+        """Returns a list of Run tuples for all runs of tests with names
+        starting with any of `prefixes` (all tests if empty), in the order
+        in which they were stored.  The config is returned as a dict."""
+        cur = self.conn.execute('SELECT id, test, revision, machine, backend, '
+                'config, fingerprint, mlups_total, mlups_comp FROM runs '
+                'ORDER BY id')
+        ret = []
+        for row in cur.fetchall():
+            run = Run(*row)
+            if prefixes and not any(run.test.startswith(x) for x in prefixes):
+                continue
+            ret.append(run._replace(config=json.loads(run.config)))
+        return ret
 
-    if double:
-        defaults['precision'] = 'double'
-    else:
-        defaults['precision'] = 'single'
+
+def _mean_var(x):
+    mean = sum(x) / float(len(x))
+    var = sum((y - mean)**2 for y in x) / (len(x) - 1.0)
+    return mean, var
+
+def regression_pvalue(history, current):
+    """Returns the p-value of the one-sided Welch's t-test of the hypothesis
+    that `current` MLUPS values are lower than `history` MLUPS values,
+    or None if there is not enough data for the test."""
+    if len(history) < 2 or len(current) < 2:
+        return None
+
+    m1, v1 = _mean_var(history)
+    m2, v2 = _mean_var(current)
+    se2 = v1 / len(history) + v2 / len(current)
+    if se2 == 0.0:
+        return 0.0 if m2 < m1 else 1.0
+
+    t = (m2 - m1) / math.sqrt(se2)
+    df = se2**2 / ((v1 / len(history))**2 / (len(history) - 1) +
+                   (v2 / len(current))**2 / (len(current) - 1))
+    try:
+        from scipy import stats
+        return stats.t.cdf(t, df)
+    except ImportError:
+        # Normal approximation of the t distribution.
+        return 0.5 * math.erfc(-t / math.sqrt(2.0))
+
+
+def run_test(name, test_suite, db, repeat=3, history=10, alpha=0.01,
+        min_drop=0.02, block_size=None, double=False):
+    """Runs a single test `repeat` times and checks its results against
+    the history of the test.
+
+    :returns: True if a performance regression was detected
+    """
+    print '* %s' % name
 
     if name not in test_suite:
         raise ValueError('Test %s not found' % name)
 
-    if block_sizes is not None:
-        basepath = os.path.join('perftest', 'results', defaults['precision'],
-                pycuda.autoinit.device.name().replace(' ', '_'),
-                'blocksize')
-        path = os.path.join(basepath, name)
+    settings = {}
+    settings.update(defaults)
+    settings['precision'] = 'double' if double else 'single'
+    if block_size is not None:
+        settings['block_size'] = block_size
+    settings.update(test_suite[name]['options'])
 
-        if not os.path.exists(basepath):
-            os.makedirs(basepath)
+    revision = git_revision()
+    current = []
+    first_id = None
+    for i in range(repeat):
+        ctrl = LBSimulationController(test_suite[name]['sim'],
+                test_suite[name].get('geo'), settings)
+        timing_infos, blocks = ctrl.run()
+        run_id, fingerprint, mlups = db.add_run(name, settings, timing_infos,
+                blocks, revision)
+        if first_id is None:
+            first_id = run_id
+        current.append(mlups)
 
-        ddata = pycuda.tools.DeviceData()
+    past = db.history(name, fingerprint, first_id, history)
+    mean = sum(current) / len(current)
+    print '  MLUPS: %.2f (%d runs)' % (mean, len(current))
 
-        f = open(path, 'w')
-        print >>f, "# block_size, performance, occupancy, tb_per_mp, warps_per_mp"
+    p = regression_pvalue(past, current)
+    if p is None:
+        print '  not enough history to check for regressions'
+        return False
 
-        for bs in block_sizes:
-            defaults['block_size'] = bs
-            settings = {}
-            settings.update(defaults)
-            settings.update(test_suite[name]['options'])
-            sim = test_suite[name]['run'](settings)
-            try:
-                sim.run()
-            except pycuda.driver.LaunchError:
-                continue
-            kern = sim._lb_kernel
-            occ = pycuda.tools.OccupancyRecord(ddata, bs, kern.shared_size_bytes, kern.num_regs)
-            print >>f, bs, sim._bench_avg, occ.occupancy, occ.tb_per_mp, occ.warps_per_mp
+    past_mean = sum(past) / len(past)
+    drop = 1.0 - mean / past_mean
+    if p < alpha and drop > min_drop:
+        print '  REGRESSION: %.1f%% slower than %.2f MLUPS (p = %.2e)' % (
+                drop * 100.0, past_mean, p)
+        return True
 
-        f.close()
-    else:
-        settings = {}
-        settings.update(defaults)
-        settings.update(test_suite[name]['options'])
-        sim = test_suite[name]['run'](settings)
-        sim.run()
-
-        basepath = os.path.join('perftest', 'results', defaults['precision'], pycuda.autoinit.device.name().replace(' ','_'))
-        path = os.path.join(basepath, name)
-        if not os.path.exists(basepath):
-            os.makedirs(basepath)
-
-        f = open(path, 'a')
-        print >>f, head.id, time.time(), sim._bench_avg
-        f.close()
-
-def run_suite(suite, args, block_sizes=None, double=False):
+    print '  previous: %.2f MLUPS (p = %.2e)' % (past_mean, p)
+    return False
+
+
+def run_suite(suite, args, db_path=DEFAULT_DB, block_sizes=None, **kwargs):
+    """Runs all tests in `suite` matching names or name prefixes in `args`.
+
+    :returns: list of names of tests with performance regressions
+    """
     sys.argv = sys.argv[0:1]
+    db = ResultDB(db_path)
 
+    names = []
     if args:
-        done = set()
-
         for name in args:
             if name in suite:
-                run_test(name, suite, block_sizes, double=double)
+                names.append(name)
             else:
                 # Treat test name as a prefix if an exact match has not been found.
-                for x in suite:
-                    if len(name) < len(x) and name == x[0:len(name)] and x not in done:
-                        run_test(x, suite, block_sizes, double=double)
-                        done.add(x)
+                for x in sorted(suite):
+                    if x.startswith(name) and x not in names:
+                        names.append(x)
     else:
-        for name in suite.iterkeys():
-            run_test(name, suite, block_sizes, double=double)
+        names = sorted(suite.iterkeys())
 
+    if block_sizes is None:
+        block_sizes = [None]
+
+    regressions = []
+    for name in names:
+        for bs in block_sizes:
+            if run_test(name, suite, db, block_size=bs, **kwargs):
+                regressions.append(name if bs is None else
+                        '{0} (block_size={1})'.format(name, bs))
+    return regressions
@@ -0,0 +1,117 @@
+#!/usr/bin/python
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from sailfish import io
+from sailfish.geo_block import Subdomain3D
+from sailfish.controller import LBSimulationController
+from sailfish.lb_single import LBFluidSim, LBForcedSim
+from regtest.blocks import util
+
+block_size = 64
+tmpdir = tempfile.mkdtemp()
+# Distance between the channel walls.
+width = 32
+
+class PoiseuilleBlock(Subdomain3D):
+    """3D channel with walls at the top and bottom, periodic along X and Z."""
+
+    def boundary_conditions(self, hx, hy, hz):
+        self.set_node(np.logical_or(hy == 0, hy == self.gy - 1), self.NODE_WALL)
+
+    def initial_conditions(self, sim, hx, hy, hz):
+        sim.rho[:] = 1.0
+
+
+class PoiseuilleSim(LBFluidSim, LBForcedSim):
+    subdomain = PoiseuilleBlock
+    max_v = 0.02
+
+    @classmethod
+    def update_defaults(cls, defaults):
+        defaults.update({
+            'lat_nx': 64,
+            'lat_ny': width + 2,
+            'lat_nz': 8,
+            'grid': 'D3Q19',
+            'periodic_x': True,
+            'periodic_z': True})
+
+    @classmethod
+    def add_options(cls, group, dim):
+        LBFluidSim.add_options(group, dim)
+        LBForcedSim.add_options(group, dim)
+
+    @classmethod
+    def accel(cls, config):
+        """Body force resulting in a maximum velocity of max_v."""
+        return 8.0 * config.visc * cls.max_v / (config.lat_ny - 2)**2
+
+    def __init__(self, config):
+        super(PoiseuilleSim, self).__init__(config)
+        self.add_body_force((self.accel(config), 0.0, 0.0))
+
+
+class TestPoiseuille(unittest.TestCase):
+    def run_channel(self, model, visc, **kwargs):
+        """Runs the simulation until the flow is fully developed and returns
+        the simulated and analytical velocity profiles at the fluid nodes."""
+        output = os.path.join(tmpdir, '{0}_{1}'.format(model, visc))
+        # The slowest mode of the transient decays as
+        # exp(-pi**2 * visc * t / width**2).
+        max_iters = int(2 * width**2 / visc)
+        defaults = {
+            'model': model,
+            'visc': visc,
+            'max_iters': max_iters,
+            'every': max_iters,
+            'output': output,
+            'block_size': block_size,
+            'mode': 'batch',
+            'quiet': True}
+        defaults.update(kwargs)
+
+        ctrl = LBSimulationController(PoiseuilleSim, default_config=defaults)
+        ctrl.run()
+        config = ctrl.config
+
+        data = np.load(io.filename(output, io.filename_iter_digits(max_iters),
+            0, max_iters))
+        prof = np.average(np.average(data['v'][0], axis=2), axis=0)
+        th = util.poiseuille_profile(config.lat_ny, PoiseuilleSim.accel(config),
+                visc)
+        return prof[1:-1], th[1:-1]
+
+    def assert_profile(self, prof, th, tolerance):
+        error = np.max(np.abs(prof - th)) / np.max(th)
+        self.assertTrue(error < tolerance,
+                'relative profile error {0} exceeds {1}'.format(error, tolerance))
+
+    def test_bgk(self):
+        prof, th = self.run_channel('bgk', 0.1)
+        self.assert_profile(prof, th, 0.01)
+
+    def test_mrt(self):
+        prof, th = self.run_channel('mrt', 0.1)
+        self.assert_profile(prof, th, 0.01)
+
+    def test_trt(self):
+        # With Lambda = 3/16 the bounce-back walls are located halfway
+        # between the nodes independently of the viscosity.  At visc = 0.5,
+        # BGK misplaces the walls enough to exceed the tolerance (about 1%
+        # error for this channel width).
+        for visc in (0.02, 0.5):
+            prof, th = self.run_channel('trt', visc, trt_magic=3.0/16.0)
+            self.assert_profile(prof, th, 0.005)
+
+
+if __name__ == '__main__':
+    args = util.parse_cmd_line()
+    block_size = args.block_size
+    unittest.main()
+    shutil.rmtree(tmpdir)
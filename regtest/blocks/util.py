@@ -1,6 +1,8 @@
 import argparse
 import sys
 
+import numpy as np
+
 def parse_cmd_line():
     parser = argparse.ArgumentParser()
     parser.add_argument('--block_size', metavar='N', type=int, default=64,
@@ -10,3 +12,15 @@ def parse_cmd_line():
     del sys.argv[1:]
     sys.argv.extend(remaining)
     return args
+
+def poiseuille_profile(width, accel, visc):
+    """Returns the analytical velocity profile of a body force driven flow in
+    a channel with wall nodes at 0 and width - 1.
+
+    The walls are assumed to be located halfway between the wall nodes and
+    the first fluid nodes.  The profile is zero at the wall nodes.
+    """
+    y = np.arange(width, dtype=np.float64)
+    prof = accel / (2.0 * visc) * (y - 0.5) * (width - 1.5 - y)
+    prof[0] = prof[-1] = 0.0
+    return prof
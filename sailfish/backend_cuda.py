@@ -43,6 +43,11 @@ def _set_txt_format(dsc, strides):
 class CUDABackend(object):
     name='cuda'
 
+    #: Exceptions raised when a kernel cannot be compiled or launched with
+    #: the current settings (e.g. the block size).
+    kernel_errors = (cuda.CompileError, cuda.LaunchError, cuda.LogicError,
+            cuda.MemoryError)
+
     @classmethod
     def devices_count(cls):
         """Returns the number of CUDA devices on this host."""
@@ -63,8 +68,6 @@ class CUDABackend(object):
         group.add_argument('--cuda-fermi-highprec', dest='cuda_fermi_highprec',
                 help='use high precision division on Compute Capability 2.0+ '
                      ' devices', action='store_true', default=False)
-        group.add_argument('--block_size', type=int, default=64,
-                help='size of the block of threads on the compute device')
         return 1
 
     def __init__(self, options, gpu_id):
@@ -88,6 +91,10 @@ class CUDABackend(object):
     def total_memory(self):
         return self._device.total_memory()
 
+    @property
+    def device_name(self):
+        return self._device.name()
+
     def alloc_buf(self, size=None, like=None, wrap_in_array=False):
         if like is not None:
             # When calculating the total array size, take into account
@@ -6,6 +6,8 @@ __license__ = 'LGPL3'
 
 class DummyBackend(object):
 
+    kernel_errors = ()
+
     @classmethod
     def add_options(cls, group):
         return 0
@@ -14,6 +16,10 @@ class DummyBackend(object):
         self.buffers = {}
         self.arrays = {}
 
+    @property
+    def device_name(self):
+        return 'dummy'
+
     def alloc_buf(self, size=None, like=None, wrap_in_array=True):
         return 0
 
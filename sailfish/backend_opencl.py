@@ -5,27 +5,116 @@ __email__ = 'sailfish-cfd@googlegroups.com'
 __license__ = 'LGPL3'
 
 import os
+import time
+import numpy as np
 import pyopencl as cl
 import pyopencl.array as clarray
 import pyopencl.reduction as reduction
 import pyopencl.tools
 
+# Maps kernel argument format characters (as used by PyCUDA) to the
+# types of scalar arguments.  Pointers are represented by None.
+_ARG_TYPES = {
+    'P': None,
+    'i': np.int32,
+    'I': np.uint32,
+    'f': np.float32,
+    'd': np.float64,
+}
+
+_DEVICE_TYPES = {
+    'gpu': cl.device_type.GPU,
+    'cpu': cl.device_type.CPU,
+    'accelerator': cl.device_type.ACCELERATOR,
+    'all': cl.device_type.ALL,
+}
+
+
+class OpenCLStream(object):
+    """Command queue used in place of a CUDA stream.
+
+    The queue executes commands in order, and commands in different queues
+    can overlap, as is the case with CUDA streams."""
+
+    def __init__(self, queue):
+        self.queue = queue
+
+    def synchronize(self):
+        self.queue.finish()
+
+    def wait_for_event(self, event):
+        """Makes all future commands in this queue wait for 'event'."""
+        cl.enqueue_barrier(self.queue, wait_for=[event.event])
+
+
+class OpenCLEvent(object):
+    """Marker in a command queue, used in place of a CUDA event."""
+
+    def __init__(self, event, host_time=None):
+        """
+        :param host_time: host time at which the marker was known to be
+            completed, used instead of the profiling information if not None
+        """
+        self.event = event
+        self.host_time = host_time
+
+    def time_since(self, other):
+        """Returns the time (in ms) elapsed between 'other' and this event.
+        Both events have to be completed."""
+        if self.host_time is not None and other.host_time is not None:
+            return (self.host_time - other.host_time) * 1e3
+        return (self.event.profile.end - other.event.profile.end) / 1e6
+
+
+def _marker_profiling_supported(ctx, device):
+    """Checks whether markers in command queues of 'device' carry profiling
+    information.  This is optional for markers in OpenCL 1.1 and not
+    implemented by all runtimes."""
+    profiling = cl.command_queue_properties.PROFILING_ENABLE
+    if not device.queue_properties & profiling:
+        return False
+
+    queue = cl.CommandQueue(ctx, device, properties=profiling)
+    event = cl.enqueue_marker(queue)
+    queue.finish()
+    try:
+        event.profile.end
+    except cl.Error:
+        return False
+    return True
+
+
 class OpenCLBackend(object):
     name='opencl'
 
+    #: Exceptions raised when a kernel cannot be compiled or launched with
+    #: the current settings (e.g. the block size).
+    kernel_errors = (cl.RuntimeError, cl.LogicError, cl.MemoryError)
+
+    @classmethod
+    def devices_count(cls):
+        """Returns the number of OpenCL devices on the default platform."""
+        return len(cl.get_platforms()[0].get_devices())
+
     @classmethod
     def add_options(cls, group):
         group.add_argument('--opencl-interactive-select',
                 dest='opencl_interactive',
                 help='select the OpenCL device in an interactive manner',
                 action='store_true', default=False)
-        group.add_argument('--opencl-block-size', type=int,
-                help='size of the block of threads on the compute '
-                     'device; use 0 to set block size to an '
-                     'automatically selected value', default=0)
+        group.add_argument('--opencl-device-type', dest='opencl_device_type',
+                help='type of the OpenCL devices to use; the ID passed via '
+                     '--gpus selects one of the devices of this type',
+                type=str, choices=sorted(_DEVICE_TYPES.keys()),
+                default='gpu')
         return 1
 
-    def __init__(self, options):
+    def __init__(self, options, gpu_id=0):
+        """Initializes the OpenCL backend.
+
+        :param gpu_id: number of the device to use, among all devices of the
+            selected type on the selected platform
+        """
         if options.opencl_interactive:
             self.ctx = cl.create_some_context(True)
         else:
@@ -35,76 +124,125 @@ class OpenCLBackend(object):
                 platform_num = 0
 
             platform = cl.get_platforms()[platform_num]
-            devices = platform.get_devices(device_type=cl.device_type.GPU)
+            devices = platform.get_devices(
+                    device_type=_DEVICE_TYPES[options.opencl_device_type])
 
             if 'OPENCL_DEVICE' in os.environ:
-                device = int(os.environ['OPENCL_DEVICE'])
-                devices = [devices[device]]
+                gpu_id = int(os.environ['OPENCL_DEVICE'])
+            devices = [devices[gpu_id]]
             self.ctx = cl.Context(devices=devices, properties=[(cl.context_properties.PLATFORM, platform)])
 
-        self.queue = cl.CommandQueue(self.ctx)
+        self._device = self.ctx.devices[0]
+        self._marker_profiling = _marker_profiling_supported(self.ctx,
+                self._device)
+        self.queue = self.make_stream().queue
         self.buffers = {}
         self.arrays = {}
+        self.options = options
+
+    @property
+    def total_memory(self):
+        return self._device.global_mem_size
+
+    @property
+    def device_name(self):
+        return self._device.name
 
     def alloc_buf(self, size=None, like=None, wrap_in_array=True):
         mf = cl.mem_flags
         if like is not None:
-            if like.base is not None:
+            if like.base is not None and not isinstance(like.base, cl.MemoryMap):
                 hbuf = like.base
             else:
                 hbuf = like
 
             buf = cl.Buffer(self.ctx, mf.READ_WRITE | mf.COPY_HOST_PTR, hostbuf=hbuf)
             self.buffers[buf] = hbuf
-            self.to_buf(buf)
             if wrap_in_array:
-                self.arrays[buf] = clarray.Array(self.ctx, like.shape, like.dtype, data=buf)
+                self.arrays[buf] = clarray.Array(self.queue, like.shape, like.dtype, data=buf)
         else:
             buf = cl.Buffer(self.ctx, mf.READ_WRITE, size)
 
         return buf
 
+    def alloc_async_host_buf(self, shape, dtype):
+        """Allocates a buffer that can be used for asynchronous data
+        transfers.
+
+        The buffer is allocated by the OpenCL runtime and mapped into the
+        host memory, which allows the runtime to use pinned memory."""
+        mf = cl.mem_flags
+        dtype = np.dtype(dtype)
+        if isinstance(shape, (int, long)):
+            shape = (shape,)
+        size = int(np.prod(shape)) * dtype.itemsize
+        if size == 0:
+            return np.zeros(shape, dtype=dtype)
+        buf = cl.Buffer(self.ctx, mf.READ_WRITE | mf.ALLOC_HOST_PTR, size)
+        array, _ = cl.enqueue_map_buffer(self.queue, buf,
+                cl.map_flags.READ | cl.map_flags.WRITE, 0, shape, dtype,
+                is_blocking=True)
+        array[:] = 0
+        return array
+
     def to_buf(self, cl_buf, source=None):
         if source is None:
             if cl_buf in self.buffers:
-                cl.enqueue_write_buffer(self.queue, cl_buf, self.buffers[cl_buf])
+                cl.enqueue_copy(self.queue, cl_buf, self.buffers[cl_buf])
             else:
                 raise ValueError('Unknown compute buffer and source not specified.')
         else:
-            if source.base is not None:
-                cl.enqueue_write_buffer(self.queue, cl_buf, source.base)
+            if source.base is not None and not isinstance(source.base, cl.MemoryMap):
+                cl.enqueue_copy(self.queue, cl_buf, source.base)
             else:
-                cl.enqueue_write_buffer(self.queue, cl_buf, source)
+                cl.enqueue_copy(self.queue, cl_buf, source)
 
     def from_buf(self, cl_buf, target=None):
         if target is None:
             if cl_buf in self.buffers:
-                cl.enqueue_read_buffer(self.queue, cl_buf, self.buffers[cl_buf])
+                cl.enqueue_copy(self.queue, self.buffers[cl_buf], cl_buf)
             else:
                 raise ValueError('Unknown compute buffer and target not specified.')
         else:
-            if target.base is not None:
-                cl.enqueue_read_buffer(self.queue, cl_buf, target.base)
+            if target.base is not None and not isinstance(target.base, cl.MemoryMap):
+                cl.enqueue_copy(self.queue, target.base, cl_buf)
             else:
-                cl.enqueue_read_buffer(self.queue, cl_buf, target)
+                cl.enqueue_copy(self.queue, target, cl_buf)
+
+    def _queue(self, stream):
+        if stream is None:
+            return self.queue
+        return stream.queue
+
+    def to_buf_async(self, cl_buf, stream=None):
+        cl.enqueue_copy(self._queue(stream), cl_buf, self.buffers[cl_buf],
+                is_blocking=False)
+
+    def from_buf_async(self, cl_buf, stream=None):
+        cl.enqueue_copy(self._queue(stream), self.buffers[cl_buf], cl_buf,
+                is_blocking=False)
 
     def build(self, source):
         preamble = '#pragma OPENCL EXTENSION cl_khr_fp64: enable\n'
         return cl.Program(self.ctx, preamble + source).build() #'-cl-single-precision-constant -cl-fast-relaxed-math')
 
     def get_kernel(self, prog, name, block, args, args_format, shared=0, fields=[]):
-        kern = getattr(prog, name)
-        for i, arg in enumerate(args):
-            kern.set_arg(i, arg)
+        # A new kernel object is created every time, as the arguments are
+        # a property of the kernel object, and the same kernel is often
+        # used with different arguments.
+        kern = cl.Kernel(prog, name)
+        kern.set_scalar_arg_dtypes([_ARG_TYPES[x] for x in args_format])
+        kern.set_args(*args)
         setattr(kern, 'block', block)
         return kern
 
-    def run_kernel(self, kernel, grid, *args):
+    def run_kernel(self, kernel, grid, stream=None):
         global_size = []
         for i, dim in enumerate(grid):
             global_size.append(dim * kernel.block[i])
 
-        cl.enqueue_nd_range_kernel(self.queue, kernel, global_size, kernel.block[0:len(global_size)])
+        cl.enqueue_nd_range_kernel(self._queue(stream), kernel, global_size,
+                kernel.block[0:len(global_size)])
 
     def get_reduction_kernel(self, reduce_expr, map_expr, neutral, *args):
         """Generate and return reduction kernel; see PyOpenCL documentation
@@ -124,8 +262,8 @@ class OpenCLBackend(object):
         for i, arg in enumerate(args):
             array = self.arrays[arg]
             arrays.append(array)
-            arguments.append('const {0} *x{1}'.format(pyopencl.tools.dtype_to_ctype(array.dtype), i))
-        kernel = reduction.ReductionKernel(arrays[0].dtype, neutral=neutral,
+            arguments.append('__global const {0} *x{1}'.format(pyopencl.tools.dtype_to_ctype(array.dtype), i))
+        kernel = reduction.ReductionKernel(self.ctx, arrays[0].dtype, neutral=neutral,
                 reduce_expr=reduce_expr, map_expr=map_expr,
                 arguments=', '.join(arguments))
         return lambda : kernel(*arrays).get()
@@ -133,8 +271,27 @@ class OpenCLBackend(object):
     def sync(self):
         self.queue.finish()
 
+    def make_stream(self):
+        properties = 0
+        if self._marker_profiling:
+            properties = cl.command_queue_properties.PROFILING_ENABLE
+        return OpenCLStream(cl.CommandQueue(self.ctx, self._device,
+            properties=properties))
+
+    def make_event(self, stream, timing=False):
+        event = cl.enqueue_marker(self._queue(stream))
+        if not timing or self._marker_profiling:
+            return OpenCLEvent(event)
+
+        # Without profiling information for markers, fall back to host
+        # timing.  This blocks until all previously enqueued commands in
+        # the queue are completed.
+        event.wait()
+        return OpenCLEvent(event, host_time=time.time())
+
     def get_defines(self):
         return {
+            'backend': 'opencl',
             'shared_var': '__local',
             'kernel': '__kernel',
             'global_ptr': '__global',
@@ -5,24 +5,67 @@ __email__ = 'sailfish-cfd@googlegroups.com'
 __license__ = 'LGPL3'
 
 from collections import defaultdict, namedtuple
+import json
 import math
 import operator
+import os
 import numpy as np
+import tempfile
 import time
 import zmq
-from sailfish import codegen, util
+from sailfish import codegen, geo_block, metrics, timeline, util
 
 # Used to hold a reference to a CUDA kernel and a grid on which it is
 # to be executed.
 KernelGrid = namedtuple('KernelGrid', 'kernel grid')
 TimingInfo = namedtuple('TimingInfo', 'comp bulk bnd coll data recv send wait total block_id')
+# Load of a block, sent to the machine master every rebalance_every
+# iterations.  Times are averages per iteration, in seconds.
+LoadReport = namedtuple('LoadReport', 'block_id iteration busy wait')
+# State of a block, used to continue the simulation of the block on a
+# different device.
+BlockState = namedtuple('BlockState', 'iteration dists fields timeline')
+# Force exerted by the fluid on the part of every obstacle belonging to a
+# block, sent to the controller every force_every iterations.  'forces' is
+# a dict mapping obstacle names to force vectors.
+ForceSample = namedtuple('ForceSample', 'block_id iteration forces')
+
+# Number of boundary links summed within a single work group when computing
+# the force on obstacles.  Has to be a power of 2.
+FORCE_BLOCK_SIZE = 64
+
+
+def _load_autotune_cache(path):
+    try:
+        f = open(path, 'r')
+    except IOError:
+        return {}
+    try:
+        return json.load(f)
+    except ValueError:
+        return {}
+    finally:
+        f.close()
+
+def _save_autotune_result(path, key, value):
+    # Multiple block runners can be updating the cache at the same time.
+    # Write the new version to a temporary file and atomically rename it
+    # so that the cache file is never seen in an inconsistent state.
+    cache = _load_autotune_cache(path)
+    cache[key] = value
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.')
+    f = os.fdopen(fd, 'w')
+    json.dump(cache, f, indent=2, sort_keys=True)
+    f.close()
+    os.rename(tmp_path, path)
 
 
 class ConnectionBuffer(object):
     def __init__(self, face, cpair, coll_buf, coll_idx, recv_buf,
             dist_partial_buf, dist_partial_idx, dist_partial_sel,
-            dist_full_buf, dist_full_idx):
+            dist_full_buf, dist_full_idx, grid_id=0):
         self.face = face
+        self.grid_id = grid_id
         self.cpair = cpair
         self.coll_buf = coll_buf
         self.coll_idx = coll_idx
@@ -33,15 +76,33 @@ class ConnectionBuffer(object):
         self.dist_full_buf = dist_full_buf
         self.dist_full_idx = dist_full_idx
 
-    def distribute(self, backend, stream):
+    def distribute(self):
+        """Copies the received data to the host side of the distribution
+        buffers.  The data is uploaded to the GPU separately, in a single
+        transfer for all connections."""
         if self.dist_partial_sel is not None:
             self.dist_partial_buf.host[:] = self.recv_buf[self.dist_partial_sel]
-            backend.to_buf_async(self.dist_partial_buf.gpu, stream)
 
         if self.cpair.dst.dst_slice:
             slc = [slice(0, self.recv_buf.shape[0])] + list(reversed(self.cpair.dst.dst_full_buf_slice))
-            self.dist_full_buf.host[:] = self.recv_buf[slc]
-            backend.to_buf_async(self.dist_full_buf.gpu, stream)
+            self.dist_full_buf.host[:] = self.recv_buf[tuple(slc)]
+
+
+class MacroConnectionBuffer(object):
+    """Buffers for the exchange of nonlocally accessed macroscopic fields
+    between two blocks.
+
+    Values of the fields in the real nodes next to the face are collected
+    and sent to the neighboring block, where they are written into the
+    ghost nodes."""
+    def __init__(self, face, cpair, coll_idx, dist_idx):
+        self.face = face
+        self.cpair = cpair
+        self.coll_idx = coll_idx
+        self.dist_idx = dist_idx
+        # One buffer per nonlocal field.
+        self.coll_bufs = []
+        self.recv_bufs = []
 
 
 class GPUBuffer(object):
@@ -54,11 +115,30 @@ class GPUBuffer(object):
             self.gpu = None
 
 
+class GPUBufferView(object):
+    """Part of a GPUBuffer shared by multiple connections.
+
+    The host buffer is a view of a part of the host buffer of the parent,
+    and kernels access the GPU buffer of the parent at 'offset' (in
+    elements)."""
+    def __init__(self, parent, offset, shape):
+        size = reduce(operator.mul, shape, 1)
+        self.host = parent.host[offset:offset + size].reshape(shape)
+        self.gpu = parent.gpu
+        self.offset = offset
+
+
 class BlockRunner(object):
     """Runs the simulation for a single SubdomainSpec.
     """
     def __init__(self, simulation, block, output, backend, quit_event,
-            summary_addr=None):
+            summary_addr=None, balance_conn=None, state=None):
+        """
+        :param balance_conn: connection through which load reports are sent
+            to the machine master, or None if load balancing is disabled
+        :param state: BlockState from which the simulation is to be continued,
+            or None to start the simulation from the initial conditions
+        """
         # Create a 2-way connection between the SubdomainSpec and this BlockRunner
         self._ctx = zmq.Context()
         if summary_addr is not None:
@@ -81,6 +161,11 @@ class BlockRunner(object):
         else:
             self.float = np.float32
 
+        # Type in which the distributions are stored in the device memory.
+        self.dist_float = {'half': np.float16, 'single': np.float32,
+                'double': np.float64}[self._bcg.storage_precision()]
+        self._dist_deviation = getattr(self.config, 'storage_deviation', False)
+
         self._scalar_fields = []
         self._vector_fields = []
         self._gpu_field_map = {}
@@ -88,6 +173,10 @@ class BlockRunner(object):
         self._gpu_grids_secondary = []
         self._vis_map_cache = None
         self._quit_event = quit_event
+        self._timeline = None
+        self._metrics = None
+        self._balance_conn = balance_conn
+        self._state = state
 
         for b_id, connector in self._block._connectors.iteritems():
             connector.init_runner(self._ctx)
@@ -141,9 +230,10 @@ class BlockRunner(object):
         ctx['dist_size'] = self._get_nodes()
         ctx['sim'] = self._sim
         ctx['block'] = self._block
+        ctx['force_block_size'] = FORCE_BLOCK_SIZE
 
         # FIXME Additional constants.
-        ctx['constants'] = []
+        ctx.setdefault('constants', [])
 
         arr_nx = self._physical_size[-1]
         arr_ny = self._physical_size[-2]
@@ -345,10 +435,32 @@ class BlockRunner(object):
     def _get_dist_bytes(self, grid):
         """Returns the number of bytes required to store a single set of
            distributions for the whole simulation domain."""
-        return self._get_nodes() * grid.Q * self.float().nbytes
+        return self._get_nodes() * grid.Q * self.dist_float().nbytes
+
+    def _dist_weights(self, ndim, axis):
+        """Returns the lattice weights shaped for broadcasting along `axis`
+        of an `ndim`-dimensional array of distributions."""
+        shape = [1] * ndim
+        shape[axis] = -1
+        return np.array([float(w) for w in self._sim.grids[0].weights],
+                dtype=self.float).reshape(shape)
 
-    def _get_compute_code(self):
-        return self._bcg.get_code(self)
+    def _decode_dists(self, dists, axis):
+        """Converts distributions as stored in the device memory to an array
+        of the compute precision.
+
+        :param axis: axis of `dists` along which the distribution index varies
+        """
+        dists = dists.astype(self.float)
+        if self._dist_deviation:
+            dists += self._dist_weights(dists.ndim, axis)
+        return dists
+
+    def _encode_dists(self, dists, axis):
+        """Inverse of _decode_dists."""
+        if self._dist_deviation:
+            dists = dists - self._dist_weights(dists.ndim, axis)
+        return np.asarray(dists, dtype=self.dist_float)
 
     def _get_global_idx(self, location, dist_num):
         if self.dim == 2:
@@ -394,90 +506,236 @@ class BlockRunner(object):
         return self._idx_helper(gx, dst_slice, cpair.dst.dists)
 
     def _dst_face_loc_to_full_loc(self, face, face_loc):
+        """Inserts the coordinate of the real node layer next to `face`
+        into in-face coordinates.  Works for scalars and arrays."""
         axis = self._block.face_to_axis(face)
         missing_loc = self.lat_linear_dist[self._block.opposite_face(face)]
-        if axis == 0:
-            return [missing_loc] + face_loc
-        elif axis == 1:
-            if self.dim == 2:
-                return (face_loc[0], missing_loc)
-            else:
-                return (face_loc[0], missing_loc, face_loc[1])
-        elif axis == 2:
-            return face_loc + [missing_loc]
+        full_loc = list(face_loc)
+        full_loc.insert(axis, missing_loc)
+        return full_loc
 
     def _get_partial_dst_indices(self, face, cpair):
         if cpair.dst.partial_nodes == 0:
-            return None, None, None
-        buf = self.backend.alloc_async_host_buf(cpair.dst.partial_nodes,
-                dtype=self.float)
-        idx = np.zeros(cpair.dst.partial_nodes, dtype=np.uint32)
-        dst_low = [x + self._block.envelope_size for x in cpair.dst.dst_low]
-        sel = []
-        i = 0
-        for dist_num, locations in sorted(cpair.dst.dst_partial_map.items()):
-            for loc in locations:
-                dst_loc = [x + y for x, y in zip(dst_low, loc)]
-                dst_loc = self._dst_face_loc_to_full_loc(face, dst_loc)
-
-                # Reverse 'loc' here to go from natural order (x, y, z) to the
-                # in-face buffer order z, y, x
-                sel.append([cpair.dst.dists.index(dist_num)] + list(reversed(loc)))
-                idx[i] = self._get_global_idx(dst_loc, dist_num)
-                i += 1
-        sel2 = []
-        for i in range(0, len(sel[0])):
-            sel2.append([])
-
-        for loc in sel:
-            for i, coord in enumerate(loc):
-                sel2[i].append(coord)
-
-        return buf, idx, sel2
+            return None, None
+        dst_low = np.array(cpair.dst.dst_low) + self._block.envelope_size
+        items = sorted(cpair.dst.dst_partial_map.items())
+
+        # [partial nodes, dim - 1] array of in-face buffer locations, in
+        # natural order (x, y, z).
+        locations = np.vstack([locs for dist_num, locs in items])
+        dist_nums = np.hstack([[dist_num] * len(locs) for dist_num, locs in
+            items])
+        buf_dists = np.hstack([[cpair.dst.dists.index(dist_num)] * len(locs)
+            for dist_num, locs in items])
+
+        dst_loc = self._dst_face_loc_to_full_loc(face,
+                list((locations + dst_low).T))
+        idx = self._get_global_idx(dst_loc, dist_nums).astype(np.uint32)
+
+        # Reverse the locations here to go from natural order (x, y, z) to
+        # the in-face buffer order z, y, x.
+        sel = tuple([buf_dists] + list(locations.T[::-1]))
+        return idx, sel
+
+    def _get_probe_indices(self, locations, grid):
+        """Returns a [nodes * Q] array of global indices of all distributions
+        at the probe nodes, in the [node][dist] order.
+
+        :param locations: [nodes, dim] array of block-local node coordinates
+        """
+        loc = np.asarray(locations) + self._block.envelope_size
+        coords = [loc[:, i][:, np.newaxis] for i in range(self.dim)]
+        dists = np.arange(grid.Q)[np.newaxis, :]
+        return np.ravel(self._get_global_idx(coords, dists)).astype(np.uint32)
+
+    def _get_force_links(self, locations, types, grid):
+        """Returns a [links] array of global indices of the distributions at
+        the wall nodes 'locations' which were streamed from non-wall nodes,
+        i.e. of all links between an obstacle and the fluid.
+
+        :param locations: [nodes, dim] array of block-local coordinates of
+            the wall nodes
+        :param types: map of node types including a margin of 1 node around
+            the block, see Subdomain.node_types()
+        """
+        idx = []
+        for i, vec in enumerate(grid.basis):
+            vec = np.array([int(x) for x in vec])
+            if not vec.any():
+                continue
+            # The distribution i at a wall node was streamed from the node
+            # at -vec.  The type map is in the [z,] y, x order.
+            src = locations - vec + 1
+            links = locations[types[tuple(src.T[::-1])] !=
+                    geo_block.Subdomain.NODE_WALL]
+            coords = [links[:, j] + self._block.envelope_size for j in
+                    range(self.dim)]
+            idx.append(self._get_global_idx(coords, i))
+        return np.hstack(idx).astype(np.uint32)
+
+    def _get_field_layer_indices(self, face, layer, span):
+        """Returns global indices of the nodes in the plane `layer` along
+        the axis of `face`, spanning `span` along the remaining axes.
+
+        :param span: list of slices in the natural order (x, y, z), in the
+            coordinate system including the ghost nodes
+        """
+        coords = list(np.mgrid[span])
+        coords.insert(self._block.face_to_axis(face), layer)
+        return np.ravel(self._get_global_idx(coords, 0)).astype(np.uint32)
+
+    def _get_macro_indices(self, face, cpair):
+        """Returns global indices of the nodes from which the fields are
+        sent to the neighbor and indices of the ghost nodes into which
+        the fields received from the neighbor are written."""
+        es = self._block.envelope_size
+        # The neighbor needs data spanning its own transfer slice, which
+        # is translated here to the coordinate system of this block.
+        send_span = [slice(low + es, low + es + (x.stop - x.start)) for
+                low, x in zip(cpair.dst.dst_low, cpair.dst.src_slice)]
+        send_idx = self._get_field_layer_indices(face,
+                self.lat_linear_dist[self._block.opposite_face(face)],
+                send_span)
+        recv_idx = self._get_field_layer_indices(face, self.lat_linear[face],
+                cpair.src.src_slice)
+        return send_idx, recv_idx
 
     def _init_buffers(self):
-        # TODO(michalj): Fix this for multi-grid models.
-        grid = util.get_grid_from_config(self.config)
         alloc = self.backend.alloc_async_host_buf
-
-        # Maps block ID to a list of 1 or 2 ConnectionBuffer
-        # objects.  The list will contain 2 elements  only when
-        # global periodic boundary conditions are enabled).
+        num_grids = len(self._sim.grids)
+        size = lambda shape: reduce(operator.mul, shape, 1)
+
+        # Maps block ID to a list of ConnectionBuffer objects, ordered by
+        # grid and then by face.  There is more than 1 face per grid only
+        # when global periodic boundary conditions are enabled.  All grids
+        # are assumed to have the same connectivity as the one used to create
+        # the connections, so that the indices can be shared between them.
         self._block_to_connbuf = defaultdict(list)
-        for face, block_id in self._block.connecting_blocks():
+        # Maps block ID to a list of MacroConnectionBuffer objects (one
+        # per face), used by models with nonlocal interactions.
+        self._block_to_macrobuf = defaultdict(list)
+        # Maps block ID to a list of (grid ID, face, connection data) tuples.
+        conns = defaultdict(list)
+        for face, block_id in sorted(self._block.connecting_blocks()):
             cpair = self._block.get_connection(face, block_id)
-
-            # Buffers for collecting and sending information.
-            # TODO(michalj): Optimize this by providing proper padding.
-            coll_buf = alloc(cpair.src.transfer_shape, dtype=self.float)
-            coll_idx = self._get_src_slice_indices(face, cpair)
-
-            # Buffers for receiving and distributing information.
-            recv_buf = alloc(cpair.dst.transfer_shape, dtype=self.float)
+            coll_idx = GPUBuffer(self._get_src_slice_indices(face, cpair),
+                    self.backend)
             # Any partial dists are serialized into a single continuous buffer.
-            dist_partial_buf, dist_partial_idx, dist_partial_sel = \
+            dist_partial_idx, dist_partial_sel = \
                     self._get_partial_dst_indices(face, cpair)
-            dist_full_buf = alloc(cpair.dst.full_shape, dtype=self.float)
-            dist_full_idx = self._get_dst_slice_indices(face, cpair)
-
-            cbuf = ConnectionBuffer(face, cpair,
-                    GPUBuffer(coll_buf, self.backend),
-                    GPUBuffer(coll_idx, self.backend),
-                    recv_buf,
-                    GPUBuffer(dist_partial_buf, self.backend),
-                    GPUBuffer(dist_partial_idx, self.backend),
-                    dist_partial_sel,
-                    GPUBuffer(dist_full_buf, self.backend),
-                    GPUBuffer(dist_full_idx, self.backend))
-
-            self.config.logger.debug('adding buffer for conn: {0} -> {1} '
-                    '(face {2})'.format(self._block.id, block_id, face))
-            self._block_to_connbuf[block_id].append(cbuf)
+            dist_partial_idx = GPUBuffer(dist_partial_idx, self.backend)
+            dist_full_idx = GPUBuffer(self._get_dst_slice_indices(face, cpair),
+                    self.backend)
+            for grid_id in range(0, num_grids):
+                conns[block_id].append((grid_id, face, (cpair, coll_idx,
+                    dist_partial_idx, dist_partial_sel, dist_full_idx)))
+
+            if self._sim.nonlocality > 0:
+                send_idx, recv_idx = self._get_macro_indices(face, cpair)
+                self._block_to_macrobuf[block_id].append(
+                        MacroConnectionBuffer(face, cpair,
+                            GPUBuffer(send_idx, self.backend),
+                            GPUBuffer(recv_idx, self.backend)))
+
+        # The data for all connections is collected into a single buffer,
+        # so that it can be copied from the GPU in a single transfer.  The
+        # data sent to every remote block forms a continuous segment of
+        # this buffer.  Similarly, the data received from all remote blocks
+        # is placed in a single buffer and uploaded to the GPU in a single
+        # transfer.
+        coll_size = 0
+        recv_size = 0
+        dist_size = 0
+        for block_id, block_conns in conns.iteritems():
+            for grid_id, face, (cpair, _, _, _, _) in block_conns:
+                coll_size += size(cpair.src.transfer_shape)
+                recv_size += size(cpair.dst.transfer_shape)
+                dist_size += cpair.dst.partial_nodes
+                if cpair.dst.dst_slice:
+                    dist_size += size(cpair.dst.full_shape)
+
+        if coll_size > 0:
+            self._coll_buf = GPUBuffer(alloc(coll_size, dtype=self.dist_float),
+                    self.backend)
+            self._dist_buf = GPUBuffer(alloc(dist_size, dtype=self.dist_float),
+                    self.backend)
+        else:
+            self._coll_buf = GPUBuffer(None, self.backend)
+            self._dist_buf = GPUBuffer(None, self.backend)
+        recv_buf = np.zeros(recv_size, dtype=self.dist_float)
+
+        # Order in which the data from the remote block is received.  The
+        # remote block sends data for its faces in ascending order, and
+        # every one of these faces is connected to the opposite face of
+        # this block.
+        opp_face = lambda conn: (conn[0], self._block.opposite_face(conn[1]))
+
+        # Maps block ID to a part of the collection/receive buffer with the
+        # data exchanged with that block.
+        self._block_to_sendbuf = {}
+        self._block_to_recvdest = {}
+        recv_views = {}
+        coll_offset = 0
+        recv_offset = 0
+        dist_offset = 0
+        for block_id in sorted(conns.keys()):
+            start = recv_offset
+            for grid_id, face, (cpair, _, _, _, _) in sorted(conns[block_id],
+                    key=opp_face):
+                shape = cpair.dst.transfer_shape
+                recv_views[(block_id, grid_id, face)] = \
+                        recv_buf[recv_offset:recv_offset + size(shape)].reshape(shape)
+                recv_offset += size(shape)
+            self._block_to_recvdest[block_id] = recv_buf[start:recv_offset]
+
+            start = coll_offset
+            for grid_id, face, (cpair, coll_idx, dist_partial_idx,
+                    dist_partial_sel, dist_full_idx) in sorted(conns[block_id],
+                            key=lambda conn: conn[0:2]):
+                coll_buf = GPUBufferView(self._coll_buf, coll_offset,
+                        cpair.src.transfer_shape)
+                coll_offset += coll_buf.host.size
+
+                if dist_partial_sel is not None:
+                    dist_partial_buf = GPUBufferView(self._dist_buf,
+                            dist_offset, (cpair.dst.partial_nodes,))
+                    dist_offset += dist_partial_buf.host.size
+                else:
+                    dist_partial_buf = GPUBuffer(None, self.backend)
+
+                if cpair.dst.dst_slice:
+                    dist_full_buf = GPUBufferView(self._dist_buf, dist_offset,
+                            cpair.dst.full_shape)
+                    dist_offset += dist_full_buf.host.size
+                else:
+                    dist_full_buf = GPUBuffer(None, self.backend)
+
+                cbuf = ConnectionBuffer(face, cpair,
+                        coll_buf,
+                        coll_idx,
+                        recv_views[(block_id, grid_id, face)],
+                        dist_partial_buf,
+                        dist_partial_idx,
+                        dist_partial_sel,
+                        dist_full_buf,
+                        dist_full_idx, grid_id)
+
+                self.config.logger.debug('adding buffer for conn: {0} -> {1} '
+                        '(face {2}, grid {3})'.format(self._block.id, block_id,
+                            face, grid_id))
+                self._block_to_connbuf[block_id].append(cbuf)
+            self._block_to_sendbuf[block_id] = \
+                    self._coll_buf.host[start:coll_offset]
+
+        self._block_to_recvbuf = {}
+        for block_id, conn_bufs in self._block_to_connbuf.iteritems():
+            self._block_to_recvbuf[block_id] = sorted(conn_bufs,
+                    key=lambda cbuf: (cbuf.grid_id,
+                        self._block.opposite_face(cbuf.face)))
 
     def _init_compute(self):
         self.config.logger.debug("Initializing compute unit.")
-        code = self._get_compute_code()
-        self.module = self.backend.build(code)
+        self.module = self._bcg.build(self)
 
         # Streams
         self._boundary_stream = self.backend.make_stream()
@@ -529,7 +787,26 @@ class BlockRunner(object):
         kernel = self.get_kernel(name, args, args_format)
         self.backend.run_kernel(kernel, self._kernel_grid_full)
 
-    def step(self, output_req):
+    def step(self, output_req, exchange=True):
+        """Runs a single simulation step.
+
+        :param exchange: if False, the nonlocally accessed macroscopic fields
+            are not exchanged with the neighboring blocks
+        """
+        # Models with nonlocal interactions need the macroscopic fields in
+        # all nodes, including the ghost ones, before the step is started.
+        if self._prepare_kernels is not None:
+            self.backend.run_kernel(
+                    self._prepare_kernels[self._sim.iteration & 1],
+                    self._kernel_grid_full, self._bulk_stream)
+            self._update_ghost_fields(exchange)
+
+        # The macroscopic fields are computed from the distributions before
+        # they are overwritten by the current step.
+        if output_req and self._macro_kernels is not None:
+            self.backend.run_kernel(
+                    self._macro_kernels[self._sim.iteration & 1],
+                    self._kernel_grid_full, self._bulk_stream)
         self._step_boundary(output_req)
         self._step_bulk(output_req)
         self._sim.iteration += 1
@@ -557,11 +834,17 @@ class BlockRunner(object):
             kernel, grid = self._get_bulk_kernel(output_req)
             self.backend.run_kernel(kernel, grid, self._bulk_stream)
 
-        if self._sim.iteration & 1:
-            base = 0
-        else:
-            base = 3
+        # PBC kernels are grouped by grid, with 3 kernels (one per axis) for
+        # each of the 2 distribution buffers.
+        for grid_base in range(0, len(self._pbc_kernels), 6):
+            if self._sim.iteration & 1:
+                self._apply_pbc(grid_base)
+            else:
+                self._apply_pbc(grid_base + 3)
+
+        self._timing_calc_end = self.backend.make_event(self._bulk_stream, timing=True)
 
+    def _apply_pbc(self, base):
         if self._block.periodic_x:
             kernel = self._pbc_kernels[base]
             if self._block.dim == 2:
@@ -597,8 +880,6 @@ class BlockRunner(object):
                     self._lat_size[1])
             self.backend.run_kernel(kernel, grid_size, self._bulk_stream)
 
-        self._timing_calc_end = self.backend.make_event(self._bulk_stream, timing=True)
-
     def _step_boundary(self, output_req):
         """Runs one simulation step for the boundary blocks.
 
@@ -634,52 +915,68 @@ class BlockRunner(object):
         self._timing_coll_done = self.backend.make_event(self._boundary_stream, timing=True)
 
     def send_data(self):
-        for b_id, connector in self._block._connectors.iteritems():
-            conn_bufs = self._block_to_connbuf[b_id]
-            for x in conn_bufs:
-                self.backend.from_buf_async(x.coll_buf.gpu, self._boundary_stream)
+        if not self._block._connectors:
+            return
 
+        self.backend.from_buf_async(self._coll_buf.gpu, self._boundary_stream)
         self._boundary_stream.synchronize()
         for b_id, connector in self._block._connectors.iteritems():
-            conn_bufs = self._block_to_connbuf[b_id]
-            if len(conn_bufs) > 1:
-                connector.send(np.hstack(
-                    [np.ravel(x.coll_buf.host) for x in conn_bufs]))
-            else:
-                # TODO(michalj): Use non-blocking sends here?
-                connector.send(np.ravel(conn_bufs[0].coll_buf.host))
+            # TODO(michalj): Use non-blocking sends here?
+            connector.send(self._block_to_sendbuf[b_id])
 
     def recv_data(self):
+        if not self._block._connectors:
+            return
+
         for b_id, connector in self._block._connectors.iteritems():
-            conn_bufs = self._block_to_connbuf[b_id]
-            if len(conn_bufs) > 1:
-                dest = np.hstack([np.ravel(x.recv_buf) for x in conn_bufs])
-                # Returns false only if quit event is active.
-                if not connector.recv(dest, self._quit_event):
-                    return
-                i = 0
-                # In case there are 2 connections between the blocks, reverse the
-                # order of subbuffers in the recv buffer.  Note that this implicitly
-                # assumes the order of conn_bufs is the same for both blocks.
-                # TODO(michalj): Consider explicitly sorting conn_bufs.
-                for cbuf in reversed(conn_bufs):
-                    l = cbuf.recv_buf.size
-                    cbuf.recv_buf[:] = dest[i:i+l].reshape(cbuf.recv_buf.shape)
+            # Returns false only if quit event is active.
+            if not connector.recv(self._block_to_recvdest[b_id],
+                    self._quit_event):
+                return
+            for cbuf in self._block_to_recvbuf[b_id]:
+                cbuf.distribute()
+
+        self.backend.to_buf_async(self._dist_buf.gpu, self._boundary_stream)
+
+    def _update_ghost_fields(self, exchange):
+        """Updates the nonlocally accessed macroscopic fields in the ghost
+        nodes, using the values from the real nodes of this block (for local
+        periodic boundary conditions) and of the neighboring blocks."""
+        stream = self._bulk_stream
+        for kernel, grid in self._field_pbc_kernels:
+            self.backend.run_kernel(kernel, grid, stream)
+
+        if not exchange or not self._block_to_macrobuf:
+            return
+
+        for kernel, grid in self._field_collect_kernels:
+            self.backend.run_kernel(kernel, grid, stream)
+        for mbufs in self._block_to_macrobuf.itervalues():
+            for mbuf in mbufs:
+                for buf in mbuf.coll_bufs:
+                    self.backend.from_buf_async(buf.gpu, stream)
+        stream.synchronize()
+
+        for b_id, connector in self._block._connectors.iteritems():
+            connector.send(np.hstack([buf.host for mbuf in
+                self._block_to_macrobuf[b_id] for buf in mbuf.coll_bufs]))
+
+        for b_id, connector in self._block._connectors.iteritems():
+            dest = self._field_recv_dest[b_id]
+            # Returns false only if quit event is active.
+            if not connector.recv(dest, self._quit_event):
+                return
+            # See _init_buffers() for the order of faces.
+            i = 0
+            for mbuf in self._block_to_macrorecv[b_id]:
+                for buf in mbuf.recv_bufs:
+                    l = buf.host.size
+                    buf.host[:] = dest[i:i+l]
                     i += l
-                    cbuf.distribute(self.backend, self._boundary_stream)
-            else:
-                cbuf = conn_bufs[0]
-                dest = np.ravel(cbuf.recv_buf)
-                # Returns false only if quit event is active.
-                if not connector.recv(dest, self._quit_event):
-                    return
-                # If ravel returned a copy, we need to write the data
-                # back to the proper buffer.
-                # TODO(michalj): Check if there is any way of avoiding this
-                # copy.
-                if dest.flags.owndata:
-                    cbuf.recv_buf[:] = dest.reshape(cbuf.recv_buf.shape)
-                cbuf.distribute(self.backend, self._boundary_stream)
+                    self.backend.to_buf_async(buf.gpu, stream)
+
+        for kernel, grid in self._field_distrib_kernels:
+            self.backend.run_kernel(kernel, grid, stream)
 
     def _fields_to_host(self):
         """Copies data for all fields from the GPU to the host."""
@@ -691,8 +988,6 @@ class BlockRunner(object):
                 self.backend.from_buf_async(component, self._bulk_stream)
 
     def _init_interblock_kernels(self):
-        # TODO(michalj): Extend this for multi-grid models.
-
         collect_primary = []
         collect_secondary = []
 
@@ -713,9 +1008,10 @@ class BlockRunner(object):
                     def _get_sparse_coll_kernel(i):
                         return KernelGrid(
                             self.get_kernel('CollectSparseData',
-                            [cbuf.coll_idx.gpu, self.gpu_dist(0, i),
-                             cbuf.coll_buf.gpu, cbuf.coll_buf.host.size],
-                            'PPPi', (collect_block,)),
+                            [cbuf.coll_idx.gpu, self.gpu_dist(cbuf.grid_id, i),
+                             cbuf.coll_buf.gpu, cbuf.coll_buf.offset,
+                             cbuf.coll_buf.host.size],
+                            'PPPii', (collect_block,)),
                             grid_size)
 
                     collect_primary.append(_get_sparse_coll_kernel(1))
@@ -726,18 +1022,19 @@ class BlockRunner(object):
                             list(reversed(cbuf.coll_buf.host.shape[1:])))
                     min_max[-1] = min_max[-1] * len(cbuf.cpair.src.dists)
                     if self.dim == 2:
-                        signature = 'PiiiP'
+                        signature = 'PiiiPi'
                         grid_size = (_grid_dim1(cbuf.coll_buf.host.size),)
                     else:
-                        signature = 'PiiiiiP'
+                        signature = 'PiiiiiPi'
                         grid_size = (_grid_dim1(cbuf.coll_buf.host.shape[-1]),
                             cbuf.coll_buf.host.shape[-2] * len(cbuf.cpair.src.dists))
 
                     def _get_cont_coll_kernel(i):
                         return KernelGrid(
                             self.get_kernel('CollectContinuousData',
-                            [self.gpu_dist(0, i),
-                             cbuf.face] + min_max + [cbuf.coll_buf.gpu],
+                            [self.gpu_dist(cbuf.grid_id, i),
+                             cbuf.face] + min_max + [cbuf.coll_buf.gpu,
+                             cbuf.coll_buf.offset],
                              signature, (collect_block,)),
                              grid_size)
 
@@ -753,10 +1050,11 @@ class BlockRunner(object):
                         return KernelGrid(
                                 self.get_kernel('DistributeSparseData',
                                     [cbuf.dist_partial_idx.gpu,
-                                     self.gpu_dist(0, i),
+                                     self.gpu_dist(cbuf.grid_id, i),
                                      cbuf.dist_partial_buf.gpu,
+                                     cbuf.dist_partial_buf.offset,
                                      cbuf.dist_partial_buf.host.size],
-                                    'PPPi', (collect_block,)),
+                                    'PPPii', (collect_block,)),
                                 grid_size)
 
                     distrib_primary.append(_get_sparse_dist_kernel(0))
@@ -772,10 +1070,11 @@ class BlockRunner(object):
                             return KernelGrid(
                                     self.get_kernel('DistributeSparseData',
                                         [cbuf.dist_full_idx.gpu,
-                                         self.gpu_dist(0, i),
+                                         self.gpu_dist(cbuf.grid_id, i),
                                          cbuf.dist_full_buf.gpu,
+                                         cbuf.dist_full_buf.offset,
                                          cbuf.dist_full_buf.host.size],
-                                    'PPPi', (collect_block,)),
+                                    'PPPii', (collect_block,)),
                                     grid_size)
 
                         distrib_primary.append(_get_sparse_fdist_kernel(0))
@@ -789,19 +1088,20 @@ class BlockRunner(object):
                         min_max[-1] = min_max[-1] * len(cbuf.cpair.dst.dists)
 
                         if self.dim == 2:
-                            signature = 'PiiiP'
+                            signature = 'PiiiPi'
                             grid_size = (_grid_dim1(cbuf.dist_full_buf.host.size),)
                         else:
-                            signature = 'PiiiiiP'
+                            signature = 'PiiiiiPi'
                             grid_size = (_grid_dim1(cbuf.dist_full_buf.host.shape[-1]),
                                 cbuf.dist_full_buf.host.shape[-2] * len(cbuf.cpair.dst.dists))
 
                         def _get_cont_dist_kernel(i):
                             return KernelGrid(
                                     self.get_kernel('DistributeContinuousData',
-                                    [self.gpu_dist(0, i),
+                                    [self.gpu_dist(cbuf.grid_id, i),
                                      self._block.opposite_face(cbuf.face)] +
-                                    min_max + [cbuf.dist_full_buf.gpu],
+                                    min_max + [cbuf.dist_full_buf.gpu,
+                                               cbuf.dist_full_buf.offset],
                                     signature, (collect_block,)),
                                     grid_size)
 
@@ -811,6 +1111,373 @@ class BlockRunner(object):
         self._collect_kernels = (collect_primary, collect_secondary)
         self._distrib_kernels = (distrib_primary, distrib_secondary)
 
+    def _init_field_exchange(self):
+        """Prepares the buffers and kernels used to update the nonlocally
+        accessed macroscopic fields in the ghost nodes."""
+        self._field_pbc_kernels = []
+        self._field_collect_kernels = []
+        self._field_distrib_kernels = []
+        self._field_recv_dest = {}
+        self._block_to_macrorecv = {}
+
+        fields = self._sim.nonlocal_fields()
+        if not fields:
+            return
+
+        collect_block = 32
+        def _grid_dim1(x):
+            return (int(math.ceil(x / float(collect_block))),)
+
+        def _field_kernel(name, idx, field, buf):
+            return KernelGrid(self.get_kernel(name,
+                [idx.gpu, self.gpu_field(field), buf.gpu, idx.host.size],
+                'PPPi', (collect_block,)), _grid_dim1(idx.host.size))
+
+        # Local periodic boundary conditions: ghost nodes are filled with
+        # values from the real nodes on the opposite side of the block.
+        periodic = [self._block.periodic_x, self._block.periodic_y]
+        if self.dim == 3:
+            periodic.append(self._block.periodic_z)
+        for axis, is_periodic in enumerate(periodic):
+            if not is_periodic:
+                continue
+            span = [slice(0, x) for i, x in
+                    enumerate(reversed(self._lat_size)) if i != axis]
+            for face in (2 * axis, 2 * axis + 1):
+                src_idx = GPUBuffer(self._get_field_layer_indices(face,
+                    self.lat_linear_dist[face], span), self.backend)
+                dst_idx = GPUBuffer(self._get_field_layer_indices(face,
+                    self.lat_linear[face], span), self.backend)
+                for field in fields:
+                    buf = GPUBuffer(np.zeros(src_idx.host.size,
+                        dtype=self.float), self.backend)
+                    self._field_pbc_kernels.append(_field_kernel(
+                        'CollectSparseField', src_idx, field, buf))
+                    self._field_pbc_kernels.append(_field_kernel(
+                        'DistributeSparseField', dst_idx, field, buf))
+
+        alloc = self.backend.alloc_async_host_buf
+        for b_id, mbufs in self._block_to_macrobuf.iteritems():
+            size = 0
+            for mbuf in mbufs:
+                for field in fields:
+                    coll_buf = GPUBuffer(alloc(mbuf.coll_idx.host.size,
+                        dtype=self.float), self.backend)
+                    recv_buf = GPUBuffer(alloc(mbuf.dist_idx.host.size,
+                        dtype=self.float), self.backend)
+                    mbuf.coll_bufs.append(coll_buf)
+                    mbuf.recv_bufs.append(recv_buf)
+                    size += recv_buf.host.size
+                    self._field_collect_kernels.append(_field_kernel(
+                        'CollectSparseField', mbuf.coll_idx, field, coll_buf))
+                    self._field_distrib_kernels.append(_field_kernel(
+                        'DistributeSparseField', mbuf.dist_idx, field, recv_buf))
+            self._field_recv_dest[b_id] = np.zeros(size, dtype=self.float)
+            self._block_to_macrorecv[b_id] = sorted(mbufs,
+                    key=lambda mbuf: self._block.opposite_face(mbuf.face))
+
+    def _init_probes(self):
+        self._probe_kernels = None
+        probes = self._subdomain.probes()
+        if (not probes or not self.config.probe_every or
+                self.config.mode == 'benchmark'):
+            return
+
+        if not self.config.output:
+            self.config.logger.warning('Probes are defined, but no output '
+                    'file is specified.  Probe data will not be saved.')
+            return
+
+        # Only the first grid is sampled.
+        grid = self._sim.grids[0]
+        locations = np.vstack([locs for name, locs in probes])
+        idx = self._get_probe_indices(locations, grid)
+        self._probe_idx = GPUBuffer(idx, self.backend)
+        self._probe_buf = GPUBuffer(self.backend.alloc_async_host_buf(
+            idx.size, dtype=self.dist_float), self.backend)
+        self._probe_basis = np.array([[float(x) for x in vec] for vec in
+            grid.basis], dtype=self.float)
+
+        collect_block = 32
+        grid_size = (int(math.ceil(idx.size / float(collect_block))),)
+        self._probe_kernels = [
+                KernelGrid(self.get_kernel('CollectSparseData',
+                    [self._probe_idx.gpu, self.gpu_dist(0, i),
+                     self._probe_buf.gpu, 0, idx.size],
+                    'PPPii', (collect_block,)), grid_size)
+                for i in (0, 1)]
+
+        # A restored block continues the time series saved before it was
+        # migrated.
+        offset = np.array(self._block.location)
+        self._output.init_probes([(name, locs + offset) for name, locs in
+            probes], self.dim, append=self._state is not None)
+        self.config.logger.debug('Sampling {0} probe nodes every {1} '
+                'iterations.'.format(len(locations), self.config.probe_every))
+
+    def _probe_req(self):
+        return (self._probe_kernels is not None and
+                ((self._sim.iteration + 1) % self.config.probe_every) == 0)
+
+    def _final_exchange_req(self):
+        """Returns True if the data has to be exchanged with the neighboring
+        blocks after the last step, so that the final probe and force samples
+        include the distributions received from them.  Only depends on the
+        config, so that all blocks make the same decision."""
+        if (self.config.output and self.config.probe_every and
+                self._sim.iteration % self.config.probe_every == 0):
+            return True
+        # Every block has a force sender if the forces are computed.
+        return (self._force_sender is not None and
+                self._sim.iteration % self.config.force_every == 0)
+
+    def _collect_probes(self):
+        """Gathers the distributions at all probe nodes into a host buffer.
+        Has to be called after the distributions received from the
+        neighboring blocks are distributed, as probe nodes can be located
+        next to the boundaries of the block."""
+        self._boundary_stream.wait_for_event(self._timing_calc_end)
+        kernel, grid = self._probe_kernels[self._sim.iteration & 1]
+        self.backend.run_kernel(kernel, grid, self._boundary_stream)
+        self.backend.from_buf_async(self._probe_buf.gpu, self._boundary_stream)
+
+    def _save_probes(self):
+        dists = self._decode_dists(self._probe_buf.host.reshape(
+            -1, self._probe_basis.shape[0]), axis=1)
+        rho = np.sum(dists, axis=1)
+        v = np.dot(dists, self._probe_basis)
+        # Only single fluid models have an incompressible variant.
+        if not getattr(self.config, 'incompressible', False):
+            v /= rho[:, np.newaxis]
+        # Apply the same velocity correction as the compute kernels.
+        accel = self._sim.body_force_accel(rho)
+        if accel is not None and self.config.relaxation_enabled:
+            v += 0.5 * accel
+        self._output.save_probes(self._sim.iteration, rho, v)
+
+    def _init_forces(self):
+        self._force_sender = None
+        self._force_kernels = []
+        if not self.config.force_every or self.config.mode == 'benchmark':
+            return
+
+        # Every block reports at the same iterations, even if it does not
+        # contain any obstacles, so that the controller knows when the
+        # forces on all obstacles are complete.
+        self._force_sender = self._ctx.socket(zmq.REQ)
+        self._force_sender.connect(self.config.forces_addr)
+        objects = self._subdomain.force_objects()
+        self._force_names = [name for name, locs in objects]
+        self._force_groups = []
+        if not objects:
+            return
+
+        # Only the forces acting on the first grid are computed.
+        grid = self._sim.grids[0]
+        types = self._subdomain.node_types()
+        links = [self._get_force_links(locs, types, grid) for name, locs in
+                objects]
+
+        # Links of every obstacle are summed by separate work groups, so
+        # that the partial sums can be attributed to the obstacles.
+        groups = 0
+        for idx in links:
+            num = int(math.ceil(idx.size / float(FORCE_BLOCK_SIZE)))
+            self._force_groups.append(slice(groups, groups + num))
+            groups += num
+
+        self._force_buf = None
+        if not groups:
+            return
+
+        self._force_idx = GPUBuffer(np.hstack(links), self.backend)
+        self._force_buf = GPUBuffer(self.backend.alloc_async_host_buf(
+            (groups, self.dim), dtype=self.float), self.backend)
+
+        for i in (0, 1):
+            kernels = []
+            offset = 0
+            for idx, group_slice in zip(links, self._force_groups):
+                if idx.size > 0:
+                    kernels.append(KernelGrid(self.get_kernel('ComputeForce',
+                        [self._force_idx.gpu, self.gpu_dist(0, i),
+                         self._force_buf.gpu, offset, group_slice.start,
+                         idx.size], 'PPPiii', (FORCE_BLOCK_SIZE,)),
+                        (group_slice.stop - group_slice.start,)))
+                offset += idx.size
+            self._force_kernels.append(kernels)
+
+        self.config.logger.debug('Computing forces on {0} obstacles with {1} '
+                'boundary links every {2} iterations.'.format(len(links),
+                    sum(idx.size for idx in links), self.config.force_every))
+
+    def _force_req(self):
+        return (self._force_sender is not None and
+                ((self._sim.iteration + 1) % self.config.force_every) == 0)
+
+    def _compute_forces(self):
+        """Computes partial sums of the forces on all obstacles.  Has to be
+        called after the distributions received from the neighboring blocks
+        are distributed, as links can cross the boundaries of the block."""
+        if not self._force_kernels:
+            return
+        self._boundary_stream.wait_for_event(self._timing_calc_end)
+        for kernel, grid in self._force_kernels[self._sim.iteration & 1]:
+            self.backend.run_kernel(kernel, grid, self._boundary_stream)
+        self.backend.from_buf_async(self._force_buf.gpu, self._boundary_stream)
+
+    def _send_forces(self):
+        forces = {}
+        for name, group_slice in zip(self._force_names, self._force_groups):
+            if self._force_buf is None:
+                forces[name] = np.zeros(self.dim, dtype=self.float)
+            else:
+                forces[name] = np.sum(self._force_buf.host[group_slice],
+                        axis=0)
+        self._force_sender.send_pyobj(ForceSample(self._block.id,
+            self._sim.iteration, forces))
+        self._force_sender.recv_pyobj()
+
+    def _span(self, name, iteration, start, end, track=timeline.TRACK_HOST):
+        if self._timeline is not None:
+            self._timeline.record(name, iteration, start, end, track)
+
+    def _record_gpu_spans(self, iteration, t_launch):
+        """Records the GPU work of the last step in the timeline.
+
+        GPU events are only timed relative to each other, so the spans are
+        anchored at the host time at which the step was enqueued.  Has to be
+        called after both streams are synchronized.
+        """
+        if self._timeline is None:
+            return
+
+        ref = self._timing_bnd_start
+        def _gpu_span(name, start, end):
+            self._timeline.record(name, iteration,
+                    t_launch + start.time_since(ref) / 1e3,
+                    t_launch + end.time_since(ref) / 1e3, timeline.TRACK_GPU)
+
+        _gpu_span('boundary', self._timing_bnd_start, self._timing_bnd_stop)
+        _gpu_span('collect', self._timing_bnd_stop, self._timing_coll_done)
+        _gpu_span('bulk', self._timing_calc_start, self._timing_calc_end)
+
+    def _autotune_key(self):
+        """Returns a string identifying the device, the simulation and the
+        block for the purpose of caching autotuning results.  All settings
+        affecting the generated code are included."""
+        storage = self._bcg.storage_precision()
+        if self._dist_deviation:
+            storage += '_deviation'
+        variant = [name for name in ('incompressible', 'separate_output')
+                if getattr(self.config, name, False)]
+        faces = sorted(set(face for face, _ in
+            self._block.connecting_blocks()))
+        return '{0}/{1}/{2}/{3}/{4}/{5}/{6}/{7}/{8}'.format(
+                self.backend.device_name, self._sim.__class__.__name__,
+                self._sim.grid.__name__, getattr(self.config, 'model', ''),
+                '+'.join(variant), self.config.precision, storage,
+                'x'.join(str(x) for x in self._block.size),
+                ','.join(str(x) for x in faces))
+
+    def _reset_buffers(self):
+        """Drops all fields and compute device buffers."""
+        self._scalar_fields = []
+        self._vector_fields = []
+        self._gpu_field_map = {}
+        self._gpu_grids_primary = []
+        self._gpu_grids_secondary = []
+        self._vis_map_cache = None
+        # Drop the references held by the backend so that the device memory
+        # can be released.
+        self.backend.buffers.clear()
+        self.backend.arrays.clear()
+
+    def _benchmark_step(self, iters):
+        """Returns the average wall time of a single simulation step.
+        Data exchange with other blocks is not included."""
+        for i in range(min(10, iters)):
+            self.step(False, exchange=False)
+        self._bulk_stream.synchronize()
+        self._boundary_stream.synchronize()
+
+        t0 = time.time()
+        for i in xrange(iters):
+            self.step(False, exchange=False)
+        self._bulk_stream.synchronize()
+        self._boundary_stream.synchronize()
+        return (time.time() - t0) / iters
+
+    def _autotune(self):
+        """Selects block_size and bulk_boundary_split for this block.
+
+        All candidate settings are benchmarked, and the fastest one is
+        saved in a cache file, so that it is reused in subsequent runs.
+        """
+        cache_path = os.path.expanduser(self.config.autotune_cache)
+        key = self._autotune_key()
+        cache = _load_autotune_cache(cache_path)
+        if key in cache:
+            best = cache[key]
+            self.config.logger.info('Using cached autotuning result for {0}: '
+                    'block_size={1} bulk_boundary_split={2}'.format(key,
+                        best['block_size'], best['bulk_boundary_split']))
+            self.config.block_size = best['block_size']
+            self.config.bulk_boundary_split = best['bulk_boundary_split']
+            return
+
+        self.config.logger.info('Autotuning {0}.'.format(key))
+        best = None
+        tested = set()
+        for block_size in self.config.autotune_block_sizes:
+            for split in (True, False):
+                # The boundary kernels require blocks wider than the
+                # boundary size.
+                if block_size <= self._block.envelope_size + 1:
+                    continue
+                self.config.block_size = block_size
+                self.config.bulk_boundary_split = split
+                self._init_shape()
+
+                # The split can be disabled in _init_shape().  Do not test
+                # the same configuration twice.
+                split = self._boundary_blocks is not None
+                if (block_size, split) in tested:
+                    continue
+                tested.add((block_size, split))
+                self.config.bulk_boundary_split = split
+
+                # Settings not supported by the device cause build or launch
+                # failures.  Any other error is a bug and is not handled here.
+                try:
+                    self._init_simulation()
+                    t = self._benchmark_step(self.config.autotune_iters)
+                except self.backend.kernel_errors, e:
+                    self.config.logger.warning('Skipping block_size={0} '
+                            'bulk_boundary_split={1}: {2}'.format(
+                                block_size, split, e))
+                    continue
+                finally:
+                    self._sim.iteration = 0
+                    self._reset_buffers()
+
+                self.config.logger.debug('block_size={0} '
+                        'bulk_boundary_split={1}: {2:e} s/step'.format(
+                            block_size, split, t))
+                if best is None or t < best['time']:
+                    best = {'block_size': block_size,
+                            'bulk_boundary_split': split, 'time': t}
+
+        if best is None:
+            raise ValueError('Autotuning failed: no block size could be used.')
+
+        self.config.logger.info('Autotuning result for {0}: block_size={1} '
+                'bulk_boundary_split={2}'.format(key, best['block_size'],
+                    best['bulk_boundary_split']))
+        self.config.block_size = best['block_size']
+        self.config.bulk_boundary_split = best['bulk_boundary_split']
+        _save_autotune_result(cache_path, key, best)
+
     def _debug_get_dist(self, output=True):
         """Copies the distributions from the GPU to a properly structured host array.
         :param output: if True, returns the contents of the distributions set *after*
@@ -822,18 +1489,19 @@ class BlockRunner(object):
 
         self.config.logger.debug('getting dist {0} ({1})'.format(iter_idx,
             self.gpu_dist(0, iter_idx)))
-        dbuf = np.zeros(self._get_dist_bytes(self._sim.grids[0]) / self.float().nbytes,
-            dtype=self.float)
+        dbuf = np.zeros(self._get_dist_bytes(self._sim.grids[0]) /
+            self.dist_float().nbytes, dtype=self.dist_float)
         self.backend.from_buf(self.gpu_dist(0, iter_idx), dbuf)
         dbuf = dbuf.reshape([self._sim.grids[0].Q] + self._physical_size)
-        return dbuf
+        return self._decode_dists(dbuf, axis=0)
 
     def _debug_set_dist(self, dbuf, output=True):
         iter_idx = self._sim.iteration & 1
         if not output:
             iter_idx = 1 - iter_idx
 
-        self.backend.to_buf(self.gpu_dist(0, iter_idx), dbuf)
+        self.backend.to_buf(self.gpu_dist(0, iter_idx),
+                self._encode_dists(dbuf, axis=0))
 
     def _debug_global_idx_to_tuple(self, gi):
         dist_num = gi / self._get_nodes()
@@ -843,9 +1511,72 @@ class BlockRunner(object):
         gy = rest / arr_nx
         return dist_num, gy, gx
 
-    def run(self):
-        self.config.logger.info("Initializing block.")
+    def _field_buffers(self):
+        """Yields (host array, GPU buffer) pairs for all fields, in the order
+        in which the fields were created."""
+        for field in self._scalar_fields:
+            yield field.base, self._gpu_field_map[id(field)]
+        for field in self._vector_fields:
+            for component, gpu_buf in zip(field, self._gpu_field_map[id(field)]):
+                yield component.base, gpu_buf
 
+    def _unpadded(self, array):
+        """Returns a view of a lattice array without the padding along the
+        X axis."""
+        return array[..., 0:self._lat_size[-1]]
+
+    def _get_state(self):
+        """Copies the distributions and fields from the GPU to the host.
+        Has to be called after both streams are synchronized.
+
+        The padding of the arrays depends on the block size, so it is not
+        included in the returned state.
+        """
+        dists = []
+        for i, grid in enumerate(self._sim.grids):
+            size = self._get_dist_bytes(grid) / self.dist_float().nbytes
+            bufs = []
+            for copy in (0, 1):
+                dbuf = np.zeros(size, dtype=self.dist_float)
+                self.backend.from_buf(self.gpu_dist(i, copy), dbuf)
+                dbuf = dbuf.reshape([grid.Q] + self._physical_size)
+                bufs.append(self._unpadded(dbuf).copy())
+            dists.append(bufs)
+
+        fields = []
+        for host, gpu_buf in self._field_buffers():
+            self.backend.from_buf(gpu_buf, host)
+            fields.append(self._unpadded(host).copy())
+
+        return BlockState(self._sim.iteration, dists, fields, self._timeline)
+
+    def _restore_state(self, state):
+        self._sim.iteration = state.iteration
+        for i, grid in enumerate(self._sim.grids):
+            for copy, saved in enumerate(state.dists[i]):
+                dbuf = np.zeros([grid.Q] + self._physical_size,
+                        dtype=self.dist_float)
+                self._unpadded(dbuf)[:] = saved
+                self.backend.to_buf(self.gpu_dist(i, copy), dbuf)
+
+        for (host, gpu_buf), saved in zip(self._field_buffers(), state.fields):
+            self._unpadded(host)[:] = saved
+            self.backend.to_buf(gpu_buf, host)
+
+    def _report_load(self, busy, wait, iters):
+        """Sends the load statistics collected over the last 'iters'
+        iterations to the machine master, and waits for its decision.
+
+        :returns: True if the block is to be migrated to a different device
+        """
+        self._balance_conn.send(LoadReport(self._block.id, self._sim.iteration,
+            busy / iters, wait / iters))
+        while not self._balance_conn.poll(0.01):
+            if self._quit_event.is_set():
+                return False
+        return self._balance_conn.recv()
+
+    def _init_simulation(self):
         self._init_geometry()
         self._init_buffers()
         self._init_compute()
@@ -857,14 +1588,51 @@ class BlockRunner(object):
         self._sim.initial_conditions(self)
 
         self._init_interblock_kernels()
-        self._kernels_bulk_full = self._sim.get_compute_kernels(self, True, True)
+        self._init_field_exchange()
+        self._prepare_kernels = self._sim.get_prepare_kernels(self)
         self._kernels_bulk_none = self._sim.get_compute_kernels(self, False, True)
-        self._kernels_bnd_full = self._sim.get_compute_kernels(self, True, False)
         self._kernels_bnd_none = self._sim.get_compute_kernels(self, False, False)
+        self._macro_kernels = self._sim.get_macro_kernels(self)
+        # With a separate kernel for the macroscopic fields, the compute
+        # kernels never have to save them.
+        if self._macro_kernels is None:
+            self._kernels_bulk_full = self._sim.get_compute_kernels(self, True, True)
+            self._kernels_bnd_full = self._sim.get_compute_kernels(self, True, False)
+        else:
+            self._kernels_bulk_full = self._kernels_bulk_none
+            self._kernels_bnd_full = self._kernels_bnd_none
         self._pbc_kernels = self._sim.get_pbc_kernels(self)
 
-        if self.config.output:
+    def run(self):
+        self.config.logger.info("Initializing block.")
+
+        if self.config.autotune:
+            self._autotune()
+
+        self._init_simulation()
+        self._init_probes()
+        self._init_forces()
+
+        if self._state is not None:
+            self.config.logger.info("Restoring block state from iteration "
+                    "{0}.".format(self._state.iteration))
+            self._restore_state(self._state)
+            self._timeline = self._state.timeline
+        elif self.config.timeline:
+            self._timeline = timeline.Timeline(self._block.id,
+                    self.config.timeline_size)
+
+        if self.config.metrics_addr:
+            self._metrics = metrics.MetricsPublisher(self._ctx,
+                    self.config.metrics_addr, self._block.id,
+                    self._block.num_nodes)
+            self._metrics.reset(self._sim.iteration)
+
+        # The output for the iteration at which a block is restored has
+        # already been saved before the block was migrated.
+        if self.config.output and self._state is None:
             self._output.save(self._sim.iteration)
+        self._state = None
 
         self.config.logger.info("Starting simulation.")
 
@@ -873,29 +1641,62 @@ class BlockRunner(object):
 
         if self.config.mode == 'benchmark':
             self.main_benchmark()
-        else:
-            self.main()
+        elif self.main():
+            self.config.logger.info("Block stopped after {0} iterations for "
+                    "migration to a different device.".format(
+                        self._sim.iteration))
+            return
 
         self.config.logger.info(
             "Simulation completed after {0} iterations.".format(
                 self._sim.iteration))
 
+        if self._timeline is not None:
+            self.config.logger.debug('Saving timeline ({0} spans).'.format(
+                len(self._timeline)))
+            self._timeline.save(self.config.timeline)
+
     def main(self):
+        """Runs the simulation.
+
+        :returns: True if the simulation was stopped so that the block can be
+            migrated to a different device
+        """
+        # Time spent on computation and waiting for data from other blocks
+        # since the last load report.
+        t_busy = 0.0
+        t_wait = 0.0
+
         while True:
             output_req = ((self._sim.iteration + 1) % self.config.every) == 0
+            probe_req = self._probe_req()
+            force_req = self._force_req()
+            it = self._sim.iteration
 
             if output_req and self.config.debug_dump_dists:
                 dbuf = self._debug_get_dist(self)
                 self._output.dump_dists(dbuf, self._sim.iteration)
 
+            t1 = time.time()
             self.step(output_req)
-            self.send_data()
+            t2 = time.time()
+            # Data sent in the last iteration is only received if it is
+            # needed for the final samples.  Otherwise, it would never be
+            # received, and sending it could block once the neighbors have
+            # finished.
+            last = (self.config.max_iters > 0 and
+                    self._sim.iteration >= self.config.max_iters)
+            exchange = not last or self._final_exchange_req()
+            if exchange:
+                self.send_data()
 
             if output_req and self.config.output_required:
                 self._fields_to_host()
+            t3 = time.time()
+            self._span('step', it, t1, t2)
+            self._span('send', it, t2, t3)
 
-            if (self.config.max_iters > 0 and self._sim.iteration >=
-                    self.config.max_iters):
+            if not exchange:
                 break
 
             if self._quit_event.is_set():
@@ -905,19 +1706,66 @@ class BlockRunner(object):
             self.recv_data()
             if self._quit_event.is_set():
                 self.config.logger.info("Simulation termination requested.")
+            t4 = time.time()
 
             for kernel, grid in self._distrib_kernels[self._sim.iteration & 1]:
                 self.backend.run_kernel(kernel, grid, self._boundary_stream)
+            if probe_req:
+                self._collect_probes()
+            if force_req:
+                self._compute_forces()
+            t5 = time.time()
 
             self._boundary_stream.synchronize()
             self._bulk_stream.synchronize()
+            t6 = time.time()
+            self._span('recv', it, t3, t4)
+            self._span('distribute', it, t4, t5)
+            self._span('wait', it, t5, t6)
+            self._record_gpu_spans(it, t1)
+
             if output_req and self.config.output_required:
                 self._output.save(self._sim.iteration)
+            if probe_req:
+                self._save_probes()
+            if force_req:
+                self._send_forces()
+            t7 = time.time()
+            self._span('output', it, t6, t7)
+
+            if last:
+                # All data for the last step has already been saved.
+                output_req = force_req = False
+                break
 
+            if self._metrics is not None:
+                self._metrics.add_wait(t4 - t3)
+                self._metrics.add_output(t7 - t6)
+                if self._sim.iteration % self.config.metrics_every == 0:
+                    self._metrics.publish(self._sim.iteration)
+
+            if self._balance_conn is not None:
+                t_busy += (t6 - t1) - (t4 - t3)
+                t_wait += t4 - t3
+                if self._sim.iteration % self.config.rebalance_every == 0:
+                    if self._report_load(t_busy, t_wait,
+                            self.config.rebalance_every):
+                        if self._probe_kernels is not None:
+                            self._output.close_probes()
+                        self._balance_conn.send(self._get_state())
+                        return True
+                    t_busy = 0.0
+                    t_wait = 0.0
+
+        # The loop can be left before the data from the neighboring blocks
+        # is received, in which case the probe and force samples would be
+        # incomplete and are skipped.
         self._boundary_stream.synchronize()
         self._bulk_stream.synchronize()
         if output_req and self.config.output_required:
             self._output.save(self._sim.iteration)
+        if self._probe_kernels is not None:
+            self._output.close_probes()
 
     def main_benchmark(self):
         t_bulk = 0.0
@@ -931,6 +1779,7 @@ class BlockRunner(object):
 
         for i in xrange(self.config.max_iters):
             output_req = ((self._sim.iteration + 1) % self.config.every) == 0
+            it = self._sim.iteration
 
             t1 = time.time()
             self.step(output_req)
@@ -955,6 +1804,13 @@ class BlockRunner(object):
 
             t6 = time.time()
 
+            self._span('step', it, t1, t2)
+            self._span('send', it, t2, t3)
+            self._span('output', it, t3, t4)
+            self._span('recv', it, t4, t5)
+            self._span('wait', it, t5, t6)
+            self._record_gpu_spans(it, t1)
+
             t_bulk += self._timing_calc_end.time_since(self._timing_calc_start) / 1e3
             t_bnd  += self._timing_bnd_stop.time_since(self._timing_bnd_start) / 1e3
             t_coll += self._timing_coll_done.time_since(self._timing_bnd_stop) / 1e3
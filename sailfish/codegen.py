@@ -4,24 +4,135 @@ __author__ = 'Michal Januszewski'
 __email__ = 'sailfish-cfd@googlegroups.com'
 __license__ = 'LGPL3'
 
+import errno
+import hashlib
 import os
 import sys
+import time
+import numpy
+import sympy
 from mako.lookup import TemplateLookup
+from sailfish import sym
 
-def _convert_to_double(src):
-    """Converts all single-precision floating point literals to double
-    precision ones.
+def _fingerprint_value(value):
+    if isinstance(value, (list, tuple)):
+        return '[{0}]'.format(','.join(_fingerprint_value(x) for x in value))
+    elif isinstance(value, dict):
+        return '{{{0}}}'.format(','.join('{0}:{1}'.format(
+            _fingerprint_value(k), _fingerprint_value(v))
+            for k, v in sorted(value.iteritems())))
+    elif isinstance(value, (set, frozenset)):
+        return _fingerprint_value(sorted(value))
+    elif isinstance(value, numpy.ndarray):
+        return '{0}{1}{2}'.format(value.dtype.str, value.shape,
+                hashlib.sha1(value.tostring()).hexdigest())
+    elif isinstance(value, type):
+        return '{0}.{1}'.format(value.__module__, value.__name__)
+    elif hasattr(value, 'context_fingerprint'):
+        return value.context_fingerprint()
+    elif isinstance(value, sympy.Basic):
+        return sympy.srepr(value)
+    elif (value is None or isinstance(value, (bool, int, long, float, str,
+            unicode, numpy.generic))):
+        return repr(value)
+    else:
+        # Objects shared by all blocks, such as the simulation instance.
+        return '{0}.{1}'.format(type(value).__module__, type(value).__name__)
 
-    :param src: string containing the C code to convert
+def context_fingerprint(ctx):
+    """Returns a string identifying a code generation context.  Blocks with
+    identical fingerprints share the generated code."""
+    return hashlib.sha1(_fingerprint_value(ctx)).hexdigest()
+
+
+class SharedCode(object):
+    """Shares generated code between the block runners of a single machine.
+
+    The code is stored in a directory created by the machine master.  The
+    first block runner to claim a context fingerprint renders and builds
+    the code, and then publishes it.  Block runners with the same context
+    wait for the code instead of rendering it themselves.  Builds of the
+    published code are expected to hit the compiler cache of the backend.
     """
+
+    def __init__(self, path):
+        self.path = path
+
+    def _src_path(self, fingerprint):
+        return os.path.join(self.path, fingerprint + '.src')
+
+    def _lock_path(self, fingerprint):
+        return os.path.join(self.path, fingerprint + '.lock')
+
+    def claim(self, fingerprint):
+        """Returns True if the calling process should generate the code."""
+        try:
+            fd = os.open(self._lock_path(fingerprint),
+                    os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            return False
+        os.write(fd, str(os.getpid()))
+        os.close(fd)
+        return True
+
+    def _owner_alive(self, fingerprint):
+        try:
+            with open(self._lock_path(fingerprint), 'r') as f:
+                pid = int(f.read())
+            os.kill(pid, 0)
+        except (IOError, OSError, ValueError):
+            return False
+        return True
+
+    def publish(self, fingerprint, src):
+        tmp_path = '{0}.{1}'.format(self._src_path(fingerprint), os.getpid())
+        with open(tmp_path, 'w') as f:
+            f.write(src)
+        os.rename(tmp_path, self._src_path(fingerprint))
+
+    def wait(self, fingerprint, poll_interval=0.05):
+        """Returns the published code, or None if the process which claimed
+        the fingerprint terminated without publishing it."""
+        path = self._src_path(fingerprint)
+        while not os.path.exists(path):
+            if not self._owner_alive(fingerprint):
+                # The lock file could have been written in the meantime.
+                if not os.path.exists(path):
+                    return None
+                break
+            time.sleep(poll_interval)
+
+        with open(path, 'r') as f:
+            return f.read()
+
+    def num_sources(self):
+        return len([x for x in os.listdir(self.path) if x.endswith('.src')])
+
+
+# Lines ending with this comment are left unchanged by _convert_to_double.
+KEEP_PRECISION = '// keep precision'
+
+def _convert_line_to_double(line):
     import re
     t = re.sub('([0-9]+\.[0-9]*(e-?[0-9]*)?)f([^a-zA-Z0-9\.])', '\\1\\3',
-               src.replace('float', 'double'))
+               line.replace('float', 'double'))
     t = t.replace('logf(', 'log(')
     t = t.replace('expf(', 'exp(')
     t = t.replace('powf(', 'pow(')
     return t
 
+def _convert_to_double(src):
+    """Converts all single-precision floating point literals to double
+    precision ones.
+
+    :param src: string containing the C code to convert
+    """
+    return '\n'.join(line if line.rstrip().endswith(KEEP_PRECISION) else
+            _convert_line_to_double(line + '\n')[:-1]
+            for line in src.split('\n'))
+
 
 class BlockCodeGenerator(object):
     """Generates CUDA/OpenCL code for a simulation."""
@@ -40,6 +151,16 @@ class BlockCodeGenerator(object):
         group.add_argument('--precision',
                 help='precision (single, double)', type=str,
                 choices=['single', 'double'], default='single')
+        group.add_argument('--storage_precision',
+                help='precision in which the distributions are stored in '
+                     'the device memory (half, single); by default the '
+                     'same as --precision', type=str,
+                choices=['half', 'single'], default=None)
+        group.add_argument('--storage_deviation',
+                help='store the deviation of the distributions from the '
+                     'lattice weights instead of the distributions '
+                     'themselves, to improve the accuracy of low precision '
+                     'storage', action='store_true', default=False)
         group.add_argument('--save_src',
                 help='file to save the CUDA/OpenCL source code to',
                 type=str, default='')
@@ -53,6 +174,20 @@ class BlockCodeGenerator(object):
                 help='cache the generated Mako templates in '
                      '/tmp/sailfish_modules-$USER', action='store_true',
                 default=False)
+        group.add_argument('--nocse', dest='cse',
+                help='do not eliminate common subexpressions in the '
+                     'generated collision code', action='store_false',
+                default=True)
+        group.add_argument('--noshare_code', dest='share_code',
+                help='generate code separately for every block, even if '
+                     'the generated code would be identical',
+                action='store_false', default=True)
+        group.add_argument('--cexpr_cache', type=str, default='',
+                metavar='FILE',
+                help='file in which C code generated from symbolic '
+                     'expressions is cached across processes and runs')
+        group.add_argument('--block_size', type=int, default=64,
+                help='size of the block of threads on the compute device')
 
     def __init__(self, simulation):
         self._sim = simulation
@@ -85,19 +220,57 @@ class BlockCodeGenerator(object):
         code_tmpl = lookup.get_template(os.path.join('sailfish/templates',
                                         self._sim.kernel_file))
         ctx = self._build_context(block_runner)
+
+        cache = sym.cexpr_cache
+        if self.config.cexpr_cache:
+            cache.load(self.config.cexpr_cache)
+        hits, misses = cache.hits, cache.misses
+        sym.kernel_flops.clear()
         src = code_tmpl.render(**ctx)
+        cache.save()
+        self.config.logger.debug('cexpr cache: {0} hits, {1} misses.'.format(
+                cache.hits - hits, cache.misses - misses))
+        for kernel, (flops, flops_nocse) in sorted(sym.kernel_flops.iteritems()):
+            self.config.logger.debug('{0}: {1} FLOPs in symbolic expressions '
+                    '({2} without CSE).'.format(kernel, flops, flops_nocse))
 
         if self.is_double_precision():
             src = _convert_to_double(src)
 
+        self._save_block_code(src, block_runner)
+        return src
+
+    def build(self, block_runner):
+        """Generates the code for a block and builds it.
+
+        :returns: the compiled module
+        """
+        backend = block_runner.backend
+        if self.config.use_src or not self.config.code_dir:
+            return backend.build(self.get_code(block_runner))
+
+        shared = SharedCode(self.config.code_dir)
+        fingerprint = context_fingerprint(self._build_context(block_runner))
+        if not shared.claim(fingerprint):
+            src = shared.wait(fingerprint)
+            if src is not None:
+                self.config.logger.debug('Using shared code {0}.'.format(
+                    fingerprint))
+                self._save_block_code(src, block_runner)
+                return backend.build(src)
+
+        src = self.get_code(block_runner)
+        module = backend.build(src)
+        shared.publish(fingerprint, src)
+        return module
+
+    def _save_block_code(self, src, block_runner):
         if self.config.save_src:
             self.save_code(src, '{0}/blk{1}_{2}'.format(
                     os.path.dirname(self.config.save_src),
                     block_runner._block.id, os.path.basename(self.config.save_src)),
                            self.config.format_src)
 
-        return src
-
     def save_code(self, code, dest_path, reformat=True):
         with open(dest_path, 'w') as fsrc:
             print >>fsrc, code
@@ -108,14 +281,26 @@ class BlockCodeGenerator(object):
     def is_double_precision(self):
         return self.config.precision == 'double'
 
+    def storage_precision(self):
+        """Returns the precision in which the distributions are stored
+        (half, single or double)."""
+        return getattr(self.config, 'storage_precision', None) or \
+                self.config.precision
+
     def _build_context(self, block_runnner):
         ctx = {}
         ctx['block_size'] = self.config.block_size
         ctx['propagation_sentinels'] = True
+        ctx['cse'] = self.config.cse
 
         self._sim.update_context(ctx)
         block_runnner.update_context(ctx)
 
+        ctx['dist_storage'] = self.storage_precision()
+        ctx['dist_deviation'] = getattr(self.config, 'storage_deviation', False)
+        ctx['dist_weights'] = ['{0!r}f'.format(float(w)) for w in
+                ctx['grid'].weights]
+
         return ctx
 
 #        ctx['backend'] = self.options.backend
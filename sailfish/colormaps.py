@@ -0,0 +1,114 @@
+"""Colormaps used to render scalar fields as RGB images.
+
+This module does not depend on any graphics library, so that it can be
+used both by interactive visualization engines and for rendering images
+without a display.
+"""
+
+__author__ = 'Michal Januszewski'
+__email__ = 'sailfish-cfd@googlegroups.com'
+__license__ = 'GPL3'
+
+import math
+import numpy as np
+
+def _hsv_to_rgb(a):
+    t = a[:,:,0]*6.0
+    i = t.astype(np.uint8)
+    f = t - np.floor(t)
+
+    v = a[:,:,2]
+
+    o = np.ones_like(a[:,:,0])
+    p = v * (o - a[:,:,1])
+    q = v * (o - a[:,:,1]*f)
+    t = v * (o - a[:,:,1]*(o - f))
+
+    i = np.mod(i, 6)
+    sh = i.shape
+    i = i.reshape(sh[0], sh[1], 1) * np.uint8([1,1,1])
+
+    choices = [np.dstack((v, t, p)),
+               np.dstack((q, v, p)),
+               np.dstack((p, v, t)),
+               np.dstack((p, q, v)),
+               np.dstack((t, p, v)),
+               np.dstack((v, p, q))]
+
+    return np.choose(i, choices)
+
+def _cmap_hsv(drw):
+    drw = drw.reshape((drw.shape[0], drw.shape[1], 1)) * np.float32([1.0, 1.0, 1.0])
+    drw[:,:,2] = 1.0
+    drw[:,:,1] = 1.0
+    drw = _hsv_to_rgb(drw) * 255.0
+    return drw.astype(np.uint8)
+
+def _cmap_std(drw):
+    return (drw.reshape((drw.shape[0], drw.shape[1], 1)) * 255.0).astype(np.uint8) * np.uint8([1,1,0])
+
+def _cmap_2col(drw):
+    drw = ((drw*(drw>0).astype(int)).reshape((drw.shape[0], drw.shape[1], 1)) * np.uint8([255, 0, 0])
+        - ( drw*(drw<0).astype(int)).reshape((drw.shape[0], drw.shape[1], 1)) * np.uint8([0, 0, 255]))
+    drw[drw>255] = 255
+    drw[drw<-255] = -255
+    return drw.astype(np.uint8)
+
+def _cmap_rgb1(drw):
+    """Default color palette from gnuplot."""
+    r = np.sqrt(drw)
+    g = np.power(drw, 3)
+    b = np.sin(drw * math.pi)
+
+    return (np.dstack([r,g,b]) * 250.0).astype(np.uint8)
+
+def _cmap_bin_red_blue(a, b):
+    """Two fields, mapped to the red and blue components, respectively."""
+    g = a.copy()
+    g[:] = 0.0
+    return (np.dstack([a,g,b]) * 255.0).astype(np.uint8)
+
+cmaps = {
+    1: {
+        'std': _cmap_std,
+        'rgb1': _cmap_rgb1,
+        'hsv': _cmap_hsv,
+        '2col': _cmap_2col,
+        },
+    2: {
+        'rb': _cmap_bin_red_blue,
+        }
+    }
+
+_luts = {}
+
+def colormap_lut(name, levels=256):
+    """Returns a [levels, 3] array of RGB colors obtained by sampling the
+    single-component colormap 'name' at evenly spaced points of [0, 1].
+
+    Coloring a field normalized to [0, levels - 1] then only requires
+    indexing this array with integers.
+    """
+    key = (name, levels)
+    if key not in _luts:
+        x = np.linspace(0.0, 1.0, levels).astype(np.float32).reshape(levels, 1)
+        _luts[key] = cmaps[1][name](x).reshape(levels, 3)
+    return _luts[key]
+
+def lut_indices(values, levels, out):
+    """Maps the absolute values of a field to indices of a colormap lookup
+    table, so that the maximum of the field corresponds to the last entry.
+
+    :param values: float array with the field; overwritten
+    :param levels: number of entries in the lookup table
+    :param out: integer array of the same shape as values, in which the
+        indices are stored
+    """
+    # Map [0, v_max] to the nearest entries of the colormap.
+    v_max = np.max(values)
+    np.abs(values, values)
+    if v_max > 0.0:
+        values *= (levels - 1) / v_max
+    values += 0.5
+    out[:] = values
+    return out
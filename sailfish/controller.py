@@ -9,18 +9,25 @@ import logging
 import operator
 import os
 import platform
+import shutil
 import sys
 import tempfile
 import multiprocessing as mp
 from multiprocessing import Process, Array, Event, Value
 
 import zmq
-from sailfish import codegen, config, io, block_runner, util
+from sailfish import codegen, colormaps, config, io, block_runner, forces, \
+        metrics, placement, timeline, util
 from sailfish.geo import LBGeometry2D, LBGeometry3D
+from sailfish.geo_block import SubdomainIndex
 from sailfish.connector import ZMQBlockConnector
 
-def _get_backends():
-    for backend in ['cuda', 'opencl']:
+def _get_backends(backends=None):
+    """Yields classes of the available backends, in the order in which they
+    are listed in 'backends' (all known backends by default)."""
+    if backends is None:
+        backends = ['cuda', 'opencl']
+    for backend in backends:
         try:
             module = 'sailfish.backend_{0}'.format(backend)
             __import__('sailfish', fromlist=['backend_{0}'.format(backend)])
@@ -38,7 +45,7 @@ def _get_visualization_engines():
             pass
 
 def _start_block_runner(block, config, sim, backend_class, gpu_id, output,
-        quit_event):
+        quit_event, balance_conn, state):
     config.logger.debug('BlockRunner starting with PID {0}'.format(os.getpid()))
     # Make sure each block has its own temporary directory.  This is
     # particularly important with Numpy 1.3.0, where there is a race
@@ -50,7 +57,7 @@ def _start_block_runner(block, config, sim, backend_class, gpu_id, output,
     backend = backend_class(config, gpu_id)
 
     runner = block_runner.BlockRunner(sim, block, output, backend, quit_event,
-            'tcp://127.0.0.1:{0}'.format(config.zmq_port))
+            'tcp://127.0.0.1:{0}'.format(config.zmq_port), balance_conn, state)
     runner.run()
 
 
@@ -64,7 +71,9 @@ class LBMachineMaster(object):
         self.lb_class = lb_class
         self.runners = []
         self._block_id_to_runner = {}
-        self._pipes = []
+        # Maps block IDs to connections used to exchange load reports with
+        # the block runners.
+        self._pipes = {}
         self._vis_process = None
         self._vis_quit_event = None
         self._quit_event = Event()
@@ -86,16 +95,32 @@ class LBMachineMaster(object):
         else:
             self.config.logger.setLevel(logging.INFO)
 
-    def _assign_blocks_to_gpus(self):
-        block2gpu = {}
-
+    def _get_gpus(self):
         try:
-            gpus = len(self.config.gpus)
-            for i, block in enumerate(self.blocks):
-                block2gpu[block.id] = self.config.gpus[i % gpus]
+            return list(self.config.gpus)
         except TypeError:
-            for block in self.blocks:
-                block2gpu[block.id] = 0
+            return [0]
+
+    def _log_placement(self, block2gpu, gpus):
+        for gpu in sorted(set(gpus)):
+            ids = sorted(bid for bid, x in block2gpu.iteritems() if x == gpu)
+            self.config.logger.info('GPU {0}: {1} nodes in blocks {2}'.format(
+                gpu, sum(self.blocks[bid].num_nodes for bid in ids), ids))
+
+    def _assign_blocks_to_gpus(self):
+        gpus = self._get_gpus()
+        graph = placement.connectivity_graph(self.blocks)
+        block2gpu = placement.methods[self.config.placement](self.blocks,
+                gpus, graph, self.config.placement_imbalance)
+
+        self._log_placement(block2gpu, gpus)
+        if len(gpus) > 1:
+            self.config.logger.info('Block placement ({0}): {1} elements '
+                    'exchanged between GPUs in every step (round robin: '
+                    '{2}).'.format(self.config.placement,
+                        placement.cut_size(graph, block2gpu),
+                        placement.cut_size(graph, placement.round_robin(
+                            self.blocks, gpus))))
 
         return block2gpu
 
@@ -105,13 +130,12 @@ class LBMachineMaster(object):
         else:
             return ctypes.c_float
 
-    def _init_connectors(self):
+    def _init_connectors(self, sim):
         """Creates block connectors for all blocks connections."""
         # A set to keep track which connections are already created.
         _block_conns = set()
-
-        # TOOD(michalj): Fix this for multi-grid models.
-        grid = util.get_grid_from_config(self.config)
+        # Data for all grids is sent in a single message.
+        num_grids = len(sim.grids)
 
         for i, block in enumerate(self.blocks):
             connecting_blocks = block.connecting_blocks()
@@ -123,8 +147,8 @@ class LBMachineMaster(object):
                 _block_conns.add((nbid, block.id))
 
                 cpair = block.get_connection(face, nbid)
-                size1 = cpair.src.elements
-                size2 = cpair.dst.elements
+                size1 = cpair.src.elements * num_grids
+                size2 = cpair.dst.elements * num_grids
                 ctype = self._get_ctypes_float()
 
                 opp_face = block.opposite_face(face)
@@ -154,12 +178,16 @@ class LBMachineMaster(object):
         if self.config.mode != 'visualization':
             return lambda block: output_cls(self.config, block.id)
 
+        # The buffers are accessed without locking, see
+        # io.VisualizationWrapper for a description of the protocol.
         for block in self.blocks:
             size = reduce(operator.mul, block.size)
-            vis_lock = mp.Lock()
-            vis_buffer = Array(ctypes.c_float, size, lock=vis_lock)
-            vis_geo_buffer = Array(ctypes.c_uint8, size, lock=vis_lock)
-            block.set_vis_buffers(vis_buffer, vis_geo_buffer)
+            vis_buffer = Array(ctypes.c_float, 2 * size, lock=False)
+            vis_geo_buffer = Array(ctypes.c_uint8, size, lock=False)
+            vis_state = Value(io.VisBufferState, lock=False)
+            vis_state.slot = -1
+            vis_state.requested = True
+            block.set_vis_buffers(vis_buffer, vis_geo_buffer, vis_state)
 
         vis_lock = mp.Lock()
         vis_config = Value(io.VisConfig, lock=vis_lock)
@@ -195,23 +223,67 @@ class LBMachineMaster(object):
         sim = self.lb_class(self.config)
         block2gpu = self._assign_blocks_to_gpus()
 
-        self._init_connectors()
+        self._init_connectors(sim)
+        self._init_shared_code()
         output_initializer = self._init_visualization_and_io()
         try:
-            backend_cls = _get_backends().next()
+            backend_cls = _get_backends(self.config.backends.split(',')).next()
         except StopIteration:
             self.config.logger.error('Failed to initialize compute backend.'
                     ' Make sure pycuda/pyopencl is installed.')
             return
 
-        # Create block runners for all blocks.
+        outputs = dict((block.id, output_initializer(block)) for block in
+                self.blocks)
+        balance = self._balancing_enabled()
+        states = {}
+
+        while True:
+            self._start_runners(sim, backend_cls, block2gpu, outputs,
+                    balance, states)
+
+            if balance:
+                block2gpu, states = self._serve_load_reports(block2gpu)
+
+            # Wait for all block runners to finish.
+            for runner in self.runners:
+                runner.join()
+
+            if not states or self._quit_event.is_set():
+                break
+
+            self.config.logger.info('Restarting blocks at iteration {0}.'.format(
+                min(x.iteration for x in states.itervalues())))
+
+        self._finish_visualization()
+        self._finish_shared_code()
+
+    def _start_runners(self, sim, backend_cls, block2gpu, outputs, balance,
+            states):
+        """Creates and starts block runners for all blocks.
+
+        :param balance: if True, the runners will send load reports to the
+            machine master
+        :param states: dict mapping block IDs to BlockStates from which the
+            simulation is to be continued
+        """
+        self.runners = []
+        self._block_id_to_runner = {}
+        self._pipes = {}
+
         for block in self.blocks:
-            output = output_initializer(block)
+            if balance:
+                conn, runner_conn = mp.Pipe()
+                self._pipes[block.id] = conn
+            else:
+                runner_conn = None
+
             p = Process(target=_start_block_runner,
                         name='Block/{0}'.format(block.id),
                         args=(block, self.config, sim,
                               backend_cls, block2gpu[block.id],
-                              output, self._quit_event))
+                              outputs[block.id], self._quit_event,
+                              runner_conn, states.get(block.id)))
             self.runners.append(p)
             self._block_id_to_runner[block.id] = p
 
@@ -219,11 +291,143 @@ class LBMachineMaster(object):
         for runner in self.runners:
             runner.start()
 
-        # Wait for all block runners to finish.
-        for runner in self.runners:
-            runner.join()
+    def _balancing_enabled(self):
+        if self.config.rebalance_every <= 0 or self.config.mode == 'benchmark':
+            return False
+        if len(set(self._get_gpus())) < 2:
+            self.config.logger.debug('Load balancing disabled: only a single '
+                    'GPU is used.')
+            return False
+        return True
+
+    def _rebalance(self, reports, block2gpu):
+        """Decides whether blocks should be migrated between GPUs.
+
+        Blocks on the same GPU share its computational resources, so the time
+        required to complete a step on a GPU is the longest busy time of its
+        blocks.  This time is distributed over the blocks proportionally to
+        their number of nodes to estimate the cost of every block.
+
+        :param reports: dict mapping block IDs to LoadReports
+        :returns: new assignment of blocks to GPUs, or None if the blocks are
+            to stay where they are
+        """
+        gpus = sorted(set(self._get_gpus()))
+        loads = dict((gpu, 0.0) for gpu in gpus)
+        nodes = dict((gpu, 0) for gpu in gpus)
+        for bid, report in reports.iteritems():
+            gpu = block2gpu[bid]
+            loads[gpu] = max(loads[gpu], report.busy)
+            nodes[gpu] += self.blocks[bid].num_nodes
+
+        iteration = max(x.iteration for x in reports.itervalues())
+        for gpu in gpus:
+            waits = [reports[bid].wait for bid in reports if block2gpu[bid] == gpu]
+            self.config.logger.debug('Iteration {0}, GPU {1}: busy {2:e} s, '
+                    'waiting {3:e} s per step.'.format(iteration, gpu,
+                        loads[gpu], max(waits) if waits else 0.0))
+
+        mean = sum(loads.itervalues()) / len(gpus)
+        if mean <= 0.0:
+            return None
+        imbalance = max(loads.itervalues()) / mean - 1.0
+        if imbalance <= self.config.rebalance_threshold:
+            return None
+
+        weights = {}
+        for bid in reports:
+            gpu = block2gpu[bid]
+            weights[bid] = loads[gpu] * self.blocks[bid].num_nodes / nodes[gpu]
+
+        graph = placement.connectivity_graph(self.blocks)
+        new_block2gpu = placement.rebalance(self.blocks, block2gpu, gpus,
+                graph, weights, self.config.placement_imbalance)
+        new_loads = dict((gpu, 0.0) for gpu in gpus)
+        for bid, gpu in new_block2gpu.iteritems():
+            new_loads[gpu] += weights[bid]
+
+        # Migration requires all blocks to be restarted, so only do it if it
+        # results in a significant speedup of the slowest GPU.
+        gain = max(loads.itervalues()) - max(new_loads.itervalues())
+        self.config.logger.info('Iteration {0}: load imbalance between GPUs '
+                'is {1:.1f}%, expected gain from migration: {2:.1f}%.'.format(
+                    iteration, imbalance * 100.0, gain / mean * 100.0))
+        if gain <= self.config.rebalance_threshold * mean:
+            return None
+
+        moved = sorted(bid for bid in new_block2gpu if
+                new_block2gpu[bid] != block2gpu[bid])
+        self.config.logger.info('Migrating blocks {0}.'.format(moved))
+        self._log_placement(new_block2gpu, gpus)
+        return new_block2gpu
+
+    def _receive(self, bid):
+        """Waits for a message from the runner of block 'bid'.  Returns None
+        if the runner terminates without sending one."""
+        conn = self._pipes[bid]
+        while not conn.poll(0.01):
+            if not self._block_id_to_runner[bid].is_alive():
+                if not conn.poll():
+                    return None
+        try:
+            return conn.recv()
+        except EOFError:
+            return None
+
+    def _serve_load_reports(self, block2gpu):
+        """Collects the load reports sent by the block runners every
+        rebalance_every iterations and replies with a decision whether to
+        migrate the blocks.
+
+        :returns: (block2gpu, states): the new assignment of blocks to GPUs
+            and a dict mapping block IDs to their BlockStates if the blocks
+            are migrated; the states are empty if the runners finished
+        """
+        while True:
+            reports = {}
+            for bid in sorted(self._pipes):
+                report = self._receive(bid)
+                if report is not None:
+                    reports[bid] = report
+
+            # The simulation is completed, or the runners are terminating.
+            if len(reports) < len(self.blocks):
+                for bid in reports:
+                    self._pipes[bid].send(False)
+                return block2gpu, {}
+
+            new_block2gpu = self._rebalance(reports, block2gpu)
+            for bid in reports:
+                self._pipes[bid].send(new_block2gpu is not None)
+            if new_block2gpu is None:
+                continue
+
+            states = {}
+            for bid in reports:
+                states[bid] = self._receive(bid)
+            if None in states.itervalues():
+                self.config.logger.error('Failed to receive the state of '
+                        'all blocks.  The simulation cannot be continued.')
+                return block2gpu, {}
+            return new_block2gpu, states
+
+    def _init_shared_code(self):
+        """Creates a directory through which block runners with identical
+        code generation contexts share the generated code."""
+        if not self.config.share_code:
+            self.config.code_dir = ''
+        else:
+            self.config.code_dir = tempfile.mkdtemp(prefix='sailfish_code')
 
-        self._finish_visualization()
+    def _finish_shared_code(self):
+        if not self.config.code_dir:
+            return
+
+        self.config.logger.debug('Generated code for {0} distinct contexts '
+                'and {1} blocks.'.format(
+                    codegen.SharedCode(self.config.code_dir).num_sources(),
+                    len(self.blocks)))
+        shutil.rmtree(self.config.code_dir, ignore_errors=True)
 
 # TODO: eventually, these arguments will be passed asynchronously
 # in a different way
@@ -251,14 +455,8 @@ class LBGeometryProcessor(object):
         for i, block in enumerate(self.blocks):
             block.id = i
 
-    def _init_lower_coord_map(self):
-        # List position corresponds to the principal axis (X, Y, Z).  List
-        # items are maps from lower coordinate along the specific axis to
-        # a list of block IDs.
-        self._coord_map_list = [{}, {}, {}]
-        for block in self.blocks:
-            for i, coord in enumerate(block.location):
-                self._coord_map_list[i].setdefault(coord, []).append(block)
+    def _init_index(self):
+        self._index = SubdomainIndex(self.blocks)
 
     def _connect_blocks(self, config):
         connected = [False] * len(self.blocks)
@@ -271,60 +469,62 @@ class LBGeometryProcessor(object):
                 connected[block1.id] = True
                 connected[block2.id] = True
 
+        def span(block, axis, envelope_size):
+            """Returns the extent of the block along all axes other than
+            'axis', enlarged by the envelope.  Only blocks overlapping this
+            span can be connected to the block."""
+            low = []
+            high = []
+            for i in range(0, self.dim):
+                if i != axis:
+                    low.append(block.location[i] - envelope_size)
+                    high.append(block.end_location[i] + envelope_size)
+            return low, high
+
+        # Pairs of blocks which are next to each other along more than one
+        # axis only need to be processed once.
+        tried = set()
         for axis in range(self.dim):
             for block in sorted(self.blocks, key=lambda x: x.location[axis]):
-                higher_coord = block.location[axis] + block.size[axis]
-                if higher_coord not in self._coord_map_list[axis]:
-                    continue
-                for neighbor_candidate in \
-                        self._coord_map_list[axis][higher_coord]:
+                low, high = span(block, axis, block.envelope_size)
+                for neighbor_candidate in self._index.lower(axis,
+                        block.end_location[axis], low, high):
+                    pair = (block.id, neighbor_candidate.id)
+                    if pair in tried:
+                        continue
+                    tried.add(pair)
+                    tried.add(tuple(reversed(pair)))
                     try_connect(block, neighbor_candidate)
 
         # In case the simulation domain is globally periodic, try to connect
         # the blocks at the lower boundary of the domain along the periodic
         # axis (i.e. coordinate = 0) with blocks which have a boundary at the
         # highest global coordinate (gx, gy, gz).
-        if config.periodic_x:
-            for block in self._coord_map_list[0][0]:
-                # If the block spans the whole X axis of the domain, mark it
+        periodic = [config.periodic_x, config.periodic_y]
+        global_size = [self.geo.gx, self.geo.gy]
+        if self.dim > 2:
+            periodic.append(config.periodic_z)
+            global_size.append(self.geo.gz)
+
+        max_envelope = max(block.envelope_size for block in self.blocks)
+        for axis, size in enumerate(global_size):
+            if not periodic[axis]:
+                continue
+
+            for block in self._index.lower(axis, 0):
+                # If the block spans the whole axis of the domain, mark it
                 # as locally periodic and do not try to find any neigbor
                 # candidates.
-                if block.location[0] + block.size[0] == self.geo.gx:
-                    block.enable_local_periodicity(0)
-                    continue
-
-                # Iterate over all blocks, for each one calculate the location
-                # of its top boundary and compare it to the size of the whole
-                # simulation domain.
-                for x0, candidates in self._coord_map_list[0].iteritems():
-                    for candidate in candidates:
-                        if (candidate.location[0] + candidate.size[0]
-                               == self.geo.gx):
-                            try_connect(block, candidate, self.geo, 0)
-
-        if config.periodic_y:
-            for block in self._coord_map_list[1][0]:
-                if block.location[1] + block.size[1] == self.geo.gy:
-                    block.enable_local_periodicity(1)
+                if block.end_location[axis] == size:
+                    block.enable_local_periodicity(axis)
                     continue
 
-                for y0, candidates in self._coord_map_list[1].iteritems():
-                    for candidate in candidates:
-                        if (candidate.location[1] + candidate.size[1]
-                               == self.geo.gy):
-                            try_connect(block, candidate, self.geo, 1)
-
-        if self.dim > 2 and config.periodic_z:
-            for block in self._coord_map_list[2][0]:
-                if block.location[2] + block.size[2] == self.geo.gz:
-                    block.enable_local_periodicity(2)
-                    continue
-
-                for z0, candidates in self._coord_map_list[2].iteritems():
-                    for candidate in candidates:
-                        if (candidate.location[2] + candidate.size[2]
-                               == self.geo.gz):
-                            try_connect(block, candidate, self.geo, 2)
+                # Only blocks with a boundary at the highest global coordinate
+                # along the axis, overlapping the current block, are
+                # candidates.
+                low, high = span(block, axis, max_envelope)
+                for candidate in self._index.upper(axis, size, low, high):
+                    try_connect(block, candidate, self.geo, axis)
 
         # Ensure every block is connected to at least one other block.
         if not all(connected) and len(connected) > 1:
@@ -332,7 +532,7 @@ class LBGeometryProcessor(object):
 
     def transform(self, config):
         self._annotate()
-        self._init_lower_coord_map()
+        self._init_index()
         self._connect_blocks(config)
         return self.blocks
 
@@ -343,6 +543,10 @@ class LBSimulationController(object):
     def __init__(self, lb_class, lb_geo=None, default_config=None):
         self.config = config.LBConfig()
         self._lb_class = lb_class
+        #: Forces acting on the obstacles defined in the subdomains, as a dict
+        #: mapping obstacle names to lists of (iteration, force) tuples.
+        #: Available after run() if --force_every is set.
+        self.forces = {}
 
         # Use a default global geometry is one has not been
         # specified explicitly.
@@ -366,9 +570,27 @@ class LBSimulationController(object):
         group.add_argument('--output',
             help='save simulation results to FILE', metavar='FILE',
             type=str, default='')
+        group.add_argument('--force_every',
+            help='if not 0, compute the force acting on the obstacles '
+            'defined with set_force_object() every N iterations',
+            metavar='N', type=int, default=0)
+        group.add_argument('--probe_every',
+            help='if not 0, sample the probes defined with set_probe() '
+            'every N iterations', metavar='N', type=int, default=0)
         group.add_argument('--output_format',
             help='output format', type=str,
             choices=io.format_name_to_cls.keys(), default='npy')
+        group.add_argument('--frame_fields', nargs='+', type=str, default=[],
+            metavar='FIELD',
+            help='fields to render when using the png or raw output '
+            'formats; all scalar and vector fields are rendered by default')
+        group.add_argument('--frame_cmap', type=str, default='rgb1',
+            choices=sorted(colormaps.cmaps[1].keys()),
+            help='colormap used by the png and raw output formats')
+        group.add_argument('--frame_levels', type=int, default=256,
+            choices=[256, 4096],
+            help='number of colors in the colormap used by the png and raw '
+            'output formats')
         group.add_argument('--backends',
             type=str, default='cuda,opencl',
             help='computational backends to use; multiple backends '
@@ -378,6 +600,21 @@ class LBSimulationController(object):
             help='visualization engine to use')
         group.add_argument('--gpus', nargs='+', default=0, type=int,
             help='which GPUs to use')
+        group.add_argument('--placement', type=str, default='topology',
+            choices=sorted(placement.methods.keys()),
+            help='method of assigning blocks to GPUs; topology keeps '
+            'strongly connected blocks on the same GPU while balancing the '
+            'number of nodes')
+        group.add_argument('--placement_imbalance', type=float, default=0.05,
+            help='maximum allowed relative excess of the number of nodes on '
+            'a single GPU over the average, when using topology placement')
+        group.add_argument('--rebalance_every', type=int, default=0,
+            metavar='N', help='if not 0, measure the load of all GPUs every N '
+            'iterations and migrate blocks between GPUs when the load is '
+            'imbalanced')
+        group.add_argument('--rebalance_threshold', type=float, default=0.1,
+            help='relative excess of the step time of the slowest GPU over '
+            'the average above which blocks are migrated')
         group.add_argument('--debug_dump_dists', action='store_true',
                 default=False, help='dump the contents of the distribution '
                 'arrays to files'),
@@ -385,6 +622,32 @@ class LBSimulationController(object):
                 help='name of the file to which data is to be logged')
         group.add_argument('--zmq_port', type=int, default=1371,
                 help='0mq port to use for communication with block runners')
+        group.add_argument('--timeline', type=str, default='',
+                metavar='FILE',
+                help='record a timeline of events in all blocks and save it '
+                'as a Chrome trace (FILE_timeline.json) and as per-block CSV '
+                'files')
+        group.add_argument('--timeline_size', type=int, default=100000,
+                help='maximum number of most recent events retained in the '
+                'timeline of a single block')
+        group.add_argument('--metrics_port', type=int, default=0,
+                help='if not 0, serve live performance metrics of all blocks '
+                'in the Prometheus text format on this local HTTP port')
+        group.add_argument('--metrics_every', type=int, default=100,
+                metavar='N', help='publish live metrics every N iterations')
+        group.add_argument('--autotune', action='store_true', default=False,
+                help='select the fastest block_size and bulk_boundary_split '
+                'setting for every block automatically; results are cached '
+                'and reused in subsequent runs')
+        group.add_argument('--autotune_cache', type=str,
+                default='~/.sailfish_autotune.json', metavar='FILE',
+                help='file in which autotuning results are cached')
+        group.add_argument('--autotune_block_sizes', type=int, nargs='+',
+                default=[32, 64, 96, 128, 160, 192, 224, 256],
+                help='block sizes to be tested by the autotuner')
+        group.add_argument('--autotune_iters', type=int, default=200,
+                help='number of iterations used to benchmark a single '
+                'autotuner setting')
         group.add_argument('--bulk_boundary_split', type=bool, default=True,
                 help='if True, bulk and boundary nodes will be handled '
                 'separately (increases parallelism)')
@@ -427,11 +690,15 @@ class LBSimulationController(object):
         return self._lb_class.subdomain.dim
 
     def _init_block_envelope(self, sim, blocks):
-        """Sets the size of the ghost node envelope for all blocks."""
+        """Sets the size of the ghost node envelope for all blocks.
+
+        The envelope has to be wide enough to accommodate both the nonlocal
+        interactions of the model and the longest lattice vector.
+        """
         envelope_size = sim.nonlocality
         for vec in sim.grid.basis:
             for comp in vec:
-                envelope_size = max(sim.nonlocality, abs(comp))
+                envelope_size = max(envelope_size, abs(comp))
 
         # Get rid of any Sympy wrapper objects.
         envelope_size = int(envelope_size)
@@ -439,6 +706,21 @@ class LBSimulationController(object):
         for block in blocks:
             block.set_actual_size(envelope_size)
 
+    def _merge_timelines(self, blocks):
+        base = self.config.timeline
+        fnames = [timeline.block_filename(base, block.id) for block in blocks]
+        fnames = [x for x in fnames if os.path.exists(x)]
+        timeline.merge_chrome_traces(fnames, timeline.merged_filename(base))
+
+    def _finish(self, blocks, collector, force_collector):
+        if self.config.timeline:
+            self._merge_timelines(blocks)
+        if collector is not None:
+            collector.stop()
+        if force_collector is not None:
+            force_collector.stop()
+            self.forces = force_collector.forces
+
     def run(self):
         self.config.parse()
         self._lb_class.modify_config(self.config)
@@ -448,6 +730,14 @@ class LBSimulationController(object):
         summary_receiver = ctx.socket(zmq.REP)
         summary_receiver.bind('tcp://127.0.0.1:{0}'.format(self.config.zmq_port))
 
+        if self.config.metrics_port:
+            collector = metrics.MetricsCollector(ctx, self.config.metrics_port)
+            collector.start()
+            self.config.metrics_addr = collector.addr
+        else:
+            collector = None
+            self.config.metrics_addr = ''
+
         blocks = self.geo.blocks()
         assert blocks is not None, \
                 "Make sure the block list is returned in geo_class.blocks()"
@@ -460,6 +750,15 @@ class LBSimulationController(object):
         proc = LBGeometryProcessor(blocks, self.dim, self.geo)
         blocks = proc.transform(self.config)
 
+        if self.config.force_every and self.config.mode != 'benchmark':
+            force_collector = forces.ForceCollector(ctx, self.config,
+                    len(blocks))
+            force_collector.start()
+            self.config.forces_addr = force_collector.addr
+        else:
+            force_collector = None
+            self.config.forces_addr = ''
+
         # TODO(michalj): do this over MPI
         p = Process(target=_start_machine_master,
                     name='Master/{0}'.format(platform.node()),
@@ -484,6 +783,8 @@ class LBSimulationController(object):
                         mlups_total, mlups_comp))
 
             p.join()
+            self._finish(blocks, collector, force_collector)
             return timing_infos, blocks
 
         p.join()
+        self._finish(blocks, collector, force_collector)
@@ -0,0 +1,104 @@
+"""Collection of the forces acting on obstacles."""
+
+__author__ = 'Michal Januszewski'
+__email__ = 'sailfish-cfd@googlegroups.com'
+__license__ = 'LGPL3'
+
+from collections import defaultdict
+import threading
+import numpy as np
+import zmq
+
+
+def forces_filename(base):
+    return '{0}_forces.txt'.format(base)
+
+
+class ForceCollector(object):
+    """Receives the forces computed by all block runners and sums them
+    over the blocks.
+
+    The complete forces are available in the 'forces' attribute, a dict
+    mapping obstacle names to lists of (iteration, force vector) tuples,
+    and are also appended to a time series file if an output file is
+    specified in the config.
+    """
+
+    def __init__(self, ctx, config, num_blocks):
+        self._ctx = ctx
+        #: Address to which the block runners should connect.  Available
+        #: after start() returns.
+        self.addr = None
+        self.forces = defaultdict(list)
+        self._num_blocks = num_blocks
+        # Maps iterations to the number of blocks which have reported the
+        # forces at that iteration and the sums of the forces.
+        self._pending = {}
+        self._bound = threading.Event()
+        self._quit = threading.Event()
+        self._thread = None
+        self._file = None
+
+        if config.output:
+            self._file = open(forces_filename(config.output), 'w')
+            self._file.write('# columns: iteration, obstacle name, force '
+                    'components\n')
+
+    def update(self, sample):
+        count, forces = self._pending.get(sample.iteration, (0, {}))
+        for name, force in sample.forces.iteritems():
+            if name in forces:
+                forces[name] = forces[name] + force
+            else:
+                forces[name] = force
+        count += 1
+
+        if count < self._num_blocks:
+            self._pending[sample.iteration] = (count, forces)
+            return
+
+        self._pending.pop(sample.iteration, None)
+        for name, force in sorted(forces.iteritems()):
+            self.forces[name].append((sample.iteration, force))
+            if self._file is not None:
+                # Print enough digits to represent the values without loss.
+                if force.dtype == np.float64:
+                    fmt = '%.17g'
+                else:
+                    fmt = '%.9g'
+                self._file.write('{0} {1} {2}\n'.format(sample.iteration,
+                    name, ' '.join(fmt % x for x in force)))
+        if self._file is not None:
+            self._file.flush()
+
+    def _receive(self):
+        # ZMQ sockets are not thread-safe, so the socket is only ever used
+        # from within this thread.
+        sock = self._ctx.socket(zmq.REP)
+        port = sock.bind_to_random_port('tcp://127.0.0.1')
+        self.addr = 'tcp://127.0.0.1:{0}'.format(port)
+        self._bound.set()
+
+        poller = zmq.Poller()
+        poller.register(sock, zmq.POLLIN)
+        while True:
+            if poller.poll(100):
+                self.update(sock.recv_pyobj())
+                sock.send_pyobj('ack')
+            elif self._quit.is_set():
+                break
+        sock.close()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._receive)
+        self._thread.daemon = True
+        self._thread.start()
+        self._bound.wait()
+
+    def stop(self):
+        """Stops the collector once all samples have been received."""
+        self._quit.set()
+        self._thread.join()
+        if self._file is not None:
+            self._file.close()
+        self.forces = dict(self.forces)
@@ -5,6 +5,7 @@ __email__ = 'sailfish-cfd@googlegroups.com'
 __license__ = 'GPL3'
 
 from collections import defaultdict, namedtuple
+import itertools
 import operator
 import numpy as np
 from sailfish import sym
@@ -70,47 +71,46 @@ class LBConnection(object):
         normal = b1.face_to_normal(face)
         dists = sym.get_interblock_dists(grid, normal)
 
-        # Create an array where the entry at [x,y] is the global coordinate pair
-        # corresponding to the node [x,y] in the transfer buffer.
-        src_coords = np.mgrid[src_slice_global]
-        # [2,x,y] -> [x,y,2]
-        src_coords = np.rollaxis(src_coords, 0, len(src_coords.shape))
-        min_loc = []
-        max_loc = []
-
-        for axis in slice_axes:
-            min_loc.append(b1.location[axis])
-            max_loc.append(b1.end_location[axis])
-
-        # Location of the b1 block in global coordinates.
-        min_loc = np.uint32(min_loc)
-        max_loc = np.uint32(max_loc)
-        last_axis = len(src_coords.shape)-1
-        full_map = np.ones(src_coords.shape[:-1], dtype=np.bool)
-
-        dst_partial_map = {}
-        dist_idx_to_dist_map = {}
+        # Global coordinates of the nodes in the transfer buffer, separately
+        # for every axis of the buffer.
+        src_coords = [np.arange(span.start, span.stop) for span in
+                src_slice_global]
+
+        def _outer_and(masks):
+            """Combines 1D masks (one per buffer axis) into a mask spanning
+            the whole transfer buffer."""
+            n = len(masks)
+            return reduce(np.logical_and, [
+                mask.reshape([-1 if i == j else 1 for j in range(n)])
+                for i, mask in enumerate(masks)])
+
+        # A distribution is transferred to a node of the buffer if it comes
+        # from a node of b1.  This condition is separable, i.e. it can be
+        # evaluated independently along every axis of the buffer, which
+        # avoids building coordinate arrays for the whole face.
+        dist_idx_to_axis_maps = {}
+        full_axis_maps = [np.ones(len(x), dtype=np.bool) for x in src_coords]
 
         for dist_idx in dists:
-            basis_vec = list(grid.basis[dist_idx])
+            basis_vec = [int(x) for x in grid.basis[dist_idx]]
             del basis_vec[conn_axis]
 
-            src_block_node = src_coords - basis_vec
-            dist_map = np.logical_and(src_block_node >= min_loc,
-                                      src_block_node < max_loc)
-            dist_map = np.logical_and.reduce(dist_map, last_axis)
-            full_map = np.logical_and(full_map, dist_map)
-            dist_idx_to_dist_map[dist_idx] = dist_map
-
-        buf_min_loc = []
-        for span in src_slice_global:
-            buf_min_loc.append(span.start)
+            axis_maps = []
+            for i, axis in enumerate(slice_axes):
+                src_block_node = src_coords[i] - basis_vec[i]
+                axis_maps.append(np.logical_and(
+                    src_block_node >= b1.location[axis],
+                    src_block_node < b1.end_location[axis]))
+                full_axis_maps[i] &= axis_maps[-1]
+            dist_idx_to_axis_maps[dist_idx] = axis_maps
 
-        for dist_idx, dist_map in dist_idx_to_dist_map.iteritems():
-            partial_nodes = src_coords[np.logical_and(dist_map,
-                                            np.logical_not(full_map))]
+        not_full_map = np.logical_not(_outer_and(full_axis_maps))
+        dst_partial_map = {}
+        for dist_idx, axis_maps in dist_idx_to_axis_maps.iteritems():
+            # Positions relative to the beginning of the buffer.
+            partial_nodes = np.argwhere(np.logical_and(_outer_and(axis_maps),
+                not_full_map))
             if len(partial_nodes) > 0:
-                partial_nodes -= buf_min_loc
                 dst_partial_map[dist_idx] = partial_nodes
 
         # Slice selecting part of the buffer with nodes containing information
@@ -122,12 +122,11 @@ class LBConnection(object):
             b2_start = b2.location[slice_axes[i]]
             dst_low.append(global_pos.start - b2_start)
 
-        full_idxs = np.argwhere(full_map)
-        if len(full_idxs) > 0:
-            full_min = np.min(full_idxs, 0)
-            full_max = np.max(full_idxs, 0)
-            for i, (lo, hi) in enumerate(zip(full_min, full_max)):
-                b1_start = b1.location[slice_axes[i]]
+        # The nodes with all distributions form a box in the buffer.
+        full_idxs = [np.flatnonzero(x) for x in full_axis_maps]
+        if all(len(x) > 0 for x in full_idxs):
+            for i, idxs in enumerate(full_idxs):
+                lo, hi = idxs[0], idxs[-1]
                 b2_start = b2.location[slice_axes[i]]
                 curr_to_dist = src_slice_global[i].start - b2_start
                 dst_slice.append(slice(lo+curr_to_dist, hi+1+curr_to_dist))
@@ -208,6 +207,7 @@ class SubdomainSpec(object):
 
         self.vis_buffer = None
         self.vis_geo_buffer = None
+        self.vis_state = None
         self._periodicity = [False] * self.dim
 
     def __str__(self):
@@ -292,15 +292,29 @@ class SubdomainSpec(object):
     def has_face_conn(self, face):
         return face in self._connections.keys()
 
+    def context_fingerprint(self):
+        """Returns a string identifying the properties of the block which
+        are used in code generation."""
+        return '{0}{1}'.format(self.__class__.__name__,
+                sorted(self._connections.keys()))
+
     def set_actual_size(self, envelope_size):
         # TODO: It might be possible to optimize this a little by avoiding
         # having buffers on the sides which are not connected to other blocks.
         self.actual_size = [x + 2 * envelope_size for x in self.size]
         self.envelope_size = envelope_size
 
-    def set_vis_buffers(self, vis_buffer, vis_geo_buffer):
+    def set_vis_buffers(self, vis_buffer, vis_geo_buffer, vis_state):
+        """Sets the shared memory buffers used to pass data to the
+        visualization engine.
+
+        :param vis_buffer: field data, with space for two copies of the field
+        :param vis_geo_buffer: map of node types
+        :param vis_state: io.VisBufferState instance
+        """
         self.vis_buffer = vis_buffer
         self.vis_geo_buffer = vis_geo_buffer
+        self.vis_state = vis_state
 
     @classmethod
     def face_to_dir(cls, face):
@@ -435,6 +449,82 @@ class SubdomainSpec(object):
 
         return False
 
+class SubdomainIndex(object):
+    """Spatial index over the boundaries of a set of SubdomainSpecs.
+
+    Blocks are grouped by the position of their lower and upper boundary
+    along every axis.  Within every such plane, the blocks are bucketed on
+    a uniform grid (with cells as large as the largest block in the plane)
+    according to their lower corner, so that blocks overlapping a region of
+    the plane can be found without scanning all blocks.
+    """
+
+    def __init__(self, blocks):
+        self._planes = {}
+        planes = defaultdict(list)
+        for block in blocks:
+            for axis in range(0, block.dim):
+                planes[(axis, False, block.location[axis])].append(block)
+                planes[(axis, True, block.end_location[axis])].append(block)
+
+        for key, plane_blocks in planes.iteritems():
+            axis = key[0]
+            cell_size = [max(block.size[i] for block in plane_blocks)
+                    for i in self._other_axes(plane_blocks[0].dim, axis)]
+            cells = defaultdict(list)
+            for block in plane_blocks:
+                cells[self._cell(block.location, axis, cell_size)].append(block)
+            self._planes[key] = (cell_size, cells)
+
+    @staticmethod
+    def _other_axes(dim, axis):
+        return [i for i in range(0, dim) if i != axis]
+
+    def _cell(self, location, axis, cell_size):
+        return tuple(location[i] / size for i, size in
+                zip(self._other_axes(len(location), axis), cell_size))
+
+    def _find(self, key, low, high):
+        if key not in self._planes:
+            return []
+        cell_size, cells = self._planes[key]
+        if low is None:
+            return sorted(itertools.chain(*cells.values()),
+                    key=lambda block: block.id)
+
+        # Blocks are registered in the cell of their lower corner, and are
+        # at most as large as a cell, so any block overlapping [low, high)
+        # has its lower corner in [low - size + 1, high).
+        ranges = [range((lo - size + 1) / size, (hi - 1) / size + 1) for
+                lo, hi, size in zip(low, high, cell_size)]
+        axes = self._other_axes(len(low) + 1, key[0])
+        ret = []
+        for cell in itertools.product(*ranges):
+            for block in cells.get(cell, []):
+                if all(block.location[axis] < hi and
+                        block.end_location[axis] > lo for axis, lo, hi in
+                        zip(axes, low, high)):
+                    ret.append(block)
+        return sorted(ret, key=lambda block: block.id)
+
+    def lower(self, axis, coord, low=None, high=None):
+        """Returns blocks whose lower boundary along `axis` is at `coord`
+        and which overlap the region [low, high) of that plane.
+
+        :param low: lower bounds of the region along all other axes,
+            in natural order; if None, all blocks in the plane are returned
+        :param high: upper bounds of the region (exclusive)
+        """
+        return self._find((axis, False, coord), low, high)
+
+    def upper(self, axis, coord, low=None, high=None):
+        """Returns blocks whose upper boundary (exclusive) along `axis` is at
+        `coord` and which overlap the region [low, high) of that plane.
+
+        See lower() for the description of the arguments."""
+        return self._find((axis, True, coord), low, high)
+
+
 class SubdomainSpec2D(SubdomainSpec):
     dim = 2
 
@@ -674,6 +764,8 @@ class Subdomain(object):
         self._param_map = block.runner.make_scalar_field(np.uint32, register=False)
         self._params = {}
         self._encoder = None
+        self._probes = {}
+        self._force_objects = {}
 
     @property
     def config(self):
@@ -697,8 +789,88 @@ class Subdomain(object):
         self._param_map[where] = hash(key)
         self._params[hash(key)] = key
 
+    def set_probe(self, name, where):
+        """Marks nodes at which the macroscopic fields are to be sampled.
+
+        :param name: name of the probe, used in the time series file
+        :param where: boolean array selecting the probe nodes, with the same
+            shape as the coordinate arrays passed to boundary_conditions();
+            a single node makes a point probe, a row of nodes makes a line
+            probe
+        """
+        # np.nonzero returns coordinates in the [z,] y, x order.  Store them
+        # in the natural x, y, [z] order.
+        self._probes[name] = np.fliplr(np.transpose(np.nonzero(where)))
+
+    def probes(self):
+        """Returns a list of (name, locations) tuples sorted by the probe name.
+
+        Locations are a [nodes, dim] array of coordinates relative to the
+        origin of the block (ghost nodes not included).
+        """
+        return sorted(self._probes.items())
+
+    def set_force_object(self, name, where):
+        """Marks wall nodes forming an obstacle on which the hydrodynamic
+        force is to be computed (see --force_every).
+
+        :param name: name of the obstacle
+        :param where: boolean array selecting the wall nodes of the obstacle,
+            with the same shape as the coordinate arrays passed to
+            boundary_conditions(); an obstacle spanning several subdomains
+            should be marked in all of them using the same name
+        """
+        self._force_objects[name] = np.fliplr(np.transpose(np.nonzero(where)))
+
+    def force_objects(self):
+        """Returns a list of (name, locations) tuples sorted by the name of
+        the obstacle, in the same format as probes()."""
+        return sorted(self._force_objects.items())
+
+    def node_types(self, margin=1):
+        """Returns an array of the types of the nodes of this subdomain and of
+        a layer of 'margin' nodes around it, as set in boundary_conditions().
+
+        The types of the nodes around the subdomain, which belong to the
+        neighboring subdomains, are obtained by evaluating
+        boundary_conditions() for their coordinates.  Nodes outside of the
+        simulation domain are reported as walls, unless the domain is
+        periodic along the corresponding axis.
+        """
+        mgrid = list(self._get_mgrid(margin))
+        outside = np.zeros(mgrid[0].shape, dtype=np.bool)
+        sizes = self.grid_shape[::-1]
+        for axis, (coords, size) in enumerate(zip(mgrid, sizes)):
+            if getattr(self.config, 'periodic_' + 'xyz'[axis], False):
+                coords %= size
+            else:
+                outside |= (coords < 0) | (coords >= size)
+
+        # Evaluate the boundary conditions into temporary arrays, leaving
+        # the state of the subdomain intact.
+        saved = (self._type_map, self._param_map, self._params, self._probes,
+                self._force_objects, self._type_map_encoded)
+        try:
+            self._type_map = np.zeros(mgrid[0].shape, dtype=np.uint32)
+            self._type_map[:] = self.NODE_FLUID
+            self._param_map = np.zeros_like(self._type_map)
+            self._params = {}
+            self._probes = {}
+            self._force_objects = {}
+            self._type_map_encoded = False
+            self.boundary_conditions(*mgrid)
+            types = self._type_map
+        finally:
+            (self._type_map, self._param_map, self._params, self._probes,
+                    self._force_objects, self._type_map_encoded) = saved
+
+        types[outside] = self.NODE_WALL
+        return types
+
     def reset(self):
         self._type_map_encoded = False
+        self._probes = {}
+        self._force_objects = {}
         mgrid = self._get_mgrid()
         self.boundary_conditions(*mgrid)
 
@@ -749,9 +921,10 @@ class Subdomain2D(Subdomain):
         self.gy, self.gx = grid_shape
         Subdomain.__init__(self, grid_shape, block, *args, **kwargs)
 
-    def _get_mgrid(self):
-        return reversed(np.mgrid[self.block.oy:self.block.oy + self.block.ny,
-                                 self.block.ox:self.block.ox + self.block.nx])
+    def _get_mgrid(self, margin=0):
+        m = margin
+        return reversed(np.mgrid[self.block.oy - m:self.block.oy + self.block.ny + m,
+                                 self.block.ox - m:self.block.ox + self.block.nx + m])
 
     def _define_ghosts(self):
         assert not self._type_map_encoded
@@ -783,10 +956,11 @@ class Subdomain3D(Subdomain):
         self.gz, self.gy, self.gx = grid_shape
         Subdomain.__init__(self, grid_shape, block, *args, **kwargs)
 
-    def _get_mgrid(self):
-        return reversed(np.mgrid[self.block.oz:self.block.oz + self.block.nz,
-                                 self.block.oy:self.block.oy + self.block.ny,
-                                 self.block.ox:self.block.ox + self.block.nx])
+    def _get_mgrid(self, margin=0):
+        m = margin
+        return reversed(np.mgrid[self.block.oz - m:self.block.oz + self.block.nz + m,
+                                 self.block.oy - m:self.block.oy + self.block.ny + m,
+                                 self.block.ox - m:self.block.ox + self.block.nx + m])
 
     def _define_ghosts(self):
         assert not self._type_map_encoded
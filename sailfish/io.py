@@ -8,15 +8,30 @@ __license__ = 'LGPL3'
 import math
 import numpy as np
 import operator
+import os
+import struct
+import zlib
 import ctypes
 from ctypes import Structure, c_uint16, c_int32, c_uint8, c_bool
 
+from sailfish import colormaps
+
 class VisConfig(Structure):
     MAX_NAME_SIZE = 64
     _fields_ = [('iteration', c_int32), ('block', c_uint16), ('field', c_uint8),
             ('all_blocks', c_bool), ('fields', c_uint8), ('field_name',
                 type(ctypes.create_string_buffer(MAX_NAME_SIZE)))]
 
+class VisBufferState(Structure):
+    """State of the visualization buffer of a single block.
+
+    slot: index of the half of the buffer holding the most recent field
+        data, or -1 if no data is available yet
+    requested: set by the visualization engine when it has finished
+        reading the most recent data and is ready for a new frame
+    """
+    _fields_ = [('slot', c_int32), ('requested', c_bool)]
+
 class LBOutput(object):
     def __init__(self, config, block_id, *args, **kwargs):
         self._scalar_fields = {}
@@ -25,6 +40,7 @@ class LBOutput(object):
         self._visualization_fields = {}
         self.basename = config.output
         self.block_id = block_id
+        self._probe_file = None
 
     def register_field(self, field, name, visualization=False):
         if visualization:
@@ -41,6 +57,54 @@ class LBOutput(object):
     def dump_dists(self, i):
         pass
 
+    def init_probes(self, probes, dim, append=False):
+        """Opens the time series file for probe samples.
+
+        :param probes: list of (name, locations) tuples; locations are
+            a [nodes, dim] array of global node coordinates
+        :param dim: dimensionality of the simulation
+        :param append: if True, samples are appended to an existing file
+        """
+        if not self.basename:
+            return
+
+        fname = probes_filename(self.basename, self.block_id)
+        if append:
+            self._probe_file = open(fname, 'a')
+            return
+
+        self._probe_file = open(fname, 'w')
+        self._probe_file.write('# probe nodes (name x y [z]):\n')
+        for name, locations in probes:
+            for loc in locations:
+                self._probe_file.write('# {0} {1}\n'.format(name,
+                    ' '.join(str(x) for x in loc)))
+        self._probe_file.write('# columns: iteration, {0} for every node '
+                'listed above\n'.format(' '.join(['rho', 'vx', 'vy', 'vz'][0:dim+1])))
+
+    def save_probes(self, i, rho, v):
+        """Appends a single probe sample to the time series file.
+
+        :param rho: [nodes] array of densities
+        :param v: [nodes, dim] array of velocities
+        """
+        if self._probe_file is None:
+            return
+
+        row = np.hstack([rho[:, np.newaxis], v]).ravel()
+        # Print enough digits to represent the values without loss.
+        if v.dtype == np.float64:
+            fmt = '%.17g'
+        else:
+            fmt = '%.9g'
+        self._probe_file.write('{0} {1}\n'.format(i,
+            ' '.join(fmt % x for x in row)))
+
+    def close_probes(self):
+        if self._probe_file is not None:
+            self._probe_file.close()
+            self._probe_file = None
+
 
 class VisualizationWrapper(LBOutput):
     """Passes data to a visualization engine, and handles saving it to a
@@ -51,17 +115,29 @@ class VisualizationWrapper(LBOutput):
     # used for the output file.
     def __init__(self, config, block, vis_config, output_cls):
         self._output = output_cls(config, block.id)
-        self._vis_buffer = block.vis_buffer
         self._vis_config = vis_config
-        self._geo_buffer = block.vis_geo_buffer
+        self._vis_state = block.vis_state
         self._first_save = True
+        self._geo_saved = False
         self.block = block
         self.nodes = reduce(operator.mul, block.size)
         self._dim = len(self.block.size)
+        self._vis_buffer = np.ctypeslib.as_array(block.vis_buffer).reshape(
+                2, self.nodes)
+        self._geo_buffer = np.ctypeslib.as_array(block.vis_geo_buffer)
 
     def register_field(self, field, name, visualization=False):
         self._output.register_field(field, name, visualization)
 
+    def init_probes(self, probes, dim, append=False):
+        self._output.init_probes(probes, dim, append)
+
+    def save_probes(self, i, rho, v):
+        self._output.save_probes(i, rho, v)
+
+    def close_probes(self):
+        self._output.close_probes()
+
     def save(self, i):
         self._output.save(i)
 
@@ -82,29 +158,50 @@ class VisualizationWrapper(LBOutput):
             self._vis_config.fields = self._scalar_len + self._vis_len + self._vector_len
             self._first_save = False
 
-        # Only update the buffer if the block to which we belong is
-        # currently being visualized.
-        if self._vis_config.all_blocks or self.block.id == self._vis_config.block:
-            self._vis_config.iteration = i
-            requested_field = self._vis_config.field
-            self._vis_config.field_name = self._field_names[requested_field]
-
-            if requested_field < self._scalar_len:
-                name = self._scalar_names[requested_field]
-                field = self._output._scalar_fields[name]
-            elif requested_field < self._scalar_len + self._vis_len:
-                requested_field -= self._scalar_len
-                name = self._vis_names[requested_field]
-                field = self._output._visualization_fields[name]()
-            else:
-                requested_field -= self._scalar_len + self._vis_len
-                idx = requested_field / self._dim
-                name = self._vector_names[idx]
-                component = requested_field % self._dim
-                field = self._output._vector_fields[name][component]
+        # The geometry does not change during the simulation, so it only
+        # needs to be passed to the visualization engine once.
+        if not self._geo_saved:
+            self._geo_buffer[0:self.nodes].reshape(self.block.size[::-1])[:] = \
+                    self.block.runner.visualization_map()
+            self._geo_saved = True
 
-            self._vis_buffer[0:self.nodes] = np.ravel(field)
-            self._geo_buffer[0:self.nodes] = np.ravel(self.block.runner.visualization_map())
+        # Only update the buffer if the block to which we belong is
+        # currently being visualized, and the visualization engine is
+        # ready for a new frame.
+        if not (self._vis_config.all_blocks or
+                self.block.id == self._vis_config.block):
+            return
+        if not self._vis_state.requested:
+            return
+
+        requested_field = self._vis_config.field
+        self._vis_config.field_name = self._field_names[requested_field]
+
+        if requested_field < self._scalar_len:
+            name = self._scalar_names[requested_field]
+            field = self._output._scalar_fields[name]
+        elif requested_field < self._scalar_len + self._vis_len:
+            requested_field -= self._scalar_len
+            name = self._vis_names[requested_field]
+            field = self._output._visualization_fields[name]()
+        else:
+            requested_field -= self._scalar_len + self._vis_len
+            idx = requested_field / self._dim
+            name = self._vector_names[idx]
+            component = requested_field % self._dim
+            field = self._output._vector_fields[name][component]
+
+        # Write to the slot which is not visible to the visualization
+        # engine, and then atomically make it the most recent one.  The
+        # engine only reads the most recent slot, so no locking is
+        # necessary.
+        slot = 1 - max(self._vis_state.slot, 0)
+        self._vis_buffer[slot].reshape(field.shape)[:] = field
+        self._vis_state.requested = False
+        self._vis_state.slot = slot
+        # The visualization engine redraws the screen when the iteration
+        # changes, so it is updated after the data.
+        self._vis_config.iteration = i
 
 
 def filename_iter_digits(max_iters=0):
@@ -127,6 +224,9 @@ def dists_filename(base, digits, subdomain_id, it, suffix='.npy'):
 def subdomains_filename(base):
     return base + '.subdomains'
 
+def probes_filename(base, subdomain_id):
+    return '{0}_probes.{1}.txt'.format(base, subdomain_id)
+
 class VTKOutput(LBOutput):
     """Saves simulation data in VTK files."""
     format_name = 'vtk'
@@ -233,7 +333,136 @@ class MatlabOutput(LBOutput):
         scipy.io.savemat(dists)
 
 
-_OUTPUTS = [NPYOutput, VTKOutput, MatlabOutput]
+def _png_chunk(tag, data):
+    return (struct.pack('>I', len(data)) + tag + data +
+            struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff))
+
+def _write_png(fname, rgb):
+    """Saves a [height, width, 3] uint8 array as a PNG file."""
+    height, width = rgb.shape[0:2]
+    # Every row of the image is preceded by the filter type (0 = none).
+    rows = np.zeros((height, width * 3 + 1), dtype=np.uint8)
+    rows[:, 1:] = rgb.reshape(height, width * 3)
+    with open(fname, 'wb') as f:
+        f.write('\x89PNG\r\n\x1a\n')
+        f.write(_png_chunk('IHDR', struct.pack('>IIBBBBB', width, height,
+            8, 2, 0, 0, 0)))
+        f.write(_png_chunk('IDAT', zlib.compress(rows.tostring(), 6)))
+        f.write(_png_chunk('IEND', ''))
+
+
+class FrameOutput(LBOutput):
+    """Base class for outputs rendering fields into RGB images.
+
+    Images are generated using the same colormaps as in the interactive
+    visualization, without the need for a display.  Vector fields are
+    represented by their magnitude, and for 3D simulations the middle
+    slice along the Z axis is rendered.
+    """
+
+    def __init__(self, config, block_id):
+        LBOutput.__init__(self, config, block_id)
+        self.digits = filename_iter_digits(config.max_iters)
+        self.logger = config.logger
+        self._field_names = config.frame_fields
+        self._levels = config.frame_levels
+        self._lut = colormaps.colormap_lut(config.frame_cmap,
+                config.frame_levels)
+        self._buffers = None
+
+    def _selected_fields(self):
+        if self._field_names:
+            return self._field_names
+        return sorted(self._scalar_fields.keys()) + sorted(
+                self._vector_fields.keys())
+
+    def _field_slice(self, name):
+        """Returns a 2D array with the values of the field 'name'."""
+        if name in self._scalar_fields:
+            field = self._scalar_fields[name]
+        elif name in self._visualization_fields:
+            field = self._visualization_fields[name]()
+        elif name in self._vector_fields:
+            field = [np.square(c.astype(np.float32)) for c in
+                    self._vector_fields[name]]
+            field = np.sqrt(reduce(operator.add, field))
+        else:
+            raise ValueError('Unknown field for frame output: {0}. Valid '
+                    'fields are: {1}'.format(name, ', '.join(
+                        sorted(self._scalar_fields.keys() +
+                            self._vector_fields.keys() +
+                            self._visualization_fields.keys()))))
+
+        if field.ndim == 3:
+            field = field[field.shape[0] / 2]
+        return field
+
+    def render(self, name):
+        """Returns a [height, width, 3] uint8 array with the image of the
+        field 'name'.  The Y axis of the field points up in the image."""
+        field = self._field_slice(name)
+        if self._buffers is None:
+            self._buffers = (np.zeros(field.shape, dtype=np.float32),
+                    np.zeros(field.shape, dtype=np.intp),
+                    np.zeros(field.shape + (3,), dtype=np.uint8))
+        tmp, idx, rgb = self._buffers
+        tmp[:] = field
+        colormaps.lut_indices(tmp, self._levels, idx)
+        np.take(self._lut, idx[::-1], axis=0, out=rgb, mode='clip')
+        return rgb
+
+    def save(self, i):
+        for name in self._selected_fields():
+            self.save_frame(i, name, self.render(name))
+
+    def save_frame(self, i, name, rgb):
+        raise NotImplementedError("save_frame() should be implemented in a subclass")
+
+
+class PNGOutput(FrameOutput):
+    """Saves images of the simulation fields as PNG files, one file per
+    field, block and iteration."""
+    format_name = 'png'
+
+    def save_frame(self, i, name, rgb):
+        _write_png(filename('{0}_{1}'.format(self.basename, name),
+            self.digits, self.block_id, i, suffix='.png'), rgb)
+
+
+class RawVideoOutput(FrameOutput):
+    """Appends images of the simulation fields to raw RGB24 video streams,
+    one stream per field and block.
+
+    The streams can be encoded with ffmpeg, e.g.:
+      ffmpeg -f rawvideo -pix_fmt rgb24 -s WxH -i out_v.0.rgb out_v.0.mp4
+    """
+    format_name = 'raw'
+
+    def __init__(self, config, block_id):
+        FrameOutput.__init__(self, config, block_id)
+        self._streams = {}
+
+    def save_frame(self, i, name, rgb):
+        if name not in self._streams:
+            fname = '{0}_{1}.{2}.rgb'.format(self.basename, name,
+                    self.block_id)
+            # Continue an existing stream if the simulation is resumed
+            # from a later iteration (e.g. when the block is migrated).
+            if i == 0 or not os.path.exists(fname):
+                self.logger.info('Writing {0}x{1} rgb24 frames of {2} to '
+                        '{3}'.format(rgb.shape[1], rgb.shape[0], name, fname))
+                self._streams[name] = open(fname, 'wb')
+            else:
+                self._streams[name] = open(fname, 'ab')
+
+        stream = self._streams[name]
+        stream.write(rgb.tostring())
+        # The block runner process might terminate without flushing
+        # the file buffers.
+        stream.flush()
+
+
+_OUTPUTS = [NPYOutput, VTKOutput, MatlabOutput, PNGOutput, RawVideoOutput]
 
 format_name_to_cls = {}
 for output_class in _OUTPUTS:
@@ -40,6 +40,32 @@ class LBSim(object):
         code generation."""
         pass
 
+    def get_macro_kernels(self, runner):
+        """Returns a pair of kernels (one for every distributions buffer)
+        computing the macroscopic fields for output, or None if the fields
+        are saved by the compute kernels."""
+        return None
+
+    def get_prepare_kernels(self, runner):
+        """Returns a pair of kernels (one for every distributions buffer)
+        computing the macroscopic fields accessed nonlocally by the compute
+        kernels, or None if the model is local.  The kernels are run at the
+        beginning of every step, before the fields in the ghost nodes are
+        updated."""
+        return None
+
+    def body_force_accel(self, rho):
+        """Returns the acceleration of the fluid due to body forces in nodes
+        with densities rho, as a [nodes, dim] array, or None if there are no
+        body forces."""
+        return None
+
+    def nonlocal_fields(self):
+        """Returns a list of fields accessed nonlocally by the compute
+        kernels.  Their values in the ghost nodes are updated in every
+        step."""
+        return []
+
     def __init__(self, config):
         self.config = config
         self.S = sym.S()
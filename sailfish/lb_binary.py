@@ -4,183 +4,215 @@ __author__ = 'Michal Januszewski'
 __email__ = 'sailfish-cfd@googlegroups.com'
 __license__ = 'GPL3'
 
-import numpy
+import numpy as np
 
-from sailfish import lbm, lb_single, sym
+from sailfish import sym, util
+from sailfish.lb_base import LBSim
+from sailfish.lb_single import GridError
+
+
+class BinaryFluidBase(LBSim):
+    """Base class for binary fluid simulations.
+
+    Two sets of distributions are used: the first one for the density field
+    (rho) and the second one for the order parameter field (phi).  Both
+    fields are accessed nonlocally by the collision kernel."""
 
-class BinaryFluidBase(lb_single.FluidLBMSim):
     kernel_file = 'binary_fluid.mako'
+    nonlocality = 1
+
+    @classmethod
+    def add_options(cls, group, dim):
+        LBSim.add_options(group, dim)
+
+        group.add_argument('--visc', type=float, default=1.0, help='numerical viscosity')
+        group.add_argument('--tau_phi', type=float, default=1.0,
+                help='relaxation time for the phi field')
+
+        grids = [x.__name__ for x in sym.KNOWN_GRIDS if x.dim == dim]
+        group.add_argument('--grid', help='LB grid', type=str,
+                choices=grids, default=grids[0])
+
+    def __init__(self, config):
+        super(BinaryFluidBase, self).__init__(config)
 
-    def __init__(self, geo_class, options=[], args=None, defaults=None):
-        super(BinaryFluidBase, self).__init__(geo_class, options, args, defaults)
+        grid = util.get_grid_from_config(config)
+
+        if grid is None:
+            raise GridError('Invalid grid selected: {0}'.format(config.grid))
+
+        self.grids = [grid, grid]
+        self._force_couplings = {}
+        self._force_term_for_eq = {}
         self._prepare_symbols()
-        self.add_nonlocal_field(0)
-        self.add_nonlocal_field(1)
 
-    def curr_dists(self):
-        if self.iter_ & 1:
-            return [self.gpu_dist1b, self.gpu_dist2b]
-        else:
-            return [self.gpu_dist1a, self.gpu_dist2a]
+    @property
+    def grid(self):
+        """Grid with the highest connectivity (Q)."""
+        return self.grids[0]
 
-    def _prepare_symbols(self):
-        self.S.alias('phi', self.S.g1m0)
+    @property
+    def constants(self):
+        """List of (name, value) pairs of constants used in the kernels."""
+        return []
 
-    def _init_fields(self, need_dist):
-        lbm.LBMSim._init_fields(self, need_dist)
-        self.phi = self.make_field('phi', True)
+    def add_force_coupling(self, grid_a, grid_b, const_name):
+        """Adds a Shan-Chen interaction between the fluid components.
 
-        if need_dist:
-            self.dist2 = self.make_dist(self.grid)
+        :param grid_a: number of the grid of the first component
+        :param grid_b: number of the grid of the second component
+        :param const_name: name of the constant holding the coupling strength
+        """
+        self._force_couplings[(grid_a, grid_b)] = const_name
 
-    def _init_compute_fields(self):
-        super(BinaryFluidBase, self)._init_compute_fields()
-        self.gpu_phi = self.backend.alloc_buf(like=self.phi)
-        self.gpu_mom0.append(self.gpu_phi)
+    def use_force_for_eq(self, force_grid, target_grid):
+        """Makes the equilibrium velocity of the `target_grid` component
+        include the acceleration acting on the `force_grid` component."""
+        self._force_term_for_eq[target_grid] = force_grid
 
-        if not self._ic_fields:
-            self.gpu_dist2a = self.backend.alloc_buf(like=self.dist2)
-            self.gpu_dist2b = self.backend.alloc_buf(like=self.dist2)
-        else:
-            self.gpu_dist2a = self.backend.alloc_buf(size=self.get_dist_bytes(self.grid), wrap_in_array=False)
-            self.gpu_dist2b = self.backend.alloc_buf(size=self.get_dist_bytes(self.grid), wrap_in_array=False)
-
-        self.img_rho = self.bind_nonlocal_field(self.gpu_rho, 0)
-        self.img_phi = self.bind_nonlocal_field(self.gpu_phi, 1)
-
-    def _init_compute_kernels(self):
-        cnp_args1n = [self.geo.gpu_map, self.gpu_dist1a, self.gpu_dist1b, self.gpu_dist2a,
-                      self.gpu_dist2b, self.gpu_rho, self.gpu_phi] + self.gpu_velocity + [numpy.uint32(0)]
-        cnp_args1s = [self.geo.gpu_map, self.gpu_dist1a, self.gpu_dist1b, self.gpu_dist2a,
-                      self.gpu_dist2b, self.gpu_rho, self.gpu_phi] + self.gpu_velocity + [numpy.uint32(1)]
-        cnp_args2n = [self.geo.gpu_map, self.gpu_dist1b, self.gpu_dist1a, self.gpu_dist2b,
-                      self.gpu_dist2a, self.gpu_rho, self.gpu_phi] + self.gpu_velocity + [numpy.uint32(0)]
-        cnp_args2s = [self.geo.gpu_map, self.gpu_dist1b, self.gpu_dist1a, self.gpu_dist2b,
-                      self.gpu_dist2a, self.gpu_rho, self.gpu_phi] + self.gpu_velocity + [numpy.uint32(1)]
-
-        macro_args1 = [self.geo.gpu_map, self.gpu_dist1a, self.gpu_dist2a, self.gpu_rho, self.gpu_phi]
-        macro_args2 = [self.geo.gpu_map, self.gpu_dist1b, self.gpu_dist2b, self.gpu_rho, self.gpu_phi]
-
-        k_block_size = self._kernel_block_size()
-        cnp_name = 'CollideAndPropagate'
-        macro_name = 'PrepareMacroFields'
-        fields = [self.img_rho, self.img_phi]
-
-        kern_cnp1n = self.backend.get_kernel(self.mod, cnp_name,
-                         args=cnp_args1n, args_format='P'*(len(cnp_args1n)-1)+'i',
-                         block=k_block_size, fields=fields)
-        kern_cnp1s = self.backend.get_kernel(self.mod, cnp_name,
-                         args=cnp_args1s, args_format='P'*(len(cnp_args1n)-1)+'i',
-                         block=k_block_size, fields=fields)
-        kern_cnp2n = self.backend.get_kernel(self.mod, cnp_name,
-                         args=cnp_args2n, args_format='P'*(len(cnp_args1n)-1)+'i',
-                         block=k_block_size, fields=fields)
-        kern_cnp2s = self.backend.get_kernel(self.mod, cnp_name,
-                         args=cnp_args2s, args_format='P'*(len(cnp_args1n)-1)+'i',
-                         block=k_block_size, fields=fields)
-        kern_mac1 = self.backend.get_kernel(self.mod, macro_name,
-                         args=macro_args1, args_format='P'*len(macro_args1),
-                         block=k_block_size)
-        kern_mac2 = self.backend.get_kernel(self.mod, macro_name,
-                         args=macro_args2, args_format='P'*len(macro_args2),
-                         block=k_block_size)
-
-        # For occupancy analysis in performance tests.
-        self._lb_kernel = kern_cnp1n
-
-        # Map: iteration parity -> kernel arguments to use.
-        self.kern_map = {
-            0: (kern_mac1, kern_cnp1n, kern_cnp1s),
-            1: (kern_mac2, kern_cnp2n, kern_cnp2s),
-        }
+    def _prepare_symbols(self):
+        self.S.alias('phi', self.S.g1m0)
+
+    def update_context(self, ctx):
+        super(BinaryFluidBase, self).update_context(ctx)
+        ctx['tau'] = (6.0 * self.config.visc + 1.0)/2.0
+        ctx['visc'] = self.config.visc
+        ctx['tau_phi'] = self.config.tau_phi
+        ctx['model'] = getattr(self.config, 'model', 'bgk')
+        ctx['loc_names'] = ['gx', 'gy', 'gz']
+        ctx['grid'] = self.grid
+        ctx['grids'] = self.grids
+        ctx['bgk_equilibrium'] = self.equilibrium
+        ctx['bgk_equilibrium_vars'] = self.equilibrium_vars
+        ctx['constants'] = self.constants
+
+        ctx['relaxation_enabled'] = self.config.relaxation_enabled
+        ctx.setdefault('forces', {})
+        ctx['force_couplings'] = self._force_couplings
+        ctx['force_for_eq'] = self._force_term_for_eq
+        ctx['image_fields'] = set()
+
+    def init_fields(self, runner):
+        self.rho = runner.make_scalar_field(name='rho', async=True)
+        self.phi = runner.make_scalar_field(name='phi', async=True)
+        self.v = runner.make_vector_field(name='v', async=True)
 
         if self.grid.dim == 2:
-            self.kern_grid_size = (self.arr_nx/self.options.block_size, self.arr_ny)
-        else:
-            self.kern_grid_size = (self.arr_nx/self.options.block_size * self.arr_ny, self.arr_nz)
-
-    def _init_compute_ic(self):
-        if not self._ic_fields:
-            # Nothing to do, the initial distributions have already been
-            # set and copied to the GPU in _init_compute_fields.
-            return
-
-        args1 = [self.gpu_dist1a, self.gpu_dist2a] + self.gpu_velocity + [self.gpu_rho, self.gpu_phi]
-        args2 = [self.gpu_dist1b, self.gpu_dist2b] + self.gpu_velocity + [self.gpu_rho, self.gpu_phi]
-
-        kern1 = self.backend.get_kernel(self.mod, 'SetInitialConditions',
-                    args=args1,
-                    args_format='P'*len(args1),
-                    block=self._kernel_block_size())
-
-        kern2 = self.backend.get_kernel(self.mod, 'SetInitialConditions',
-                    args=args2,
-                    args_format='P'*len(args2),
-                    block=self._kernel_block_size())
-
-        self.backend.run_kernel(kern1, self.kern_grid_size)
-        self.backend.run_kernel(kern2, self.kern_grid_size)
-        self.backend.sync()
-
-    def _lbm_step(self, get_data, **kwargs):
-        kerns = self.kern_map[self.iter_ & 1]
-
-        self.backend.run_kernel(kerns[0], self.kern_grid_size)
-        self.backend.sync()
-
-        if get_data:
-            self.backend.run_kernel(kerns[2], self.kern_grid_size)
-            self.backend.sync()
-            self.hostsync_velocity()
-            self.hostsync_density()
-            self.backend.from_buf(self.gpu_phi)
-            self.backend.sync()
+            self.vx, self.vy = self.v
+            runner.add_visualization_field(
+                    lambda: np.square(self.vx) + np.square(self.vy),
+                    name='v^2')
         else:
-            self.backend.run_kernel(kerns[1], self.kern_grid_size)
+            self.vx, self.vy, self.vz = self.v
+            runner.add_visualization_field(
+                    lambda: np.square(self.vx) + np.square(self.vy) +
+                    np.square(self.vz), name='v^2')
+
+    def nonlocal_fields(self):
+        return [self.rho, self.phi]
+
+    def initial_conditions(self, runner):
+        gpu_rho = runner.gpu_field(self.rho)
+        gpu_phi = runner.gpu_field(self.phi)
+        gpu_v = runner.gpu_field(self.v)
+
+        for i in (0, 1):
+            args = ([runner.gpu_dist(0, i), runner.gpu_dist(1, i)] + gpu_v +
+                    [gpu_rho, gpu_phi])
+            runner.exec_kernel('SetInitialConditions', args, 'P'*len(args))
+
+    def get_prepare_kernels(self, runner):
+        gpu_rho = runner.gpu_field(self.rho)
+        gpu_phi = runner.gpu_field(self.phi)
+        gpu_map = runner.gpu_geo_map()
+
+        kernels = []
+        for i in (0, 1):
+            args = [gpu_map, runner.gpu_dist(0, i), runner.gpu_dist(1, i),
+                    gpu_rho, gpu_phi]
+            kernels.append(runner.get_kernel('PrepareMacroFields', args,
+                'P'*len(args)))
+        return kernels
+
+    def get_compute_kernels(self, runner, full_output, bulk):
+        """
+        Args:
+          full_output: if True, returns kernels that prepare fields for
+              visualization or saving into a file
+        """
+        gpu_rho = runner.gpu_field(self.rho)
+        gpu_phi = runner.gpu_field(self.phi)
+        gpu_v = runner.gpu_field(self.v)
+        gpu_map = runner.gpu_geo_map()
+
+        options = 0
+        if full_output:
+            options |= 1
+        if bulk:
+            options |= 2
+
+        kernels = []
+        for i in (0, 1):
+            args = ([gpu_map, runner.gpu_dist(0, i), runner.gpu_dist(0, 1-i),
+                     runner.gpu_dist(1, i), runner.gpu_dist(1, 1-i),
+                     gpu_rho, gpu_phi] + gpu_v + [np.uint32(options)])
+            kernels.append(runner.get_kernel(
+                    'CollideAndPropagate', args, 'P'*(len(args)-1)+'i'))
+        return kernels
+
+    def get_pbc_kernels(self, runner):
+        kernels = []
+        for grid_id in range(0, len(self.grids)):
+            for copy in (0, 1):
+                gpu_dist = runner.gpu_dist(grid_id, copy)
+                for i in range(0, 3):
+                    kernels.append(runner.get_kernel(
+                        'ApplyPeriodicBoundaryConditions',
+                        [gpu_dist, np.uint32(i)], 'Pi'))
+
+        return kernels
+
 
 class BinaryFluidFreeEnergy(BinaryFluidBase):
+    """Binary liquid model based on the free energy approach."""
+
+    @classmethod
+    def add_options(cls, group, dim):
+        BinaryFluidBase.add_options(group, dim)
+
+        group.add_argument('--model', help='LB model to use', type=str,
+                choices=['bgk', 'femrt'], default='bgk')
+        group.add_argument('--bc_wall_grad_phase', type=float, default=0.0,
+                help='gradient of the phase field at the wall; this '
+                'determines the wetting properties')
+        group.add_argument('--bc_wall_grad_order', type=int, default=2,
+                choices=[1, 2], help='order of the gradient stencil used for '
+                'the wetting boundary condition at the walls')
+        group.add_argument('--Gamma', type=float, default=0.5,
+                help='Gamma parameter')
+        group.add_argument('--kappa', type=float, default=0.5,
+                help='kappa parameter')
+        group.add_argument('--A', type=float, default=0.5, help='A parameter')
+        group.add_argument('--tau_a', type=float, default=1.0,
+                help='relaxation time for the A component')
+        group.add_argument('--tau_b', type=float, default=1.0,
+                help='relaxation time for the B component')
+
     @property
     def constants(self):
-        return [('Gamma', self.options.Gamma), ('A', self.options.A), ('kappa', self.options.kappa),
-                ('tau_a', self.options.tau_a), ('tau_b', self.options.tau_b)]
+        return [('Gamma', self.config.Gamma), ('A', self.config.A),
+                ('kappa', self.config.kappa), ('tau_a', self.config.tau_a),
+                ('tau_b', self.config.tau_b)]
 
-    def __init__(self, geo_class, options=[], args=None, defaults=None):
-        super(BinaryFluidFreeEnergy, self).__init__(geo_class, options, args, defaults)
+    def __init__(self, config):
+        super(BinaryFluidFreeEnergy, self).__init__(config)
         self.equilibrium, self.equilibrium_vars = sym.free_energy_binary_liquid_equilibrium(self)
 
-    def _add_options(self, parser, lb_group):
-        super(BinaryFluidFreeEnergy, self)._add_options(parser, lb_group)
-
-        lb_group.add_option('--bc_wall_grad_phase', dest='bc_wall_grad_phase',
-            type='float', default=0.0, help='gradient of the phase field at '
-            'the wall; this determines the wetting properties')
-        lb_group.add_option('--bc_wall_grad_order', dest='bc_wall_grad_order', type='int',
-            default=2, help='order of the gradient stencil used for the '
-            'wetting boundary condition at the walls; valid values are 1 and 2')
-        lb_group.add_option('--Gamma', dest='Gamma',
-            help='Gamma parameter', action='store', type='float',
-            default=0.5)
-        lb_group.add_option('--kappa', dest='kappa',
-            help='kappa parameter', action='store', type='float',
-            default=0.5)
-        lb_group.add_option('--A', dest='A',
-            help='A parameter', action='store', type='float',
-            default=0.5)
-        lb_group.add_option('--tau_phi', dest='tau_phi', help='relaxation time for the phi field',
-                            action='store', type='float', default=1.0)
-        lb_group.add_option('--tau_a', dest='tau_a', help='relaxation time for the A component',
-                            action='store', type='float', default=1.0)
-        lb_group.add_option('--tau_b', dest='tau_b', help='relaxation time for the B component',
-                            action='store', type='float', default=1.0)
-        return None
-
-    def _update_ctx(self, ctx):
-        super(BinaryFluidFreeEnergy, self)._update_ctx(ctx)
-        ctx['grids'] = [self.grid, self.grid]
-        ctx['tau_phi'] = self.options.tau_phi
+    def update_context(self, ctx):
+        super(BinaryFluidFreeEnergy, self).update_context(ctx)
         ctx['simtype'] = 'free-energy'
-        ctx['bc_wall_grad_phase'] = self.options.bc_wall_grad_phase
-        ctx['bc_wall_grad_order'] = self.options.bc_wall_grad_order
+        ctx['bc_wall_grad_phase'] = self.config.bc_wall_grad_phase
+        ctx['bc_wall_grad_order'] = self.config.bc_wall_grad_order
 
     def _prepare_symbols(self):
         """Additional symbols and coefficients for the free-energy binary liquid model."""
@@ -268,40 +300,28 @@ class BinaryFluidFreeEnergy(BinaryFluidBase):
                     self.S.wyy.append(-Rational(1, 24))
 
 
-    def _init_fields(self, need_dist):
-        super(BinaryFluidFreeEnergy, self)._init_fields(need_dist)
-        self.vis.add_field((lambda: self.rho + self.phi, lambda: self.rho - self.phi), 'density')
+class ShanChenBinary(BinaryFluidBase):
+    """Binary fluid with a Shan-Chen interaction between the components."""
+
+    @classmethod
+    def add_options(cls, group, dim):
+        BinaryFluidBase.add_options(group, dim)
 
+        group.add_argument('--G', type=float, default=1.0,
+                help='Shan-Chen interaction strength')
 
-class ShanChenBinary(BinaryFluidBase):
     @property
     def constants(self):
-        return [('SCG', self.options.G)]
+        return [('SCG', self.config.G)]
 
-    def __init__(self, geo_class, options=[], args=None, defaults=None):
-        super(ShanChenBinary, self).__init__(geo_class, options, args, defaults)
+    def __init__(self, config):
+        super(ShanChenBinary, self).__init__(config)
         self.equilibrium, self.equilibrium_vars = sym.bgk_equilibrium(self.grid)
         eq2, _ = sym.bgk_equilibrium(self.grid, self.S.phi, self.S.phi)
         self.equilibrium.append(eq2[0])
         self.add_force_coupling(0, 1, 'SCG')
 
-    def _init_fields(self, need_dist):
-        super(ShanChenBinary, self)._init_fields(need_dist)
-        self.vis.add_field((lambda: self.rho, lambda: self.phi), 'density')
-
-    def _add_options(self, parser, lb_group):
-        super(ShanChenBinary, self)._add_options(parser, lb_group)
-
-        lb_group.add_option('--G', dest='G',
-            help='Shan-Chen interaction strength', action='store', type='float',
-            default=1.0)
-        lb_group.add_option('--tau_phi', dest='tau_phi', help='relaxation time for the phi field',
-                            action='store', type='float', default=1.0)
-        return None
-
-    def _update_ctx(self, ctx):
-        super(ShanChenBinary, self)._update_ctx(ctx)
-        ctx['grids'] = [self.grid, self.grid]
-        ctx['tau_phi'] = self.options.tau_phi
+    def update_context(self, ctx):
+        super(ShanChenBinary, self).update_context(ctx)
         ctx['simtype'] = 'shan-chen'
         ctx['sc_pseudopotential'] = 'sc_ppot_lin'
@@ -42,6 +42,20 @@ class LBForcedSim(LBSim):
         a = self._forces[grid][accel] + np.float64(force)
         self._forces[grid][accel] = a
 
+    def body_force_accel(self, rho):
+        # Forces and accelerations acting on the first grid, combined in the
+        # same way as in the compute kernels (see sym.body_force_accel()).
+        forces = self._forces.get(0)
+        if not forces:
+            return None
+
+        accel = np.zeros((rho.size, self.grids[0].dim), dtype=rho.dtype)
+        if True in forces:
+            accel += forces[True]
+        if False in forces:
+            accel += forces[False] / rho[:, np.newaxis]
+        return accel
+
     def update_context(self, ctx):
         super(LBForcedSim, self).update_context(ctx)
         ctx['forces'] = self._forces
@@ -61,8 +75,17 @@ class LBFluidSim(LBSim):
                 action='store_true', default=False,
                 help='use the incompressible model of Luo and He')
         group.add_argument('--model', help='LB model to use',
-                type=str, choices=['bgk', 'mrt'],
+                type=str, choices=['bgk', 'mrt', 'trt'],
                 default='bgk')
+        group.add_argument('--trt_magic', type=float, default=0.25,
+                help='magic parameter Lambda of the TRT model; 1/4 '
+                     'maximizes stability, 3/16 places bounce-back walls '
+                     'exactly halfway between nodes')
+        group.add_argument('--separate_output', action='store_true',
+                default=False,
+                help='compute the macroscopic fields in a separate kernel '
+                     'run only when output is requested, so that the '
+                     'collision kernel never saves them')
         group.add_argument('--subgrid', default='none', type=str,
                 choices=['none', 'les-smagorinsky'],
                 help='subgrid model to use')
@@ -94,6 +117,8 @@ class LBFluidSim(LBSim):
         ctx['tau'] = (6.0 * self.config.visc + 1.0)/2.0
         ctx['visc'] = self.config.visc
         ctx['model'] = self.config.model
+        ctx['trt_magic'] = self.config.trt_magic
+        ctx['separate_output'] = self.config.separate_output
         ctx['loc_names'] = ['gx', 'gy', 'gz']
         ctx['simtype'] = 'lbm'
         ctx['grid'] = self.grid
@@ -149,6 +174,21 @@ class LBFluidSim(LBSim):
                 'CollideAndPropagate', args2, 'P'*(len(args2)-1)+'i'))
         return kernels
 
+    def get_macro_kernels(self, runner):
+        if not self.config.separate_output:
+            return None
+
+        gpu_rho = runner.gpu_field(self.rho)
+        gpu_v = runner.gpu_field(self.v)
+        gpu_map = runner.gpu_geo_map()
+
+        kernels = []
+        for i in (0, 1):
+            args = [gpu_map, runner.gpu_dist(0, i)] + gpu_v + [gpu_rho]
+            kernels.append(runner.get_kernel('ComputeMacroFields', args,
+                'P'*len(args)))
+        return kernels
+
     def get_pbc_kernels(self, runner):
         gpu_dist1a = runner.gpu_dist(0, 0)
         gpu_dist1b = runner.gpu_dist(0, 1)
@@ -0,0 +1,166 @@
+"""Live performance metrics for running simulations.
+
+Block runners publish their metrics over a ZMQ PUB socket.  The controller
+collects them and serves the latest values in the Prometheus text format
+over HTTP.
+"""
+
+__author__ = 'Michal Januszewski'
+__email__ = 'sailfish-cfd@googlegroups.com'
+__license__ = 'LGPL3'
+
+import BaseHTTPServer
+import threading
+import time
+import zmq
+
+# Name, help string and type of all per-block metrics.
+_METRICS = [
+    ('iteration', 'Current iteration of the block.', 'gauge'),
+    ('mlups', 'Million lattice updates per second.', 'gauge'),
+    ('halo_wait_seconds', 'Average time per iteration spent waiting for '
+        'data from neighboring blocks.', 'gauge'),
+    ('output_seconds', 'Average time per iteration spent saving output.',
+        'gauge'),
+]
+
+
+class MetricsPublisher(object):
+    """Publishes performance metrics of a single block."""
+
+    def __init__(self, ctx, addr, block_id, num_nodes):
+        self._sock = ctx.socket(zmq.PUB)
+        self._sock.connect(addr)
+        self._block_id = block_id
+        self._num_nodes = num_nodes
+        self.reset(0)
+
+    def reset(self, iteration):
+        self._last_iteration = iteration
+        self._last_time = time.time()
+        self._wait = 0.0
+        self._output = 0.0
+
+    def add_wait(self, t):
+        self._wait += t
+
+    def add_output(self, t):
+        self._output += t
+
+    def publish(self, iteration):
+        """Sends metrics averaged since the last call and starts a new
+        averaging period."""
+        iters = iteration - self._last_iteration
+        dt = time.time() - self._last_time
+        if iters <= 0 or dt <= 0.0:
+            return
+
+        self._sock.send_pyobj({
+            'block': self._block_id,
+            'iteration': iteration,
+            'mlups': self._num_nodes * iters / dt * 1e-6,
+            'halo_wait_seconds': self._wait / iters,
+            'output_seconds': self._output / iters})
+        self.reset(iteration)
+
+    def close(self):
+        self._sock.close(linger=0)
+
+
+class MetricsCollector(object):
+    """Receives metrics from all block runners and serves them over HTTP."""
+
+    def __init__(self, ctx, http_port):
+        self._ctx = ctx
+        #: Address to which the block runners should connect.  Available
+        #: after start() returns.
+        self.addr = None
+        self._http_port = http_port
+        self._latest = {}
+        self._lock = threading.Lock()
+        self._bound = threading.Event()
+        self._quit = threading.Event()
+        self._httpd = None
+        self._threads = []
+
+    def update(self, metrics):
+        self._lock.acquire()
+        self._latest[metrics['block']] = metrics
+        self._lock.release()
+
+    def render(self):
+        """Returns the latest metrics in the Prometheus text format."""
+        self._lock.acquire()
+        latest = dict(self._latest)
+        self._lock.release()
+
+        lines = []
+        for name, help_, type_ in _METRICS:
+            lines.append('# HELP sailfish_{0} {1}'.format(name, help_))
+            lines.append('# TYPE sailfish_{0} {1}'.format(name, type_))
+            for block_id, metrics in sorted(latest.iteritems()):
+                lines.append('sailfish_{0}{{block="{1}"}} {2!r}'.format(
+                    name, block_id, metrics[name]))
+
+        if latest:
+            lines.append('# HELP sailfish_mlups_total Sum of MLUPS over all '
+                    'blocks.')
+            lines.append('# TYPE sailfish_mlups_total gauge')
+            lines.append('sailfish_mlups_total {0!r}'.format(
+                sum(x['mlups'] for x in latest.itervalues())))
+            lines.append('# HELP sailfish_iteration_min Iteration of the '
+                    'slowest block.')
+            lines.append('# TYPE sailfish_iteration_min gauge')
+            lines.append('sailfish_iteration_min {0}'.format(
+                min(x['iteration'] for x in latest.itervalues())))
+
+        return '\n'.join(lines) + '\n'
+
+    def _receive(self):
+        # ZMQ sockets are not thread-safe, so the socket is only ever used
+        # from within this thread.
+        sock = self._ctx.socket(zmq.SUB)
+        sock.setsockopt(zmq.SUBSCRIBE, '')
+        port = sock.bind_to_random_port('tcp://127.0.0.1')
+        self.addr = 'tcp://127.0.0.1:{0}'.format(port)
+        self._bound.set()
+
+        poller = zmq.Poller()
+        poller.register(sock, zmq.POLLIN)
+        while not self._quit.is_set():
+            if poller.poll(100):
+                self.update(sock.recv_pyobj())
+        sock.close()
+
+    def _make_handler(self):
+        collector = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = collector.render()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self._httpd = BaseHTTPServer.HTTPServer(('127.0.0.1', self._http_port),
+                self._make_handler())
+        for target in (self._receive, self._httpd.serve_forever):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        self._bound.wait()
+
+    def stop(self):
+        self._quit.set()
+        self._httpd.shutdown()
+        for thread in self._threads:
+            thread.join()
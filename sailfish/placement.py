@@ -0,0 +1,194 @@
+"""Assignment of blocks to computational devices."""
+
+__author__ = 'Michal Januszewski'
+__email__ = 'sailfish-cfd@googlegroups.com'
+__license__ = 'LGPL3'
+
+from collections import defaultdict
+
+
+def connectivity_graph(blocks):
+    """Returns the block connectivity graph as a dict mapping pairs of block
+    IDs (lower ID first) to the number of elements exchanged between the two
+    blocks in a single step."""
+    graph = defaultdict(int)
+    for block in blocks:
+        for face, nbid in block.connecting_blocks():
+            cpair = block.get_connection(face, nbid)
+            graph[(min(block.id, nbid), max(block.id, nbid))] += \
+                    cpair.src.elements
+    return dict(graph)
+
+def cut_size(graph, block2dev):
+    """Returns the number of elements exchanged between different devices
+    in a single step."""
+    return sum(w for (b1, b2), w in graph.iteritems()
+            if block2dev[b1] != block2dev[b2])
+
+def round_robin(blocks, devices, graph=None, imbalance=None):
+    """Assigns blocks to devices in the order in which they are listed,
+    ignoring their connectivity."""
+    return dict((block.id, devices[i % len(devices)]) for i, block in
+            enumerate(blocks))
+
+def _adjacency(blocks, graph):
+    adj = dict((block.id, {}) for block in blocks)
+    for (b1, b2), w in graph.iteritems():
+        adj[b1][b2] = w
+        adj[b2][b1] = w
+    return adj
+
+def _grow_partitions(weights, adj, k):
+    """Splits the graph into k parts by growing them one at a time from
+    a peripheral seed block, always adding the unassigned block with the
+    strongest connection to the current part."""
+    ids = sorted(weights.keys())
+    target = sum(weights.itervalues()) / float(k)
+    unassigned = set(ids)
+    part = {}
+
+    for p in range(0, k - 1):
+        load = 0
+        # Maps unassigned block IDs to the strength of their connection to
+        # the current part.
+        frontier = {}
+        # Leave at least one block for every remaining part.
+        while len(unassigned) > k - 1 - p:
+            if frontier:
+                bid = max(frontier, key=lambda x: (frontier[x], -x))
+            else:
+                # Start from the block least connected to other unassigned
+                # blocks, which will typically lie on the edge of the domain.
+                bid = min(unassigned, key=lambda x: (sum(w for nb, w in
+                    adj[x].iteritems() if nb in unassigned), x))
+
+            # Stop when adding the block would take us further away from the
+            # target load than we are now.
+            if load > 0 and load + weights[bid] - target > target - load:
+                break
+
+            frontier.pop(bid, None)
+            unassigned.remove(bid)
+            part[bid] = p
+            load += weights[bid]
+            for nb, w in adj[bid].iteritems():
+                if nb in unassigned:
+                    frontier[nb] = frontier.get(nb, 0) + w
+
+    for bid in unassigned:
+        part[bid] = k - 1
+
+    return part
+
+def _refine_partitions(part, weights, adj, k, imbalance, max_passes=10):
+    """Moves blocks on the boundaries between parts to reduce the cut,
+    as long as the load of every part does not exceed the target load by
+    more than 'imbalance'.  Moves which do not change the cut are only
+    made if they improve the load balance."""
+    loads = [0] * k
+    sizes = [0] * k
+    for bid, p in part.iteritems():
+        loads[p] += weights[bid]
+        sizes[p] += 1
+    max_load = max((1.0 + imbalance) * sum(loads) / float(k), max(loads))
+
+    for i in range(0, max_passes):
+        moved = False
+        for bid in sorted(part.keys()):
+            src = part[bid]
+            if sizes[src] == 1:
+                continue
+
+            conn = defaultdict(int)
+            for nb, w in adj[bid].iteritems():
+                conn[part[nb]] += w
+
+            best = None
+            for dst in sorted(conn.keys()):
+                if dst == src or loads[dst] + weights[bid] > max_load:
+                    continue
+                gain = conn[dst] - conn[src]
+                if gain < 0 or (gain == 0 and
+                        loads[dst] + weights[bid] >= loads[src]):
+                    continue
+                if best is None or gain > best[0]:
+                    best = (gain, dst)
+
+            if best is not None:
+                dst = best[1]
+                part[bid] = dst
+                loads[src] -= weights[bid]
+                loads[dst] += weights[bid]
+                sizes[src] -= 1
+                sizes[dst] += 1
+                moved = True
+
+        if not moved:
+            break
+
+    return part
+
+def _partition(blocks, graph, weights, k, imbalance):
+    adj = _adjacency(blocks, graph)
+    part = _grow_partitions(weights, adj, k)
+    return _refine_partitions(part, weights, adj, k, imbalance)
+
+def topology(blocks, devices, graph, imbalance=0.05):
+    """Assigns blocks to devices so that the number of nodes on every device
+    is balanced and the amount of data exchanged between blocks on different
+    devices is minimized.
+
+    :param graph: block connectivity graph, see connectivity_graph()
+    :param imbalance: maximum allowed relative excess of the number of nodes
+        on a single device over the average
+    """
+    k = len(devices)
+    if k == 1 or len(blocks) <= k:
+        return round_robin(blocks, devices)
+
+    weights = dict((block.id, block.num_nodes) for block in blocks)
+    part = _partition(blocks, graph, weights, k, imbalance)
+    return dict((bid, devices[p]) for bid, p in part.iteritems())
+
+def rebalance(blocks, block2dev, devices, graph, weights, imbalance=0.05):
+    """Returns a new assignment of blocks to devices, balancing the total
+    weight of the blocks on every device.
+
+    The blocks are partitioned as in topology(), and the parts are then
+    matched with the devices so that the number of nodes which have to be
+    migrated to a different device is small.
+
+    :param block2dev: current assignment of blocks to devices
+    :param weights: dict mapping block IDs to their computational cost
+    :param imbalance: maximum allowed relative excess of the weight of the
+        blocks on a single device over the average
+    """
+    k = len(devices)
+    if k == 1 or len(blocks) <= k:
+        return dict(block2dev)
+
+    part = _partition(blocks, graph, weights, k, imbalance)
+
+    # Number of nodes of every part already present on every device.
+    overlap = defaultdict(int)
+    for block in blocks:
+        overlap[(part[block.id], block2dev[block.id])] += block.num_nodes
+
+    part2dev = {}
+    for (p, dev) in sorted(overlap, key=lambda x: (-overlap[x], x)):
+        if p not in part2dev and dev not in part2dev.values():
+            part2dev[p] = dev
+
+    free = [dev for dev in devices if dev not in part2dev.values()]
+    for p in range(0, k):
+        if p not in part2dev:
+            part2dev[p] = free.pop(0)
+
+    return dict((bid, part2dev[p]) for bid, p in part.iteritems())
+
+# Maps names of placement methods to functions taking the same arguments as
+# topology().
+methods = {
+    'round_robin': round_robin,
+    'topology': topology,
+}
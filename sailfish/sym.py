@@ -6,7 +6,10 @@ __license__ = 'GPL3'
 
 import copy
 from collections import namedtuple
+import hashlib
+import json
 import operator
+import os
 from operator import itemgetter
 import math
 import numpy
@@ -31,7 +34,40 @@ TargetDist = namedtuple('TargetDist', 'var idx')
 # information about the grid.
 #
 
+# Grid attributes computed in _prepare_grid().
+_DERIVED_GRID_ATTRS = set(['idx_name', 'idx_opposite', 'v', 'dir2vecidx',
+    'vecidx2dir', 'mrt_basis', 'mrt_matrix', 'mrt_equilibrium',
+    'mrt_collision'])
+
+class _GridMeta(type):
+    """Metaclass for grid classes.  Prepares the derived grid data on first
+    access to any of its attributes, so that only grids which are actually
+    used have to be processed."""
+
+    def __init__(cls, name, bases, dct):
+        super(_GridMeta, cls).__init__(name, bases, dct)
+        cls._prepared = False
+        cls._preparing = False
+        # The collision coefficients are completed in _init_mrt_equilibrium.
+        # Keep the initial values so that the final ones are only visible
+        # once the grid is prepared.
+        if 'mrt_collision' in dct:
+            cls._mrt_collision_init = dct['mrt_collision']
+            del cls.mrt_collision
+
+    def __getattr__(cls, name):
+        # Attributes which are not set yet while the grid is being prepared
+        # are missing, instead of starting the preparation again.
+        if (name in _DERIVED_GRID_ATTRS and not cls._prepared and
+                not cls._preparing):
+            _prepare_grid(cls)
+            return getattr(cls, name)
+        raise AttributeError(name)
+
+
 class DxQy(object):
+    __metaclass__ = _GridMeta
+
     vx = Symbol('vx')
     vy = Symbol('vy')
     vz = Symbol('vz')
@@ -49,7 +85,7 @@ class DxQy(object):
         if model == 'mrt':
             return hasattr(cls, 'mrt_matrix')
         # The D3Q13 grid only supports MRT.
-        elif model == 'bgk':
+        elif model == 'bgk' or model == 'trt':
             return (cls.Q != 13 or cls.dim != 3)
         else:
             return True
@@ -878,23 +914,27 @@ def get_prop_dists(grid, dir_, axis=0):
 
     return ret
 
+# Maps (grid name, direction, opposite) to a list of distribution indices.
+_interblock_dists_cache = {}
+
 def get_interblock_dists(grid, direction, opposite=False):
     """Computes a list of indices of the distributions that would be transferred
     to a node pointed to by the vector 'direction'.
     """
-    d = Matrix((direction,))
-
-    def process_dists(dists):
+    d = [int(x) for x in direction]
+    key = (grid.__name__, tuple(d), opposite)
+    if key not in _interblock_dists_cache:
+        # Plain integer arithmetic is used here, as this is called for
+        # every connection between blocks.
+        d2 = sum(x * x for x in d)
+        ret = []
+        for i, ei in enumerate(grid.basis):
+            if sum(int(x) * y for x, y in zip(ei, d)) >= d2:
+                ret.append(i)
         if opposite:
-            return [grid.idx_opposite[x] for x in dists]
-        else:
-            return dists
-
-    ret = []
-    for i, ei in enumerate(grid.basis):
-        if ei.dot(d) >= d.dot(d):
-            ret.append(i)
-    return process_dists(ret)
+            ret = [grid.idx_opposite[x] for x in ret]
+        _interblock_dists_cache[key] = ret
+    return list(_interblock_dists_cache[key])
 
 
 #
@@ -1000,6 +1040,86 @@ class KernelCodePrinter(CCodePrinter):
         else:
             return super(KernelCodePrinter, self)._print_Function(expr)
 
+class CexprCache(object):
+    """Memoizes the C code generated by cexpr().
+
+    Results are kept in memory, keyed on the expression and the conversion
+    flags.  Optionally, they can also be stored in a file, so that they can
+    be reused by other processes and in subsequent runs.
+    """
+
+    def __init__(self):
+        self._mem = {}
+        self._disk = {}
+        self._path = None
+        self._dirty = False
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, path):
+        """Enables the on-disk store and loads its contents."""
+        self._path = path
+        try:
+            f = open(path, 'r')
+            self._disk.update(json.load(f))
+            f.close()
+        except (IOError, ValueError):
+            pass
+
+    def save(self):
+        """Writes new entries to the on-disk store, if one is enabled."""
+        if self._path is None or not self._dirty:
+            return
+
+        # Merge with entries saved by other processes in the meantime.
+        disk = dict(self._disk)
+        self.load(self._path)
+        self._disk.update(disk)
+
+        tmp_path = '{0}.{1}'.format(self._path, os.getpid())
+        try:
+            f = open(tmp_path, 'w')
+            json.dump(self._disk, f)
+            f.close()
+            os.rename(tmp_path, self._path)
+            self._dirty = False
+        except (IOError, OSError):
+            pass
+
+    def _disk_key(self, key):
+        return sympy.srepr(key[0]) + repr(key[1:])
+
+    def lookup(self, key):
+        """Returns the cached code or None."""
+        try:
+            ret = self._mem.get(key)
+        except TypeError:
+            # Unhashable expression, e.g. a Matrix.
+            return None
+
+        if ret is None and self._path is not None:
+            ret = self._disk.get(self._disk_key(key))
+            if ret is not None:
+                self._mem[key] = ret
+
+        if ret is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return ret
+
+    def store(self, key, code):
+        try:
+            self._mem[key] = code
+        except TypeError:
+            return
+
+        if self._path is not None:
+            self._disk[self._disk_key(key)] = code
+            self._dirty = True
+
+cexpr_cache = CexprCache()
+
 def cexpr(sim, incompressible, pointers, ex, rho, aliases=True, vectors=False,
           phi=None):
     """Convert a SymPy expression into a string containing valid C code.
@@ -1022,6 +1142,19 @@ def cexpr(sim, incompressible, pointers, ex, rho, aliases=True, vectors=False,
         t = '%.20e' % t
         return make_float(t)
 
+    key = (ex, incompressible, pointers, rho, aliases and S.aliases_key,
+           vectors, phi)
+    ret = cexpr_cache.lookup(key)
+    if ret is not None:
+        return ret
+
+    t = _cexpr_subs(S, t, incompressible, rho, aliases, phi)
+    t = _cexpr_print(t, pointers, vectors)
+    cexpr_cache.store(key, t)
+    return t
+
+def _cexpr_subs(S, t, incompressible, rho, aliases, phi):
+    """Performs the symbol substitutions of cexpr()."""
     if type(rho) is str:
         rho = Symbol(rho)
         t = t.subs(S.rho, rho)
@@ -1041,6 +1174,11 @@ def cexpr(sim, incompressible, pointers, ex, rho, aliases=True, vectors=False,
         for src, dst in S.aliases.iteritems():
             t = t.subs(src, dst)
 
+    return t
+
+def _cexpr_print(t, pointers, vectors):
+    """Converts a sympy expression with all substitutions already done
+    into C code."""
     t = KernelCodePrinter().doprint(t)
     if pointers:
         t = use_pointers(t)
@@ -1049,8 +1187,70 @@ def cexpr(sim, incompressible, pointers, ex, rho, aliases=True, vectors=False,
     if vectors:
         t = use_vectors(t)
 
-    t = make_float(t)
-    return t
+    return make_float(t)
+
+def count_flops(ex):
+    """Returns a static estimate of the number of floating point operations
+    necessary to evaluate a sympy expression.
+
+    Every addition, multiplication and division counts as a single
+    operation, as does every function call.  Integer powers are counted
+    as a sequence of multiplications.
+    """
+    if not isinstance(ex, sympy.Basic) or ex.is_Atom:
+        return 0
+
+    ret = sum(count_flops(x) for x in ex.args)
+    if ex.is_Add or ex.is_Mul:
+        ret += len(ex.args) - 1
+    elif ex.is_Pow and ex.exp.is_Integer:
+        ret += abs(int(ex.exp)) - 1
+        if ex.exp < 0:
+            ret += 1
+    else:
+        ret += 1
+    return ret
+
+# Static FLOP counts of the expressions processed by cse_cexpr(), indexed by
+# the kernel name.  Every entry is a [with CSE, without CSE] list.
+kernel_flops = {}
+
+def cse_cexpr(sim, incompressible, exprs, prefix, kernel, enabled=True,
+              rho=None, pointers=False, vectors=False, phi=None):
+    """Converts a list of sympy expressions into C code, hoisting common
+    subexpressions into temporary variables.
+
+    :param exprs: iterable of sympy expressions to convert
+    :param prefix: prefix for the names of the temporary variables
+    :param kernel: name of the kernel the expressions are a part of; used
+        to collect FLOP counts in :data:`kernel_flops`
+    :param enabled: if ``False``, no subexpressions are eliminated
+
+    The remaining parameters have the same meaning as in :func:`cexpr`.
+
+    :rtype: tuple of: a list of (name, C code) pairs for the temporary
+        variables, and a list of C code strings corresponding to `exprs`
+    """
+    S = sim.S
+    exprs = [_cexpr_subs(S, sympy.sympify(x), incompressible, rho, True, phi)
+             for x in exprs]
+    flops = sum(count_flops(x) for x in exprs)
+
+    if enabled:
+        temps, exprs = sympy.cse(exprs,
+                symbols=sympy.cse_main.numbered_symbols(prefix))
+        cse_flops = (sum(count_flops(x) for _, x in temps) +
+                     sum(count_flops(x) for x in exprs))
+    else:
+        temps = []
+        cse_flops = flops
+
+    counts = kernel_flops.setdefault(kernel, [0, 0])
+    counts[0] += cse_flops
+    counts[1] += flops
+
+    return ([(str(name), _cexpr_print(x, pointers, vectors)) for name, x in temps],
+            [_cexpr_print(x, pointers, vectors) for x in exprs])
 
 def _gcd(a,b):
     while b:
@@ -1127,95 +1327,243 @@ def orthogonalize(*vectors):
         ret.append(x)
     return ret
 
-def _prepare_grids():
-    """Decorate grid classes with useful info computable from the basic definitions
-    of the grids.
+def _grid_cache_path(grid):
+    """Returns the name of the file caching the MRT data for a grid, or None
+    if caching is not possible."""
+    cache_dir = os.environ.get('SAILFISH_SYM_CACHE',
+            os.path.expanduser('~/.sailfish_sym_cache'))
+    # The cache is invalidated whenever this module or sympy change.
+    try:
+        f = open(os.path.splitext(__file__)[0] + '.py', 'rb')
+    except IOError:
+        return None
+    h = hashlib.sha1(f.read())
+    f.close()
+    h.update(sympy.__version__)
+    return os.path.join(cache_dir, '{0}_{1}.json'.format(grid.__name__,
+        h.hexdigest()))
+
+# Compound expressions which can be stored in the MRT cache.
+_CACHE_OPS = {'Add': sympy.Add, 'Mul': sympy.Mul, 'Pow': sympy.Pow}
+
+def _expr_to_json(ex):
+    """Converts an expression into a tree of lists which can be serialized
+    as JSON.  Only the expression types used in the MRT data are
+    supported."""
+    if type(ex) in (int, long, float):
+        return ex
+    if isinstance(ex, Symbol):
+        return ['Symbol', ex.name]
+    if isinstance(ex, sympy.Integer):
+        return ['Integer', int(ex)]
+    if isinstance(ex, Rational):
+        return ['Rational', int(ex.p), int(ex.q)]
+    if isinstance(ex, sympy.Float):
+        return ['Float', float(ex)]
+    for name, op in _CACHE_OPS.iteritems():
+        if ex.func is op:
+            return [name] + [_expr_to_json(x) for x in ex.args]
+    raise ValueError('Unsupported expression: {0}'.format(ex))
+
+def _expr_from_json(data):
+    """Inverse of _expr_to_json.  The data is read from a file and is
+    validated instead of being evaluated as code.
+
+    :raises ValueError: if the data does not represent a valid expression
+    """
+    if type(data) in (int, long, float):
+        return data
+    if type(data) is not list or not data:
+        raise ValueError('Invalid expression: {0!r}'.format(data))
+
+    kind, args = data[0], data[1:]
+    types = [type(x) for x in args]
+    if kind == 'Symbol' and types == [unicode]:
+        return Symbol(str(args[0]))
+    elif kind == 'Integer' and types in ([int], [long]):
+        return sympy.Integer(args[0])
+    elif kind == 'Rational' and len(args) == 2 and set(types) <= set([int, long]):
+        if args[1] == 0:
+            raise ValueError('Invalid rational number: {0!r}'.format(data))
+        return Rational(args[0], args[1])
+    elif kind == 'Float' and types == [float]:
+        return sympy.Float(args[0])
+    elif kind in _CACHE_OPS and args:
+        return _CACHE_OPS[kind](*[_expr_from_json(x) for x in args])
+    raise ValueError('Invalid expression: {0!r}'.format(data))
+
+def _load_mrt_cache(grid, path):
+    """Sets the MRT data of a grid using the contents of a cache file.
+
+    :returns: False if the file does not exist or cannot be parsed, in
+        which case the grid is not modified
+    """
+    if path is None or not os.path.exists(path):
+        return False
+
+    try:
+        f = open(path, 'r')
+        try:
+            data = json.load(f)
+        finally:
+            f.close()
+        matrix = [[_expr_from_json(x) for x in row] for row in
+            data['mrt_matrix']]
+        equilibrium = [_expr_from_json(x) for x in data['mrt_equilibrium']]
+        collision = [_expr_from_json(x) for x in data['mrt_collision']]
+    except (IOError, ValueError, KeyError, TypeError):
+        return False
+
+    size = len(matrix)
+    if (size == 0 or any(len(row) != size for row in matrix) or
+            len(equilibrium) != size or len(collision) != size):
+        return False
+
+    grid.mrt_matrix = Matrix(matrix)
+    grid.mrt_equilibrium = equilibrium
+    grid.mrt_collision = collision
+    return True
+
+def _save_mrt_cache(grid, path):
+    if path is None:
+        return
+
+    try:
+        data = {
+            'mrt_matrix': [[_expr_to_json(grid.mrt_matrix[i, j]) for j in
+                range(grid.mrt_matrix.cols)] for i in
+                range(grid.mrt_matrix.rows)],
+            'mrt_equilibrium': [_expr_to_json(x) for x in
+                grid.mrt_equilibrium],
+            'mrt_collision': [_expr_to_json(x) for x in grid.mrt_collision]}
+    except ValueError:
+        return
+
+    try:
+        dirname = os.path.dirname(path)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        # Write to a temporary file first, so that other processes never
+        # see an incomplete cache file.
+        tmp_path = '{0}.{1}'.format(path, os.getpid())
+        f = open(tmp_path, 'w')
+        json.dump(data, f)
+        f.close()
+        os.rename(tmp_path, path)
+    except (IOError, OSError):
+        pass
+
+def _prepare_grid(grid):
+    """Decorate a grid class with useful info computable from the basic definitions
+    of the grid.
 
     This approach saves the programmer's time and automatically ensures correctness
-    of the computed values."""
-
-    for grid in KNOWN_GRIDS:
-        if len(grid.basis) != len(grid.weights):
-            raise TypeError('Grid %s is ill-defined: not all BGK weights have been specified.' % grid.__name__)
+    of the computed values.  The MRT data, which is expensive to compute, is
+    cached on disk."""
+    grid._preparing = True
+    try:
+        _init_grid_data(grid)
+    except:
+        # Do not leave a partially prepared grid behind.  The preparation
+        # will be attempted again on the next access.
+        for name in _DERIVED_GRID_ATTRS:
+            if name in grid.__dict__:
+                delattr(grid, name)
+        raise
+    finally:
+        grid._preparing = False
+    grid._prepared = True
+
+def _init_grid_data(grid):
+    if len(grid.basis) != len(grid.weights):
+        raise TypeError('Grid %s is ill-defined: not all BGK weights have been specified.' % grid.__name__)
+
+    if len(grid.basis) != grid.Q:
+        raise TypeError('Grid {0} has an ill-defined Q factor.'.format(grid.__name__))
+
+    if sum(grid.weights) != 1:
+        raise TypeError('BGK weights for grid %s do not sum up to unity.' % grid.__name__)
+
+    grid.idx_name = []
+    grid.idx_opposite = []
 
-        if len(grid.basis) != grid.Q:
-            raise TypeError('Grid {0} has an ill-defined Q factor.'.format(grid.__name__))
-
-        if sum(grid.weights) != 1:
-            raise TypeError('BGK weights for grid %s do not sum up to unity.' % grid.__name__)
-
-        grid.idx_name = []
-        grid.idx_opposite = []
-
-        if grid.dim == 2:
-            names = [{-1: 'S', 1: 'N', 0: ''},
-                    {-1: 'W', 1: 'E', 0: ''}]
-            grid.v = Matrix(([grid.vx, grid.vy],))
+    if grid.dim == 2:
+        names = [{-1: 'S', 1: 'N', 0: ''},
+                {-1: 'W', 1: 'E', 0: ''}]
+        grid.v = Matrix(([grid.vx, grid.vy],))
+    else:
+        names = [{-1: 'B', 1: 'T', 0: ''},
+                 {-1: 'S', 1: 'N', 0: ''},
+                 {-1: 'W', 1: 'E', 0: ''}]
+        grid.v = Matrix(([grid.vx, grid.vy, grid.vz],))
+
+    grid.dir2vecidx = {}
+    grid.vecidx2dir = {}
+    dir = 1
+
+    for k, ei in enumerate(grid.basis):
+        # Compute direction names.
+        name = 'f'
+        for i, comp in enumerate(reversed(ei.tolist()[0])):
+            name += names[i][int(comp)]
+
+        if name == 'f':
+            name += 'C'
+
+        grid.idx_name.append(name)
+
+        # Find opposite directions.
+        for j, ej in enumerate(grid.basis):
+            if ej == -1 * ei:
+                grid.idx_opposite.append(j)
+                break
         else:
-            names = [{-1: 'B', 1: 'T', 0: ''},
-                     {-1: 'S', 1: 'N', 0: ''},
-                     {-1: 'W', 1: 'E', 0: ''}]
-            grid.v = Matrix(([grid.vx, grid.vy, grid.vz],))
-
-        grid.dir2vecidx = {}
-        grid.vecidx2dir = {}
-        dir = 1
-
-        for k, ei in enumerate(grid.basis):
-            # Compute direction names.
-            name = 'f'
-            for i, comp in enumerate(reversed(ei.tolist()[0])):
-                name += names[i][int(comp)]
-
-            if name == 'f':
-                name += 'C'
-
-            grid.idx_name.append(name)
-
-            # Find opposite directions.
-            for j, ej in enumerate(grid.basis):
-                if ej == -1 * ei:
-                    grid.idx_opposite.append(j)
-                    break
-            else:
-                raise TypeError('Opposite vector for %s not found.' % ei)
-
-            # Index primary direction vectors.  For cartesian grids, there
-            # are always 2*Q such vectors.
-            if ei.dot(ei) == 1:
-                grid.dir2vecidx[dir] = k
-                grid.vecidx2dir[k] = dir
-                dir += 1
-
-        # If MRT is supported for the current grid, compute the transformation
-        # matrix from the velocity space to moment space.  The procedure is as
-        # follows:
-        #  - _init_mrt_basis computes the moment vectors
-        #  - the moment vectors are orthogonalized using the Gram-Schmidt procedure
-        #  - the othogonal vectors form the transformation matrix
-        #  - the equilibrium expressions are computed and saved
-        if hasattr(grid, '_init_mrt_basis'):
-            grid._init_mrt_basis()
-
-            if len(grid.mrt_basis) != len(grid.basis):
-                raise TypeError('The number of moment vectors for grid %s is different '
-                    'than the number of vectors in velocity space.' % grid.__name__)
-
-            if len(grid.mrt_basis) != len(grid.mrt_names):
-                raise TypeError('The number of MRT names for grid %s is different '
-                    'than the number of moments.' % grid.__name__)
-
+            raise TypeError('Opposite vector for %s not found.' % ei)
+
+        # Index primary direction vectors.  For cartesian grids, there
+        # are always 2*Q such vectors.
+        if ei.dot(ei) == 1:
+            grid.dir2vecidx[dir] = k
+            grid.vecidx2dir[k] = dir
+            dir += 1
+
+    # If MRT is supported for the current grid, compute the transformation
+    # matrix from the velocity space to moment space.  The procedure is as
+    # follows:
+    #  - _init_mrt_basis computes the moment vectors
+    #  - the moment vectors are orthogonalized using the Gram-Schmidt procedure
+    #  - the othogonal vectors form the transformation matrix
+    #  - the equilibrium expressions are computed and saved
+    if hasattr(grid, '_init_mrt_basis'):
+        grid._init_mrt_basis()
+
+        if len(grid.mrt_basis) != len(grid.basis):
+            raise TypeError('The number of moment vectors for grid %s is different '
+                'than the number of vectors in velocity space.' % grid.__name__)
+
+        if len(grid.mrt_basis) != len(grid.mrt_names):
+            raise TypeError('The number of MRT names for grid %s is different '
+                'than the number of moments.' % grid.__name__)
+
+        cache_path = _grid_cache_path(grid)
+        if not _load_mrt_cache(grid, cache_path):
+            grid.mrt_collision = list(grid._mrt_collision_init)
             grid.mrt_matrix = Matrix([x.transpose().tolist()[0] for x in orthogonalize(*grid.mrt_basis)])
             grid._init_mrt_equilibrium()
+            _save_mrt_cache(grid, cache_path)
 
 # A container class for all commonly used sympy symbols.
 class S(object):
     aliases = {}
+    # Digest of the current aliases, used as a part of cexpr() cache keys.
+    aliases_key = ''
 
     @classmethod
     def alias(cls, sym_dst, sym_src):
         setattr(cls, sym_dst, sym_src)
         cls.aliases[sym_src] = sym_dst
+        cls.aliases_key = hashlib.sha1(repr(sorted(
+            (str(k), v) for k, v in cls.aliases.iteritems()))).hexdigest()
 
     @classmethod
     def make_vector(cls, sym_dst, dim, *syms):
@@ -1283,4 +1631,3 @@ def _prepare_symbols():
 KNOWN_GRIDS = (D2Q9, D3Q13, D3Q15, D3Q19)
 
 _prepare_symbols()
-_prepare_grids()
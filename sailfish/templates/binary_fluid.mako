@@ -56,18 +56,18 @@ ${kernel_common.nonlocal_fields_decl()}
 	%endfor
 
 	%for i, (feq, idx) in enumerate(bgk_equilibrium[0]):
-		${get_odist('dist1_in', i)} = ${cex(feq, vectors=True)};
+		${store_odist('dist1_in', i, capture(cex, feq, vectors=True))};
 	%endfor
 
 	%for i, (feq, idx) in enumerate(bgk_equilibrium[1]):
-		${get_odist('dist2_in', i)} = ${cex(feq, vectors=True)};
+		${store_odist('dist2_in', i, capture(cex, feq, vectors=True))};
 	%endfor
 </%def>
 
 %if dim == 2:
 ${kernel} void SetLocalVelocity(
-	${global_ptr} float *dist1_in,
-	${global_ptr} float *dist2_in,
+	${global_ptr} dist_t *dist1_in,
+	${global_ptr} dist_t *dist2_in,
 	${global_ptr} float *irho,
 	${global_ptr} float *iphi,
 	${kernel_args_1st_moment('ov')}
@@ -96,8 +96,8 @@ ${kernel} void SetLocalVelocity(
 // A kernel to set the node distributions using the equilibrium distributions
 // and the macroscopic fields.
 ${kernel} void SetInitialConditions(
-	${global_ptr} float *dist1_in,
-	${global_ptr} float *dist2_in,
+	${global_ptr} dist_t *dist1_in,
+	${global_ptr} dist_t *dist2_in,
 	${kernel_args_1st_moment('iv')}
 	${global_ptr} float *irho,
 	${global_ptr} float *iphi)
@@ -120,8 +120,8 @@ ${kernel} void SetInitialConditions(
 
 ${kernel} void PrepareMacroFields(
 	${global_ptr} int *map,
-	${global_ptr} float *dist1_in,
-	${global_ptr} float *dist2_in,
+	${global_ptr} dist_t *dist1_in,
+	${global_ptr} dist_t *dist2_in,
 	${global_ptr} float *orho,
 	${global_ptr} float *ophi)
 {
@@ -130,8 +130,9 @@ ${kernel} void PrepareMacroFields(
 	int ncode = map[gi];
 	int type = decodeNodeType(ncode);
 
-	// Unused nodes do not participate in the simulation.
-	if (isUnusedNode(type))
+	// Unused nodes do not participate in the simulation.  The fields in
+	// ghost nodes are filled with data from the neighboring blocks.
+	if (isUnusedNode(type) || isGhostNode(type))
 		return;
 
 	int orientation = decodeNodeOrientation(ncode);
@@ -230,16 +231,29 @@ ${kernel} void PrepareMacroFields(
 
 ${kernel} void CollideAndPropagate(
 	${global_ptr} int *map,
-	${global_ptr} float *dist1_in,
-	${global_ptr} float *dist1_out,
-	${global_ptr} float *dist2_in,
-	${global_ptr} float *dist2_out,
+	${global_ptr} dist_t *dist1_in,
+	${global_ptr} dist_t *dist1_out,
+	${global_ptr} dist_t *dist2_in,
+	${global_ptr} dist_t *dist2_out,
 	${global_ptr} float *gg0m0,
 	${global_ptr} float *gg1m0,
 	${kernel_args_1st_moment('ov')}
-	int save_macro)
+	int options)
 {
-	${local_indices()}
+	%if boundary_size > 0:
+		int gx, gy, lx, gi;
+		%if dim == 3:
+			int gz;
+		%endif
+
+		if (options & OPTION_BULK) {
+			${local_indices_bulk()}
+		} else {
+			${local_indices_boundary()}
+		}
+	%else:
+		${local_indices()}
+	%endif
 
 	// shared variables for in-block propagation
 	%for i in sym.get_prop_dists(grid, 1):
@@ -253,7 +267,7 @@ ${kernel} void CollideAndPropagate(
 	int type = decodeNodeType(ncode);
 
 	// Unused nodes do not participate in the simulation.
-	if (isUnusedNode(type))
+	if (isUnusedNode(type) || isGhostNode(type))
 		return;
 
 	int orientation = decodeNodeOrientation(ncode);
@@ -350,7 +364,7 @@ ${kernel} void CollideAndPropagate(
 	%endif
 
 	// only save the macroscopic quantities if requested to do so
-	if (save_macro == 1) {
+	if (options & OPTION_SAVE_MACRO_FIELDS) {
 		%if simtype == 'shan-chen' and not bc_wall_.wet_nodes:
 			if (!isWallNode(type))
 		%endif
@@ -368,4 +382,4 @@ ${kernel} void CollideAndPropagate(
 	${propagate('dist2_out', 'd1')}
 }
 
-
+<%include file="data_exchange.mako"/>
@@ -3,7 +3,7 @@
 %>
 
 <%namespace file="code_common.mako" import="*"/>
-<%namespace file="propagation.mako" import="rel_offset,get_odist"/>
+<%namespace file="propagation.mako" import="rel_offset,store_odist"/>
 <%namespace file="utils.mako" import="get_field_off,nonlocal_fld,fld_args"/>
 
 <%def name="noneq_bb(orientation)">
@@ -441,7 +441,7 @@ ${device_func} inline void getMacro(Dist *fi, int ncode, int node_type, int orie
 
 // TODO: Check whether it is more efficient to actually recompute
 // node_type and orientation instead of passing them as variables.
-${device_func} inline void postcollisionBoundaryConditions(Dist *fi, int ncode, int node_type, int orientation, float *rho, float *v0, int gi, ${global_ptr} float *dist_out)
+${device_func} inline void postcollisionBoundaryConditions(Dist *fi, int ncode, int node_type, int orientation, float *rho, float *v0, int gi, ${global_ptr} dist_t *dist_out)
 {
 	%if bc_wall == 'halfbb':
 		if (isWallNode(node_type)) {
@@ -449,7 +449,7 @@ ${device_func} inline void postcollisionBoundaryConditions(Dist *fi, int ncode,
 			%for i in range(1, grid.dim*2+1):
 				case ${i}: {
 					%for lvalue, rvalue in sym.fill_missing_dists(grid, 'fi', missing_dir=i):
-						${get_odist('dist_out', lvalue.idx)} = ${rvalue};
+						${store_odist('dist_out', lvalue.idx, rvalue)};
 					%endfor
 					break;
 				}
@@ -480,28 +480,30 @@ ${device_func} inline void precollisionBoundaryConditions(Dist *fi, int ncode, i
 		}
 	%endif
 
-	%if bc_velocity == 'equilibrium' or bc_pressure == 'equilibrium':
+	## The free-energy equilibrium depends on the gradients of the order
+	## parameter, which are not available here.
+	<% equilibrium_bc = simtype != 'free-energy' %>
+	%if equilibrium_bc and (bc_velocity == 'equilibrium' or bc_pressure == 'equilibrium'):
 		%for local_var in bgk_equilibrium_vars:
 			float ${cex(local_var.lhs)} = ${cex(local_var.rhs)};
 		%endfor
 	%endif
 
-	%if bc_velocity == 'equilibrium':
+	## The boundary conditions are applied to every grid separately, with the
+	## 0th moment of the grid passed in rho, so only the equilibrium of the
+	## first grid is used here.
+	%if equilibrium_bc and bc_velocity == 'equilibrium':
 		if (isVelocityNode(node_type)) {
-			%for eq in bgk_equilibrium:
-				%for feq, idx in eq:
-					fi->${idx} = ${cex(feq, pointers=True)};
-				%endfor
+			%for feq, idx in bgk_equilibrium[0]:
+				fi->${idx} = ${cex(feq, pointers=True)};
 			%endfor
 		}
 	%endif
 
-	%if bc_pressure == 'equilibrium':
+	%if equilibrium_bc and bc_pressure == 'equilibrium':
 		if (isPressureNode(node_type)) {
-			%for eq in bgk_equilibrium:
-				%for feq, idx in eq:
-					fi->${idx} = ${cex(feq, pointers=True)};
-				%endfor
+			%for feq, idx in bgk_equilibrium[0]:
+				fi->${idx} = ${cex(feq, pointers=True)};
 			%endfor
 		}
 	%endif
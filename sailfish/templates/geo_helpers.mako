@@ -18,10 +18,10 @@ typedef struct DistM {
 //
 // Copy the idx-th distribution from din into dout.
 //
-${device_func} inline void getDist(Dist *dout, ${global_ptr} float *din, int idx)
+${device_func} inline void getDist(Dist *dout, ${global_ptr} dist_t *din, int idx)
 {
 	%for i, dname in enumerate(grid.idx_name):
-		dout->${dname} = ${get_dist('din', i, 'idx')};
+		dout->${dname} = ${load_dist('din', i, 'idx')};
 	%endfor
 }
 
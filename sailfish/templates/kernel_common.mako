@@ -226,6 +226,39 @@
 	${array}[${idx} + DIST_SIZE * ${i} + ${offset}]
 </%def>
 
+## Reads the i-th distribution at global index 'index' from a dist_t array
+## and expands it to the compute precision.
+<%def name="load_dist_at(array, i, index)" filter="trim">
+	%if dist_storage == 'half':
+		<% value = 'loadDist({0}, {1})'.format(array, index) %>
+	%else:
+		<% value = '{0}[{1}]'.format(array, index) %>
+	%endif
+	%if dist_deviation:
+		(${value} + ${dist_weights[i]})
+	%else:
+		${value}
+	%endif
+</%def>
+
+## Stores 'value' as the i-th distribution at global index 'index' in a
+## dist_t array.
+<%def name="store_dist_at(array, i, index, value)" filter="trim">
+	<%
+		if dist_deviation:
+			value = '({0}) - {1}'.format(value, dist_weights[i])
+	%>
+	%if dist_storage == 'half':
+		storeDist(${array}, ${index}, ${value})
+	%else:
+		${array}[${index}] = ${value}
+	%endif
+</%def>
+
+<%def name="load_dist(array, i, idx, offset=0)" filter="trim">
+	${load_dist_at(array, i, '{0} + DIST_SIZE * {1} + {2}'.format(idx, i, offset))}
+</%def>
+
 ## FIXME: This should work in 3D.  Right now, there is no use case for that
 ## so we leave it 2D only.
 <%def name="wrap_coords()">
@@ -270,6 +303,21 @@
 
 #define DT 1.0f
 
+// Type in which the distributions are stored in global memory.  Lines
+// marked with 'keep precision' are not converted to double precision.
+%if dist_storage == 'half':
+	typedef unsigned short dist_t;	// keep precision
+	%if backend == 'cuda':
+		${device_func} inline float loadDist(const dist_t *p, int i) { return __half2float(p[i]); }	// keep precision
+		${device_func} inline void storeDist(dist_t *p, int i, float v) { p[i] = __float2half_rn(v); }	// keep precision
+	%else:
+		inline float loadDist(__global const dist_t *p, int i) { return vload_half(i, (__global const half *)p); }	// keep precision
+		inline void storeDist(__global dist_t *p, int i, float v) { vstore_half_rte(v, i, (__global half *)p); }	// keep precision
+	%endif
+%else:
+	typedef ${'double' if dist_storage == 'double' else 'float'} dist_t;	// keep precision
+%endif
+
 %for name, val in constants:
 	${const_var} float ${name} = ${val}f;
 %endfor
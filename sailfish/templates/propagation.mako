@@ -3,6 +3,7 @@
 %>
 
 <%namespace file="opencl_compat.mako" import="*"/>
+<%namespace file="kernel_common.mako" import="store_dist_at"/>
 
 <%def name="prop_bnd(dist_out, dist_in, effective_dir, i, di, local, offset)">
 ## Generate the propagation code for a specific base direction.
@@ -77,15 +78,25 @@
 	%endif
 </%def>
 
+<%def name="odist_idx(idir, xoff=0, yoff=0, zoff=0, offset=0)" filter="trim">
+	gi + ${dist_size*idir + offset} + ${rel_offset(xoff, yoff, zoff)}
+</%def>
+
 <%def name="get_odist(dist_out, idir, xoff=0, yoff=0, zoff=0, offset=0)" filter="trim">
-	${dist_out}[gi + ${dist_size*idir + offset} + ${rel_offset(xoff, yoff, zoff)}]
+	${dist_out}[${odist_idx(idir, xoff, yoff, zoff, offset)}]
+</%def>
+
+## Stores 'value' as the idir-th distribution of the node at (xoff, yoff, zoff)
+## relative to the current node.
+<%def name="store_odist(dist_out, idir, value, xoff=0, yoff=0, zoff=0, offset=0)" filter="trim">
+	${store_dist_at(dist_out, idir, capture(odist_idx, idir, xoff, yoff, zoff, offset), value)}
 </%def>
 
 <%def name="set_odist(dist_out, dist_in, idir, xoff, yoff, zoff, offset, local)">
 	%if local:
-		${get_odist(dist_out, idir, xoff, yoff, zoff, offset)} = prop_${grid.idx_name[idir]}[lx];
+		${store_odist(dist_out, idir, 'prop_{0}[lx]'.format(grid.idx_name[idir]), xoff, yoff, zoff, offset)};
 	%else:
-		${get_odist(dist_out, idir, xoff, yoff, zoff, offset)} = ${dist_in}.${grid.idx_name[idir]};
+		${store_odist(dist_out, idir, '{0}.{1}'.format(dist_in, grid.idx_name[idir]), xoff, yoff, zoff, offset)};
 	%endif
 </%def>
 
@@ -93,7 +104,7 @@
 // TODO: This function is DEPRECATED and should be removed.
 <%def name="propagate2(dist_out, dist_in='fi')">
 	// update the 0-th direction distribution
-	${dist_out}[gi] = ${dist_in}.fC;
+	${store_dist_at(dist_out, 0, 'gi', dist_in + '.fC')};
 
 	// E propagation in global memory
 	if (gx < ${lat_nx-1}) {
@@ -129,7 +140,7 @@
 	%>
 
 	// Update the 0-th direction distribution
-	${dist_out}[gi] = ${dist_in}.fC;
+	${store_dist_at(dist_out, 0, 'gi', dist_in + '.fC')};
 
 	%if propagation_sentinels:
 		// Initialize the shared array with invalid sentinel values.  If the sentinel
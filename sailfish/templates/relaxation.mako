@@ -6,6 +6,18 @@
 <%namespace file="code_common.mako" import="*"/>
 <%namespace file="boundary.mako" import="get_boundary_pressure"/>
 
+## Assigns expressions to the variables in 'lhs', with common subexpressions
+## hoisted into temporary variables.
+<%def name="cse_assign(lhs, exprs, prefix, kernel, **kwargs)">
+	<% temps, vals = sym.cse_cexpr(sim, incompressible, exprs, prefix, kernel, enabled=cse, **kwargs) %>
+	%for name, val in temps:
+		const float ${name} = ${val};
+	%endfor
+	%for dst, val in zip(lhs, vals):
+		${dst} = ${val};
+	%endfor
+</%def>
+
 <%def name="fluid_momentum(igrid)">
 	%if igrid in force_for_eq and equilibrium:
 		fm.mx += ${cex(0.5 * sym.fluid_accel(sim, force_for_eq[igrid], 0, forces, force_couplings), vectors=True)};
@@ -48,7 +60,7 @@
 
 
 ## TODO: support multiple grids with MRT?
-% if model == 'mrt' and simtype == 'fluid':
+% if model == 'mrt' and simtype == 'lbm':
 //
 // Relaxation in moment space.
 //
@@ -56,9 +68,8 @@ ${device_func} void MS_relaxate(Dist *fi, int node_type, float *iv0)
 {
 	DistM fm, feq;
 
-	%for mrt, val in sym.bgk_to_mrt(grid, 'fi', 'fm'):
-		${mrt} = ${val};
-	%endfor
+	<% bgk_to_mrt = sym.bgk_to_mrt(grid, 'fi', 'fm') %>
+	${cse_assign([mrt for mrt, _ in bgk_to_mrt], [val for _, val in bgk_to_mrt], 'fm_', 'MS_relaxate')}
 
 	${body_force()}
 	${fluid_momentum(0)}
@@ -68,11 +79,8 @@ ${device_func} void MS_relaxate(Dist *fi, int node_type, float *iv0)
 	#define mz fm.mz
 
 	// Calculate equilibrium distributions in moment space.
-	%for i, eq in enumerate(grid.mrt_equilibrium):
-		%if grid.mrt_collision[i] != 0:
-			feq.${grid.mrt_names[i]} = ${cex(eq, rho='fm.rho')};
-		%endif
-	%endfor
+	<% mrt_eq = [(name, eq) for name, eq, coll in zip(grid.mrt_names, grid.mrt_equilibrium, grid.mrt_collision) if coll != 0] %>
+	${cse_assign(['feq.' + name for name, _ in mrt_eq], [eq for _, eq in mrt_eq], 'feq_', 'MS_relaxate', rho='fm.rho')}
 
 	// Relexate the non-conserved moments,
 	%if bc_velocity == 'equilibrium':
@@ -107,9 +115,8 @@ ${device_func} void MS_relaxate(Dist *fi, int node_type, float *iv0)
 
 	${fluid_momentum(0)}
 
-	%for bgk, val in sym.mrt_to_bgk(grid, 'fi', 'fm'):
-		${bgk} = ${val};
-	%endfor
+	<% mrt_to_bgk = sym.mrt_to_bgk(grid, 'fi', 'fm') %>
+	${cse_assign([bgk for bgk, _ in mrt_to_bgk], [val for _, val in mrt_to_bgk], 'fi_', 'MS_relaxate')}
 
 	${fluid_velocity(0, save=True)}
 }
@@ -135,7 +142,7 @@ ${device_func} void MS_relaxate(Dist *fi, int node_type, float *iv0)
 </%def>
 
 
-<%def name="bgk_relaxation_preamble()">
+<%def name="bgk_relaxation_preamble(kernel)">
 	%for i in range(0, len(grids)):
 		Dist feq${i};
 	%endfor
@@ -158,10 +165,7 @@ ${device_func} void MS_relaxate(Dist *fi, int node_type, float *iv0)
 
 	%for i, eq in enumerate(bgk_equilibrium):
 		${fluid_velocity(i, True)};
-
-		%for feq, idx in eq:
-			feq${i}.${idx} = ${cex(feq, vectors=True)};
-		%endfor
+		${cse_assign(['feq%d.%s' % (i, idx) for _, idx in eq], [feq for feq, _ in eq], 'feq%d_' % i, kernel, vectors=True)}
 	%endfor
 
 	%if subgrid == 'les-smagorinsky':
@@ -207,7 +211,7 @@ ${device_func} inline void FE_MRT_relaxate(${bgk_args_decl()},
 %endfor
 	int node_type)
 {
-	${bgk_relaxation_preamble()}
+	${bgk_relaxation_preamble('FE_MRT_relaxate')}
 
 	%for i in range(0, len(grids)):
 		%for idx in grid.idx_name:
@@ -239,9 +243,9 @@ ${device_func} inline void FE_MRT_relaxate(${bgk_args_decl()},
 }
 %endif  ## model == femrt
 
-% if model == 'bgk':
+% if model == 'bgk' or model == 'trt':
 //
-// Performs the relaxation step in the BGK model given the density rho,
+// Performs the relaxation step in the BGK or TRT model given the density rho,
 // the velocity v and the distribution fi.
 //
 ${device_func} inline void BGK_relaxate(${bgk_args_decl()},
@@ -250,12 +254,34 @@ ${device_func} inline void BGK_relaxate(${bgk_args_decl()},
 %endfor
 	int node_type, int ncode)
 {
-	${bgk_relaxation_preamble()}
+	${bgk_relaxation_preamble('BGK_relaxate')}
 
 	%for i in range(0, len(grids)):
-		%for idx in grid.idx_name:
-			d${i}->${idx} += (feq${i}.${idx} - d${i}->${idx}) / tau${i};
-		%endfor
+		%if model == 'trt':
+			// Relaxation time for the antisymmetric part of the distributions,
+			// chosen so that the "magic" parameter Lambda is constant.
+			float tau_m${i} = ${trt_magic}f / (tau${i} - 0.5f) + 0.5f;
+
+			// Relax the symmetric and antisymmetric parts of every pair of
+			// distributions with opposite velocities.
+			%for j, oj in enumerate(grid.idx_opposite):
+				%if j == oj:
+					d${i}->${grid.idx_name[j]} += (feq${i}.${grid.idx_name[j]} - d${i}->${grid.idx_name[j]}) / tau${i};
+				%elif j < oj:
+					<% a, b = grid.idx_name[j], grid.idx_name[oj] %>
+					{
+						float neq_p = 0.5f * (d${i}->${a} + d${i}->${b} - feq${i}.${a} - feq${i}.${b}) / tau${i};
+						float neq_m = 0.5f * (d${i}->${a} - d${i}->${b} - feq${i}.${a} + feq${i}.${b}) / tau_m${i};
+						d${i}->${a} -= neq_p + neq_m;
+						d${i}->${b} -= neq_p - neq_m;
+					}
+				%endif
+			%endfor
+		%else:
+			%for idx in grid.idx_name:
+				d${i}->${idx} += (feq${i}.${idx} - d${i}->${idx}) / tau${i};
+			%endfor
+		%endif
 
 		%if bc_pressure == 'guo':
 			// The total form of the postcollision boundary node distribution value
@@ -332,7 +358,7 @@ ${device_func} inline void BGK_relaxate(${bgk_args_decl()},
 %endif
 
 <%def name="_relaxate(bgk_args)">
-	%if model == 'bgk':
+	%if model == 'bgk' or model == 'trt':
 		BGK_relaxate(${bgk_args()},
 %for i in range(0, len(grids)):
 	&d${i},
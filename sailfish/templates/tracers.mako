@@ -1,9 +1,11 @@
+<%namespace file="kernel_common.mako" import="load_dist"/>
+
 //
 // A kernel to update the position of tracer particles.
 //
 // Each thread updates the position of a single particle using Euler's algorithm.
 //
-${kernel} void LBMUpdateTracerParticles(${global_ptr} float *dist, ${global_ptr} int *map,
+${kernel} void LBMUpdateTracerParticles(${global_ptr} dist_t *dist, ${global_ptr} int *map,
 		${global_ptr} float *x, ${global_ptr} float *y \
 %if dim == 3:
 	, ${global_ptr} float *z \
@@ -67,7 +69,7 @@ ${kernel} void LBMUpdateTracerParticles(${global_ptr} float *dist, ${global_ptr}
 	// getDist(&fc, dist, idx);
 
 	%for i, dname in enumerate(grid.idx_name):
-		fc.${dname} = dist[idx + DIST_SIZE*${i}];
+		fc.${dname} = ${load_dist('dist', i, 'idx')};
 	%endfor
 
 	## FIXME: We just need the velocity here.
@@ -0,0 +1,103 @@
+"""Recording of per-iteration event timelines for block runners."""
+
+__author__ = 'Michal Januszewski'
+__email__ = 'sailfish-cfd@googlegroups.com'
+__license__ = 'LGPL3'
+
+from collections import deque, namedtuple
+import json
+
+# A single time span.  Start and end times are in seconds since the epoch,
+# which serves as a clock common to all block runners on a machine.
+Span = namedtuple('Span', 'name iteration start end track')
+
+# Tracks (rows in the trace viewer) used for the spans.
+TRACK_HOST = 0
+TRACK_GPU = 1
+_TRACK_NAMES = {TRACK_HOST: 'host', TRACK_GPU: 'GPU'}
+
+
+def block_filename(base, block_id, suffix='.json'):
+    return '{0}_timeline.{1}{2}'.format(base, block_id, suffix)
+
+def merged_filename(base):
+    return '{0}_timeline.json'.format(base)
+
+
+class Timeline(object):
+    """Records named time spans in a ring buffer, so that only the last
+    `size` spans are retained."""
+
+    def __init__(self, block_id, size):
+        self.block_id = block_id
+        self._spans = deque(maxlen=size)
+
+    def __len__(self):
+        return len(self._spans)
+
+    def record(self, name, iteration, start, end, track=TRACK_HOST):
+        self._spans.append(Span(name, iteration, start, end, track))
+
+    def spans(self):
+        return list(self._spans)
+
+    def chrome_trace_events(self):
+        """Returns a list of events in the Chrome trace event format."""
+        events = [{'name': 'process_name', 'ph': 'M', 'pid': self.block_id,
+                   'args': {'name': 'Block/{0}'.format(self.block_id)}}]
+        for track, name in _TRACK_NAMES.iteritems():
+            events.append({'name': 'thread_name', 'ph': 'M',
+                'pid': self.block_id, 'tid': track, 'args': {'name': name}})
+
+        for span in self._spans:
+            events.append({'name': span.name, 'ph': 'X',
+                'pid': self.block_id, 'tid': span.track,
+                'ts': span.start * 1e6, 'dur': (span.end - span.start) * 1e6,
+                'args': {'iteration': span.iteration}})
+        return events
+
+    def save_chrome_trace(self, fname):
+        f = open(fname, 'w')
+        json.dump({'traceEvents': self.chrome_trace_events()}, f)
+        f.close()
+
+    def save_csv(self, fname):
+        f = open(fname, 'w')
+        f.write('block,iteration,name,track,start,end\n')
+        for span in self._spans:
+            f.write('{0},{1},{2},{3},{4!r},{5!r}\n'.format(self.block_id,
+                span.iteration, span.name, _TRACK_NAMES[span.track],
+                span.start, span.end))
+        f.close()
+
+    def save(self, base):
+        """Saves the timeline as a Chrome trace and as a CSV file."""
+        self.save_chrome_trace(block_filename(base, self.block_id))
+        self.save_csv(block_filename(base, self.block_id, '.csv'))
+
+
+def merge_chrome_traces(fnames, output):
+    """Merges per-block Chrome traces into a single file.
+
+    All blocks record their spans using the same clock.  Timestamps in the
+    merged trace are shifted so that the earliest event starts at 0.
+
+    :param fnames: iterable of names of per-block trace files
+    :param output: name of the merged trace file
+    """
+    events = []
+    for fname in fnames:
+        f = open(fname, 'r')
+        events.extend(json.load(f)['traceEvents'])
+        f.close()
+
+    timestamps = [ev['ts'] for ev in events if 'ts' in ev]
+    if timestamps:
+        t0 = min(timestamps)
+        for ev in events:
+            if 'ts' in ev:
+                ev['ts'] -= t0
+
+    f = open(output, 'w')
+    json.dump({'traceEvents': events}, f)
+    f.close()
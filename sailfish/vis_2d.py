@@ -4,14 +4,13 @@ __author__ = 'Michal Januszewski'
 __email__ = 'sailfish-cfd@googlegroups.com'
 __license__ = 'GPL3'
 
-import math
 import os
 import time
 
 import numpy as np
 import pygame
 
-from sailfish import lb_base, vis, geo_block
+from sailfish import lb_base, vis, geo_block, colormaps
 
 pygame.init()
 pygame.surfarray.use_arraytype('numpy')
@@ -23,62 +22,6 @@ def _font_name():
     else:
         return 'Liberation Mono'
 
-def _hsv_to_rgb(a):
-    t = a[:,:,0]*6.0
-    i = t.astype(np.uint8)
-    f = t - np.floor(t)
-
-    v = a[:,:,2]
-
-    o = np.ones_like(a[:,:,0])
-    p = v * (o - a[:,:,1])
-    q = v * (o - a[:,:,1]*f)
-    t = v * (o - a[:,:,1]*(o - f))
-
-    i = np.mod(i, 6)
-    sh = i.shape
-    i = i.reshape(sh[0], sh[1], 1) * np.uint8([1,1,1])
-
-    choices = [np.dstack((v, t, p)),
-               np.dstack((q, v, p)),
-               np.dstack((p, v, t)),
-               np.dstack((p, q, v)),
-               np.dstack((t, p, v)),
-               np.dstack((v, p, q))]
-
-    return np.choose(i, choices)
-
-def _cmap_hsv(drw):
-    drw = drw.reshape((drw.shape[0], drw.shape[1], 1)) * np.float32([1.0, 1.0, 1.0])
-    drw[:,:,2] = 1.0
-    drw[:,:,1] = 1.0
-    drw = _hsv_to_rgb(drw) * 255.0
-    return drw.astype(np.uint8)
-
-def _cmap_std(drw):
-    return (drw.reshape((drw.shape[0], drw.shape[1], 1)) * 255.0).astype(np.uint8) * np.uint8([1,1,0])
-
-def _cmap_2col(drw):
-    drw = ((drw*(drw>0).astype(int)).reshape((drw.shape[0], drw.shape[1], 1)) * np.uint8([255, 0, 0])
-        - ( drw*(drw<0).astype(int)).reshape((drw.shape[0], drw.shape[1], 1)) * np.uint8([0, 0, 255]))
-    drw[drw>255] = 255
-    drw[drw<-255] = -255
-    return drw.astype(np.uint8)
-
-def _cmap_rgb1(drw):
-    """Default color palette from gnuplot."""
-    r = np.sqrt(drw)
-    g = np.power(drw, 3)
-    b = np.sin(drw * math.pi)
-
-    return (np.dstack([r,g,b]) * 250.0).astype(np.uint8)
-
-def _cmap_bin_red_blue(a, b):
-    """Two fields, mapped to the red and blue components, respectively."""
-    g = a.copy()
-    g[:] = 0.0
-    return (np.dstack([a,g,b]) * 255.0).astype(np.uint8)
-
 def _gauss_kernel(size, sizey=None):
     """Return a normalized 2D gauss kernel array for convolutions"""
     size = int(size)
@@ -112,18 +55,6 @@ def _emboss_field(fv, a):
     a[:,:,1] = (w*a[:,:,1] + (1-w)*a2)
     a[:,:,2] = (w*a[:,:,2] + (1-w)*a2)
 
-cmaps = {
-    1: {
-        'std': _cmap_std,
-        'rgb1': _cmap_rgb1,
-        'hsv': _cmap_hsv,
-        '2col': _cmap_2col,
-        },
-    2: {
-        'rb': _cmap_bin_red_blue,
-        }
-    }
-
 # TODO(michalj): Restore the option to manually impart velocity on the fluid.
 # TODO(michalj): Restore support for drawing walls.
 # TODO(michalj): Restore support for tracers.
@@ -144,6 +75,9 @@ class Fluid2DVis(vis.FluidVis):
         group.add_argument('--scr_h', help='screen height', type=int, default=0)
         group.add_argument('--scr_scale', help='screen scale', type=float, default=3.0)
         group.add_argument('--scr_depth', help='screen color depth', type=int, default=0)
+        group.add_argument('--cmap_levels', help='number of distinct colors '
+                'used to represent the values of a field', type=int,
+                choices=[256, 4096], default=256)
 
     def __init__(self, config, blocks, quit_event, sim_quit_event, vis_config):
         super(Fluid2DVis, self).__init__()
@@ -172,6 +106,21 @@ class Fluid2DVis(vis.FluidVis):
         self._mouse_pos = 0,0
         self._mouse_vel = 0,0
 
+        # Surfaces, work buffers and wall node coordinates, indexed by
+        # block ID.
+        self._surfaces = {}
+        self._buffers = {}
+        self._walls = {}
+        # Block, iteration and walls setting for which the field was last
+        # rendered.
+        self._field_key = None
+        # Block and iteration at the time the currently visualized block was
+        # selected.  The visualization buffers of the block are only valid
+        # once it saves data at a later iteration.
+        self._selected = (None, None)
+        # State of the screen at the last update, see _update_display().
+        self._drawn_key = None
+
         self._reset()
         self.resize()
 
@@ -207,53 +156,80 @@ class Fluid2DVis(vis.FluidVis):
         return v
 
     def _visualize(self):
-        width, height = self.size
-        srf = pygame.Surface((width, height))
         block = self._blocks[self._vis_config.block]
-        ret = ['block {0}'.format(block.id),
-               self._vis_config.field_name]
+        iteration = self._vis_config.iteration
+        if self._selected[0] != block.id:
+            self._selected = (block.id, iteration)
 
-        srf2 = self._draw_field(srf, width, height, block)
-        pygame.transform.scale(srf2, self._screen.get_size(), self._screen)
+        key = (block.id, iteration, self._show_walls)
+        if key != self._field_key:
+            self._draw_field(block)
+            self._field_key = key
+
+        pygame.transform.scale(self._surfaces[block.id],
+                self._screen.get_size(), self._screen)
 
         # TODO(michalj): Add support for vector fields.
         # TODO(michalj): Add support for tracer particles.
-        return ret
-
-    def _draw_geometry(self, tg_buffer, width, height, block):
-        geo_map = np.zeros((height, width), dtype=np.uint8)
-        geo_map.reshape(width * height)[:] = block.vis_geo_buffer[:]
-
-        geo_map = np.rot90(geo_map, 3)
-
-        tg_buffer[geo_map == geo_block.Subdomain.NODE_WALL] = self._color_wall
-
-    def _draw_field(self, srf, width, height, block):
-        a = pygame.surfarray.pixels3d(srf)
-
-        # FIXME(michalj): This is horribly inefficient.  We should only recreate
-        # the array if the data has been updated.
-        tmp = np.zeros((height, width), dtype=np.float32)
-        tmp.reshape(width * height)[:] = block.vis_buffer[:]
-
-        v_max = np.max(tmp)
-        v_min = 0.0
-
-        tmp[:] = (tmp - v_min) / (v_max - v_min)
-        tmp[tmp > 1.0]  = 1.0
-        tmp = np.abs(tmp)
-        tmp = np.rot90(tmp, 3)
+        return ['block {0}'.format(block.id), self._vis_config.field_name]
+
+    def _wall_nodes(self, block):
+        """Returns the surface coordinates of the wall nodes of 'block'.
+
+        The geometry does not change during the simulation, so the result is
+        cached once the visualization buffers of the block are valid.
+        """
+        if block.id in self._walls:
+            return self._walls[block.id]
+
+        width, height = block.size
+        geo_map = np.ctypeslib.as_array(block.vis_geo_buffer)
+        geo_map = geo_map[0:width * height].reshape(height, width)
+        # Surface arrays are indexed with [x, y], with the Y axis pointing
+        # down.
+        walls = np.nonzero((geo_map == geo_block.Subdomain.NODE_WALL)[::-1].T)
+
+        if self._selected != (block.id, self._vis_config.iteration):
+            self._walls[block.id] = walls
+        return walls
+
+    def _draw_geometry(self, tg_buffer, block):
+        tg_buffer[self._wall_nodes(block)] = self._color_wall
+
+    def _draw_field(self, block):
+        """Renders the visualization buffer of 'block' into the surface of
+        the block."""
+        width, height = block.size
+        if block.id not in self._surfaces:
+            self._surfaces[block.id] = pygame.Surface((width, height))
+            self._buffers[block.id] = (
+                    np.zeros((height, width), dtype=np.float32),
+                    np.zeros((height, width), dtype=np.intp))
+        tmp, idx = self._buffers[block.id]
+
+        # The simulation only writes to the slot which is not the most
+        # recent one, and does so only after a new frame is requested, so
+        # the data can be read without locking.
+        slot = block.vis_state.slot
+        if slot >= 0:
+            field = np.ctypeslib.as_array(block.vis_buffer)
+            tmp[:] = field.reshape(2, height, width)[slot]
+            block.vis_state.requested = True
+
+        levels = self.config.cmap_levels
+        colormaps.lut_indices(tmp, levels, idx)
 
         # TODO(michalj): Add support for multi-component fields.
-        vis_field = cmaps[1]['rgb1'](tmp)
-        a[:] = vis_field[:]
+        a = pygame.surfarray.pixels3d(self._surfaces[block.id])
+        np.take(colormaps.colormap_lut('rgb1', levels), idx[::-1].T, axis=0, out=a,
+                mode='clip')
 
-        self._draw_geometry(a, width, height, block)
+        if self._show_walls:
+            self._draw_geometry(a, block)
         # TODO(michalj): Add support for embossing.
 
-        # Unlock the surface and put the picture on screen.
+        # Unlock the surface.
         del a
-        return srf
 
     def _get_loc(self, event):
         x = event.pos[0] * self.lat_nx / self._screen.get_width()
@@ -270,6 +246,8 @@ class Fluid2DVis(vis.FluidVis):
                 self._sim_quit_event.set()
             elif event.type == pygame.VIDEORESIZE:
                 self.set_mode(*event.size)
+            elif event.type == pygame.VIDEOEXPOSE:
+                self._drawn_key = None
             elif event.type == pygame.KEYDOWN:
                 # Previous field.
                 if event.key == pygame.K_MINUS:
@@ -295,14 +273,14 @@ class Fluid2DVis(vis.FluidVis):
                     self.resize()
                 elif event.key == pygame.K_LEFTBRACKET:
                     n = len(self.field.vals)
-                    idx = cmaps[n].keys().index(self._cmap[n]) - 1
-                    idx %= len(cmaps[n].keys())
-                    self._cmap[n] = cmaps[n].keys()[idx]
+                    idx = colormaps.cmaps[n].keys().index(self._cmap[n]) - 1
+                    idx %= len(colormaps.cmaps[n].keys())
+                    self._cmap[n] = colormaps.cmaps[n].keys()[idx]
                 elif event.key == pygame.K_RIGHTBRACKET:
                     n = len(self.field.vals)
-                    idx = cmaps[n].keys().index(self._cmap[n]) + 1
-                    idx %= len(cmaps[n].keys())
-                    self._cmap[n] = cmaps[n].keys()[idx]
+                    idx = colormaps.cmaps[n].keys().index(self._cmap[n]) + 1
+                    idx %= len(colormaps.cmaps[n].keys())
+                    self._cmap[n] = colormaps.cmaps[n].keys()[idx]
                 elif event.key == pygame.K_m:
                     self._cmap_scale_lock = not self._cmap_scale_lock
                 elif event.key == pygame.K_v:
@@ -343,6 +321,15 @@ class Fluid2DVis(vis.FluidVis):
 
     def _update_display(self):
         curr_iter = self._vis_config.iteration
+
+        # Only redraw the screen if new data is available or the way it is
+        # displayed changed.
+        key = (curr_iter, self._vis_config.block, self._screen.get_size(),
+                self._show_info, self._show_walls)
+        if key == self._drawn_key:
+            return
+        self._drawn_key = key
+
         if curr_iter < 0:
             self._screen.blit(
                     self._font.render('Waiting for simulation startup...',
@@ -0,0 +1,147 @@
+import imp
+import sys
+import unittest
+
+# pyopencl is replaced with a minimal fake runtime, so that the backend can
+# be tested without OpenCL devices.
+cl = imp.new_module('pyopencl')
+
+class Error(Exception):
+    pass
+
+class CLRuntimeError(Error):
+    pass
+
+class CLLogicError(Error):
+    pass
+
+class CLMemoryError(Error):
+    pass
+
+class _Enum(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+cl.Error = Error
+cl.RuntimeError = CLRuntimeError
+cl.LogicError = CLLogicError
+cl.MemoryError = CLMemoryError
+cl.device_type = _Enum(GPU=4, CPU=2, ACCELERATOR=8, ALL=0xffffffff)
+cl.command_queue_properties = _Enum(PROFILING_ENABLE=2)
+cl.context_properties = _Enum(PLATFORM=0x1084)
+
+class Device(object):
+    name = 'fake'
+    global_mem_size = 1 << 30
+
+    def __init__(self, queue_properties, marker_profiling):
+        self.queue_properties = queue_properties
+        self.marker_profiling = marker_profiling
+
+class Platform(object):
+    devices = []
+
+    def get_devices(self, device_type):
+        return self.devices
+
+class Context(object):
+    def __init__(self, devices, properties):
+        self.devices = devices
+
+class CommandQueue(object):
+    def __init__(self, ctx, device, properties=0):
+        self.device = device
+        self.properties = properties
+
+    def finish(self):
+        pass
+
+class ProfilingInfo(object):
+    def __init__(self, end):
+        self._end = end
+
+    @property
+    def end(self):
+        if self._end is None:
+            raise CLRuntimeError('PROFILING_INFO_NOT_AVAILABLE')
+        return self._end
+
+class Event(object):
+    # Device time in ns.
+    clock = 0
+
+    def __init__(self, queue):
+        Event.clock += 2000000
+        end = None
+        if (queue.properties & cl.command_queue_properties.PROFILING_ENABLE
+                and queue.device.marker_profiling):
+            end = Event.clock
+        self.profile = ProfilingInfo(end)
+        self.waited = False
+
+    def wait(self):
+        self.waited = True
+
+cl.get_platforms = lambda: [Platform()]
+cl.Context = Context
+cl.CommandQueue = CommandQueue
+cl.enqueue_marker = Event
+
+for name in ('array', 'reduction', 'tools'):
+    module = imp.new_module('pyopencl.' + name)
+    setattr(cl, name, module)
+    sys.modules[module.__name__] = module
+sys.modules['pyopencl'] = cl
+
+from sailfish import backend_opencl
+
+
+class Options(object):
+    opencl_interactive = False
+    opencl_device_type = 'gpu'
+
+
+class TestOpenCLBackend(unittest.TestCase):
+
+    def _make_backend(self, device):
+        Platform.devices = [device]
+        return backend_opencl.OpenCLBackend(Options())
+
+    def test_marker_profiling(self):
+        backend = self._make_backend(Device(
+            cl.command_queue_properties.PROFILING_ENABLE, True))
+        self.assertTrue(backend._marker_profiling)
+        stream = backend.make_stream()
+        self.assertEqual(stream.queue.properties,
+                cl.command_queue_properties.PROFILING_ENABLE)
+
+        start = backend.make_event(stream, timing=True)
+        end = backend.make_event(stream, timing=True)
+        self.assertFalse(start.event.waited)
+        self.assertFalse(end.event.waited)
+        self.assertEqual(end.time_since(start), 2.0)
+
+    def _check_host_timing(self, backend):
+        self.assertFalse(backend._marker_profiling)
+        stream = backend.make_stream()
+        self.assertEqual(stream.queue.properties, 0)
+
+        # Events not used for timing do not block.
+        self.assertFalse(backend.make_event(stream).event.waited)
+
+        start = backend.make_event(stream, timing=True)
+        end = backend.make_event(stream, timing=True)
+        self.assertTrue(start.event.waited)
+        self.assertTrue(end.event.waited)
+        self.assertTrue(end.time_since(start) >= 0.0)
+
+    def test_no_marker_profiling(self):
+        self._check_host_timing(self._make_backend(Device(
+            cl.command_queue_properties.PROFILING_ENABLE, False)))
+
+    def test_no_queue_profiling(self):
+        self._check_host_timing(self._make_backend(Device(0, True)))
+
+
+if __name__ == '__main__':
+    unittest.main()
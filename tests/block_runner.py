@@ -1,17 +1,28 @@
 import operator
+import os
+import shutil
+import tempfile
 import unittest
 import numpy as np
 
 from sailfish.config import LBConfig
 from sailfish.lb_base import LBSim
+from sailfish.lb_single import LBForcedSim
 from sailfish.backend_dummy import DummyBackend
-from sailfish.block_runner import BlockRunner
-from sailfish.geo_block import SubdomainSpec2D, SubdomainSpec3D
+from sailfish.block_runner import BlockRunner, GPUBuffer, _load_autotune_cache, _save_autotune_result
+from sailfish.geo_block import SubdomainSpec2D, SubdomainSpec3D, Subdomain
+from sailfish.sym import D2Q9
 
 class DummyLogger(object):
     def debug(*args):
         pass
 
+    def info(*args):
+        pass
+
+    def warning(*args):
+        pass
+
 class TestBasicFunctionality(unittest.TestCase):
     location = 0, 0
     size = 10, 3
@@ -68,6 +79,220 @@ class TestBasicFunctionality(unittest.TestCase):
         nodes = runner._get_nodes()
         self.assertEqual(nodes, reduce(operator.mul, real_size))
 
+    def test_probe_indices_2d(self):
+        block = SubdomainSpec2D(self.location, self.size)
+        block.set_actual_size(1)
+        runner = self.get_block_runner(block)
+        runner._init_shape()
+
+        # Physical size is [5, 16].
+        nodes = 5 * 16
+        idx = runner._get_probe_indices(np.array([[0, 0], [3, 2]]), D2Q9)
+        self.assertEqual(idx.dtype, np.uint32)
+        self.assertEqual(idx.size, 2 * D2Q9.Q)
+        self.assertEqual(list(idx[0:D2Q9.Q]),
+                [17 + i * nodes for i in range(D2Q9.Q)])
+        self.assertEqual(list(idx[D2Q9.Q:]),
+                [(4 + 3 * 16) + i * nodes for i in range(D2Q9.Q)])
+
+    def test_probe_velocity_2d(self):
+        sim = LBForcedSim(self.sim.config)
+        sim.grids = [D2Q9]
+        sim.add_body_force((1e-3, 0.0))
+        sim.add_body_force((0.0, 2e-3), accel=False)
+        block = SubdomainSpec2D(self.location, self.size)
+        block.set_actual_size(1)
+        runner = BlockRunner(sim, block, output=None, backend=self.backend,
+                quit_event=None)
+
+        class Output(object):
+            def save_probes(self, i, rho, v):
+                self.rho = rho
+                self.v = v
+
+        # Two nodes at rest with densities 1 and 2.
+        dists = np.array([[float(w) for w in D2Q9.weights]] *
+                2, dtype=np.float32)
+        dists[1] *= 2.0
+        runner._output = Output()
+        runner._probe_buf = GPUBuffer(dists.ravel(), self.backend)
+        runner._probe_basis = np.array([[float(x) for x in vec] for vec in
+            D2Q9.basis], dtype=np.float32)
+        runner._save_probes()
+
+        np.testing.assert_allclose(runner._output.rho, [1.0, 2.0], rtol=1e-6)
+        # The velocity is shifted by half of the body force acceleration.
+        np.testing.assert_allclose(runner._output.v,
+                [[0.5e-3, 1e-3], [0.5e-3, 0.5e-3]], rtol=1e-5, atol=1e-9)
+
+    def test_force_links_2d(self):
+        block = SubdomainSpec2D(self.location, self.size)
+        block.set_actual_size(1)
+        runner = self.get_block_runner(block)
+        runner._init_shape()
+
+        # Node types with a margin of 1 node around the block.  Walls are
+        # at (0, 1), (3, 1), (4, 1) and outside of the domain.
+        types = np.zeros((5, 12), dtype=np.uint32)
+        types[[0, -1], :] = Subdomain.NODE_WALL
+        types[:, [0, -1]] = Subdomain.NODE_WALL
+        types[2, [1, 4, 5]] = Subdomain.NODE_WALL
+
+        # Physical size is [5, 16].
+        nodes = 5 * 16
+        idx = runner._get_force_links(np.array([[3, 1]]), types, D2Q9)
+        # All neighbors of (3, 1) except for (4, 1) are fluid nodes.
+        expected = [(4 + 2 * 16) + i * nodes for i, vec in
+                enumerate(D2Q9.basis) if tuple(vec) not in ((0, 0), (-1, 0))]
+        self.assertEqual(idx.dtype, np.uint32)
+        self.assertEqual(sorted(idx), sorted(expected))
+
+        # Links to nodes outside of the domain are ignored.
+        idx = runner._get_force_links(np.array([[0, 1]]), types, D2Q9)
+        self.assertEqual(idx.size, 5)
+
+    def test_final_exchange(self):
+        block = SubdomainSpec2D(self.location, self.size)
+        runner = self.get_block_runner(block)
+        runner._force_sender = None
+        self.sim.config.output = 'out'
+        self.sim.iteration = 10
+
+        # Probes are disabled.
+        self.sim.config.probe_every = 0
+        self.assertFalse(runner._final_exchange_req())
+
+        self.sim.config.probe_every = 5
+        self.assertTrue(runner._final_exchange_req())
+        self.sim.iteration = 11
+        self.assertFalse(runner._final_exchange_req())
+
+    def test_half_storage(self):
+        self.sim.config.storage_precision = 'half'
+        self.sim.config.storage_deviation = True
+        self.sim.grids = [D2Q9]
+        block = SubdomainSpec2D(self.location, self.size)
+        block.set_actual_size(0)
+        runner = self.get_block_runner(block)
+        runner._init_shape()
+
+        self.assertEqual(runner.dist_float, np.float16)
+        self.assertEqual(runner._get_dist_bytes(D2Q9),
+                runner._get_nodes() * D2Q9.Q * 2)
+
+        dists = np.array([[float(w) * 1.01 for w in D2Q9.weights]])
+        stored = runner._encode_dists(dists, axis=1)
+        self.assertEqual(stored.dtype, np.float16)
+        np.testing.assert_allclose(runner._decode_dists(stored, axis=1),
+                dists, rtol=1e-4)
+
+
+
+class KernelError(Exception):
+    pass
+
+
+class FailingBackend(DummyBackend):
+    kernel_errors = (KernelError,)
+
+
+class GridSim(LBSim):
+    grid = D2Q9
+
+
+class TestAutotune(unittest.TestCase):
+    location = 0, 0
+    size = 64, 32
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        config = LBConfig()
+        config.parse()
+        config.precision = 'single'
+        config.block_size = 8
+        config.lat_nx, config.lat_ny = self.size
+        config.logger = DummyLogger()
+        config.autotune_cache = os.path.join(self.tmpdir, 'autotune.json')
+        # block_size=2 is too small for the boundary size.
+        config.autotune_block_sizes = [2, 16, 32, 64]
+        config.autotune_iters = 10
+        config.bulk_boundary_split = True
+        self.sim = GridSim(config)
+        block = SubdomainSpec2D(self.location, self.size, id_=0)
+        block.set_actual_size(1)
+        self.runner = BlockRunner(self.sim, block, output=None,
+                backend=FailingBackend(), quit_event=None)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_autotune_cache(self):
+        path = os.path.join(self.tmpdir, 'cache.json')
+        self.assertEqual(_load_autotune_cache(path), {})
+        _save_autotune_result(path, 'a', {'block_size': 64})
+        _save_autotune_result(path, 'b', {'block_size': 128})
+        self.assertEqual(_load_autotune_cache(path),
+                {'a': {'block_size': 64}, 'b': {'block_size': 128}})
+
+    def test_autotune(self):
+        config = self.sim.config
+        tested = []
+
+        def init_simulation():
+            if config.block_size == 32:
+                raise KernelError('too many resources requested for launch')
+
+        def benchmark_step(iters):
+            tested.append((config.block_size, config.bulk_boundary_split))
+            return 1.0 / config.block_size
+
+        self.runner._init_simulation = init_simulation
+        self.runner._benchmark_step = benchmark_step
+        self.runner._autotune()
+
+        # The block has no neighbors, so the bulk/boundary split is always
+        # disabled.  block_size=32 cannot be launched.
+        self.assertEqual(tested, [(16, False), (64, False)])
+        self.assertEqual(config.block_size, 64)
+        self.assertEqual(config.bulk_boundary_split, False)
+        cache = _load_autotune_cache(config.autotune_cache)
+        self.assertEqual(cache.values()[0]['block_size'], 64)
+
+        # The cached result is used without benchmarking.
+        tested[:] = []
+        config.block_size = 16
+        self.runner._autotune()
+        self.assertEqual(tested, [])
+        self.assertEqual(config.block_size, 64)
+
+    def test_autotune_key(self):
+        config = self.sim.config
+        key = self.runner._autotune_key()
+
+        config.storage_precision = 'half'
+        runner = BlockRunner(self.sim, self.runner._block, output=None,
+                backend=FailingBackend(), quit_event=None)
+        half_key = runner._autotune_key()
+        self.assertNotEqual(half_key, key)
+
+        config.separate_output = True
+        self.assertNotEqual(runner._autotune_key(), half_key)
+
+        # Blocks with connections use different boundary kernels.
+        other = SubdomainSpec2D((64, 0), self.size, envelope_size=1, id_=1)
+        self.assertTrue(self.runner._block.connect(other, grid=D2Q9))
+        self.assertNotEqual(self.runner._autotune_key(), key)
+
+    def test_autotune_error(self):
+        def init_simulation():
+            raise TypeError('bad kernel argument')
+
+        # Errors other than kernel build and launch failures are not
+        # treated as unsupported settings.
+        self.runner._init_simulation = init_simulation
+        self.assertRaises(TypeError, self.runner._autotune)
+        self.assertFalse(os.path.exists(self.sim.config.autotune_cache))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,67 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+from sailfish import codegen, sym
+from sailfish.geo_block import SubdomainSpec2D
+
+class TestContextFingerprint(unittest.TestCase):
+
+    def _ctx(self, **kwargs):
+        ctx = {'dim': 2, 'lat_nx': 64, 'tau': 0.6, 'grid': sym.D2Q9,
+               'bgk_equilibrium': sym.bgk_equilibrium(sym.D2Q9),
+               'geo_params': [0.1, 0.0], 'forces': {},
+               'block': SubdomainSpec2D((0, 0), (64, 64))}
+        ctx.update(kwargs)
+        return ctx
+
+    def test_identical_contexts(self):
+        self.assertEqual(codegen.context_fingerprint(self._ctx()),
+                         codegen.context_fingerprint(self._ctx()))
+
+    def test_different_contexts(self):
+        fp = codegen.context_fingerprint(self._ctx())
+        self.assertNotEqual(fp, codegen.context_fingerprint(
+            self._ctx(lat_nx=32)))
+        self.assertNotEqual(fp, codegen.context_fingerprint(
+            self._ctx(grid=sym.D3Q19)))
+        self.assertNotEqual(fp, codegen.context_fingerprint(
+            self._ctx(geo_params=[0.2, 0.0])))
+        self.assertNotEqual(fp, codegen.context_fingerprint(
+            self._ctx(pbc=np.array([1, 2]))))
+
+        block = SubdomainSpec2D((0, 0), (64, 64))
+        block._add_connection(SubdomainSpec2D.X_HIGH, None)
+        self.assertNotEqual(fp, codegen.context_fingerprint(
+            self._ctx(block=block)))
+
+
+class TestSharedCode(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_claim_and_publish(self):
+        shared = codegen.SharedCode(self.path)
+        self.assertTrue(shared.claim('abc'))
+        self.assertFalse(shared.claim('abc'))
+        shared.publish('abc', 'kernel code')
+        self.assertEqual(shared.wait('abc'), 'kernel code')
+        self.assertEqual(shared.num_sources(), 1)
+
+    def test_dead_owner(self):
+        shared = codegen.SharedCode(self.path)
+        with open(os.path.join(self.path, 'abc.lock'), 'w') as f:
+            # PIDs are never this large.
+            f.write('999999999')
+        self.assertFalse(shared.claim('abc'))
+        self.assertEqual(shared.wait('abc'), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+import unittest
+
+from sailfish.controller import LBSimulationController
+from sailfish.geo_block import SubdomainSpec2D, Subdomain2D
+from sailfish.lb_single import LBFluidSim
+
+class TestSim(LBFluidSim):
+    subdomain = Subdomain2D
+
+
+class TestEnvelope(unittest.TestCase):
+
+    class Grid(object):
+        # The longest vector is not the last one.
+        basis = [(0, 0), (2, 0), (0, 1)]
+
+    class Sim(object):
+        def __init__(self, grid, nonlocality):
+            self.grid = grid
+            self.nonlocality = nonlocality
+
+    def setUp(self):
+        self.ctrl = LBSimulationController(TestSim,
+                default_config={'mode': 'batch'})
+
+    def _envelope_size(self, nonlocality):
+        block = SubdomainSpec2D((0, 0), (10, 10))
+        self.ctrl._init_block_envelope(self.Sim(self.Grid, nonlocality),
+                [block])
+        self.assertEqual(block.actual_size,
+                [10 + 2 * block.envelope_size] * 2)
+        return block.envelope_size
+
+    def test_lattice_vectors(self):
+        self.assertEqual(self._envelope_size(0), 2)
+
+    def test_nonlocality(self):
+        self.assertEqual(self._envelope_size(1), 2)
+        self.assertEqual(self._envelope_size(3), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,7 +2,7 @@ import numpy as np
 import unittest
 from sailfish.config import LBConfig
 from sailfish.geo import LBGeometry2D
-from sailfish.geo_block import SubdomainSpec2D, SubdomainSpec3D
+from sailfish.geo_block import SubdomainSpec2D, SubdomainSpec3D, SubdomainIndex
 from sailfish.sym import D2Q9, D3Q15, D3Q19
 
 vi = lambda x, y: D2Q9.vec_idx([x, y])
@@ -602,5 +602,43 @@ class TestBlock2D(unittest.TestCase):
         self._verify_partial_map(cpair.src, expected_map)
 
 
+class TestSubdomainIndex(unittest.TestCase):
+
+    def test_find_2d(self):
+        # 4x2 blocks of size 10x5.
+        blocks = []
+        for x in range(0, 4):
+            for y in range(0, 2):
+                blocks.append(SubdomainSpec2D((x * 10, y * 5), (10, 5),
+                    id_=len(blocks)))
+        idx = SubdomainIndex(blocks)
+        ids = lambda x: [b.id for b in x]
+
+        self.assertEqual(ids(idx.lower(0, 10)), [2, 3])
+        self.assertEqual(ids(idx.upper(0, 40)), [6, 7])
+        self.assertEqual(ids(idx.lower(0, 10, [0], [5])), [2])
+        self.assertEqual(ids(idx.lower(0, 10, [-1], [6])), [2, 3])
+        self.assertEqual(ids(idx.lower(1, 5, [9], [21])), [1, 3, 5])
+        self.assertEqual(ids(idx.upper(1, 5, [20], [30])), [4])
+        self.assertEqual(idx.lower(0, 5), [])
+        self.assertEqual(idx.lower(0, 10, [10], [20]), [])
+
+    def test_find_3d(self):
+        # Blocks of different sizes in the X_LOW = 8 plane.
+        blocks = [
+            SubdomainSpec3D((0, 0, 0), (8, 16, 16), id_=0),
+            SubdomainSpec3D((8, 0, 0), (8, 4, 4), id_=1),
+            SubdomainSpec3D((8, 4, 0), (8, 12, 4), id_=2),
+            SubdomainSpec3D((8, 0, 4), (8, 16, 12), id_=3)]
+        idx = SubdomainIndex(blocks)
+        ids = lambda x: [b.id for b in x]
+
+        self.assertEqual(ids(idx.lower(0, 8, [-1, -1], [17, 17])), [1, 2, 3])
+        self.assertEqual(ids(idx.lower(0, 8, [3, 3], [5, 5])), [1, 2, 3])
+        self.assertEqual(ids(idx.lower(0, 8, [5, 0], [6, 4])), [2])
+        self.assertEqual(ids(idx.upper(0, 8, [0, 0], [1, 1])), [0])
+        self.assertEqual(ids(idx.upper(2, 16, [-1, -1], [17, 17])), [0, 3])
+
+
 if __name__ == '__main__':
     unittest.main()
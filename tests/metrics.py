@@ -0,0 +1,55 @@
+import time
+import unittest
+import urllib2
+import zmq
+
+from sailfish import metrics
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.ctx = zmq.Context()
+        # Let the HTTP server pick a free port.
+        self.collector = metrics.MetricsCollector(self.ctx, 0)
+        self.collector.start()
+
+    def tearDown(self):
+        self.collector.stop()
+        self.ctx.term()
+
+    def test_publish(self):
+        pub = metrics.MetricsPublisher(self.ctx, self.collector.addr, 3, 1000)
+        iteration = 0
+        # Messages sent before the subscription is established are dropped,
+        # so keep publishing until the collector receives one.
+        deadline = time.time() + 10.0
+        while 'block="3"' not in self.collector.render():
+            self.assertTrue(time.time() < deadline)
+            pub.add_wait(0.5)
+            pub.add_output(0.25)
+            time.sleep(0.01)
+            iteration += 10
+            pub.publish(iteration)
+
+        port = self.collector._httpd.server_address[1]
+        body = urllib2.urlopen('http://127.0.0.1:{0}/'.format(port)).read()
+        values = dict(line.split(' ', 1) for line in body.splitlines()
+                if not line.startswith('#'))
+        pub.close()
+
+        received = int(values['sailfish_iteration{block="3"}'])
+        self.assertEqual(received % 10, 0)
+        self.assertTrue(0 < received <= iteration)
+        self.assertEqual(int(values['sailfish_iteration_min']), received)
+        # 1000 nodes, 10 iterations in at least 10 ms.
+        mlups = float(values['sailfish_mlups{block="3"}'])
+        self.assertTrue(0.0 < mlups <= 1.0)
+        self.assertEqual(float(values['sailfish_mlups_total']), mlups)
+        self.assertAlmostEqual(
+                float(values['sailfish_halo_wait_seconds{block="3"}']), 0.05)
+        self.assertAlmostEqual(
+                float(values['sailfish_output_seconds{block="3"}']), 0.025)
+
+
+if __name__ == '__main__':
+    unittest.main()
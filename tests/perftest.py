@@ -0,0 +1,88 @@
+import imp
+import os
+import shutil
+import tempfile
+import unittest
+
+from sailfish.block_runner import TimingInfo
+
+perftest = imp.load_source('perftest_tests', os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', 'perftest', 'tests.py'))
+
+
+class Block(object):
+    def __init__(self, num_nodes):
+        self.num_nodes = num_nodes
+
+
+class TestResultDB(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.db = perftest.ResultDB(os.path.join(self.tmpdir, 'results',
+            'perf.sqlite'))
+
+    def tearDown(self):
+        self.db.conn.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_round_trip(self):
+        settings = {'lat_nx': 64, 'lat_ny': 64, 'model': 'bgk'}
+        blocks = [Block(2000000), Block(1000000)]
+        timing_infos = [
+            TimingInfo(comp=0.5, bulk=0.3, bnd=0.2, coll=0.0, data=0.0,
+                recv=0.0, send=0.0, wait=0.0, total=1.0, block_id=0),
+            TimingInfo(comp=0.25, bulk=0.15, bnd=0.1, coll=0.0, data=0.0,
+                recv=0.0, send=0.0, wait=0.0, total=0.5, block_id=1)]
+        run_id, fingerprint, mlups = self.db.add_run('d2q9_bgk', settings,
+                timing_infos, blocks, 'abc')
+        self.assertAlmostEqual(mlups, 4.0)
+
+        other = dict(settings, model='mrt')
+        self.db.add_run('d2q9_mrt', other, timing_infos, blocks, 'abc')
+        last_id, _, _ = self.db.add_run('d2q9_bgk', settings, timing_infos,
+                blocks, 'def')
+
+        runs = self.db.runs(['d2q9_bgk'])
+        self.assertEqual([run.revision for run in runs], ['abc', 'def'])
+        run = runs[0]
+        self.assertEqual(run.id, run_id)
+        self.assertEqual(run.config, settings)
+        self.assertEqual(run.fingerprint, fingerprint)
+        self.assertAlmostEqual(run.mlups_total, 4.0)
+        self.assertAlmostEqual(run.mlups_comp, 8.0)
+        self.assertEqual(len(self.db.runs()), 3)
+
+        # Runs with a different configuration are not comparable.
+        self.assertEqual(self.db.history('d2q9_bgk', fingerprint, last_id,
+            10), [mlups])
+
+        nodes = self.db.conn.execute('SELECT nodes FROM timings WHERE '
+                'run_id = ? ORDER BY block_id', (run_id,)).fetchall()
+        self.assertEqual(nodes, [(2000000,), (1000000,)])
+
+
+class TestRegression(unittest.TestCase):
+
+    def test_regression(self):
+        history = [100.0, 101.0, 99.0, 100.5, 99.5]
+        self.assertTrue(perftest.regression_pvalue(history,
+            [80.0, 81.0, 79.0]) < 0.01)
+        self.assertTrue(perftest.regression_pvalue(history,
+            [120.0, 121.0, 119.0]) > 0.99)
+
+    def test_identical_samples(self):
+        self.assertEqual(perftest.regression_pvalue([100.0] * 3,
+            [100.0] * 3), 1.0)
+        self.assertEqual(perftest.regression_pvalue([100.0] * 3,
+            [90.0] * 3), 0.0)
+
+    def test_too_few_samples(self):
+        self.assertEqual(perftest.regression_pvalue([100.0], [80.0, 81.0]),
+                None)
+        self.assertEqual(perftest.regression_pvalue([100.0, 101.0], [80.0]),
+                None)
+
+
+if __name__ == '__main__':
+    unittest.main()
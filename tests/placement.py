@@ -0,0 +1,81 @@
+import unittest
+
+from sailfish import placement, sym
+from sailfish.geo_block import SubdomainSpec2D
+
+
+def _make_grid(nx, ny, size=10):
+    """Returns a nx x ny array of connected blocks, with IDs increasing
+    along the Y axis first."""
+    blocks = []
+    for x in range(0, nx):
+        for y in range(0, ny):
+            blocks.append(SubdomainSpec2D((x * size, y * size), (size, size),
+                envelope_size=1, id_=len(blocks)))
+
+    for i, b1 in enumerate(blocks):
+        for b2 in blocks[i+1:]:
+            b1.connect(b2, grid=sym.D2Q9)
+    return blocks
+
+
+class TestPlacement(unittest.TestCase):
+
+    def test_graph(self):
+        blocks = _make_grid(2, 1)
+        graph = placement.connectivity_graph(blocks)
+        # 3 distributions on 10 nodes, in both directions.
+        self.assertEqual(graph, {(0, 1): 2 * 3 * 10})
+
+    def test_strip(self):
+        blocks = _make_grid(1, 8)
+        graph = placement.connectivity_graph(blocks)
+        rr = placement.round_robin(blocks, [0, 1])
+        topo = placement.topology(blocks, [0, 1], graph)
+
+        self.assertEqual(topo, dict((i, 0 if i < 4 else 1) for i in range(8)))
+        self.assertEqual(placement.cut_size(graph, topo),
+                graph[(3, 4)])
+        self.assertTrue(placement.cut_size(graph, rr) >
+                placement.cut_size(graph, topo))
+
+    def test_balance(self):
+        blocks = _make_grid(4, 4)
+        graph = placement.connectivity_graph(blocks)
+        devices = [2, 5, 7, 9]
+        topo = placement.topology(blocks, devices, graph)
+
+        self.assertEqual(set(topo.keys()), set(range(16)))
+        for dev in devices:
+            self.assertEqual(topo.values().count(dev), 4)
+        self.assertTrue(placement.cut_size(graph, topo) <
+                placement.cut_size(graph, placement.round_robin(blocks,
+                    devices)))
+
+    def test_few_blocks(self):
+        blocks = _make_grid(1, 2)
+        graph = placement.connectivity_graph(blocks)
+        self.assertEqual(placement.topology(blocks, [0, 1, 2], graph),
+                {0: 0, 1: 1})
+        self.assertEqual(placement.topology(blocks, [3], graph),
+                {0: 3, 1: 3})
+
+    def test_rebalance(self):
+        blocks = _make_grid(1, 8)
+        graph = placement.connectivity_graph(blocks)
+        current = dict((i, 5 if i < 4 else 3) for i in range(8))
+
+        # Uniform load: the blocks stay where they are.
+        weights = dict((i, 1.0) for i in range(8))
+        self.assertEqual(placement.rebalance(blocks, current, [3, 5], graph,
+            weights), current)
+
+        # The blocks at the end of the strip are 3 times more expensive than
+        # the remaining ones.  Only the boundary between the devices moves.
+        weights = dict((i, 3.0 if i > 5 else 1.0) for i in range(8))
+        new = placement.rebalance(blocks, current, [3, 5], graph, weights)
+        self.assertEqual(new, dict((i, 5 if i < 6 else 3) for i in range(8)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,9 @@
+import json
+import os
+import shutil
+import tempfile
 import unittest
+from sympy import Matrix, Rational
 from sailfish import sym
 
 class TestDistComputations(unittest.TestCase):
@@ -67,5 +72,157 @@ class TestDistComputations(unittest.TestCase):
         self.assertEqual(set(gpd(grid, 1, 2)), vts([(0, 0, 1), (1, 0, 1), (-1, 0, 1), (0, 1, 1), (0, -1, 1)]))
 
 
+class TestModels(unittest.TestCase):
+
+    def test_trt_supported(self):
+        # TRT uses the BGK equilibrium, so it is available on the same grids.
+        for grid in sym.KNOWN_GRIDS:
+            self.assertEqual(grid.model_supported('trt'),
+                             grid.model_supported('bgk'))
+        self.assertFalse(sym.D3Q13.model_supported('trt'))
+
+
+class TestGridCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_mrt_cache(self):
+        class Grid(object):
+            pass
+
+        path = os.path.join(self.tmpdir, 'D3Q19.json')
+        grid = sym.D3Q19
+        sym._save_mrt_cache(grid, path)
+        self.assertTrue(sym._load_mrt_cache(Grid, path))
+        self.assertEqual(Grid.mrt_matrix, grid.mrt_matrix)
+        self.assertEqual(Grid.mrt_equilibrium, grid.mrt_equilibrium)
+        self.assertEqual(Grid.mrt_collision, grid.mrt_collision)
+
+    def test_missing_cache(self):
+        class Grid(object):
+            pass
+        self.assertFalse(sym._load_mrt_cache(Grid, None))
+        self.assertFalse(sym._load_mrt_cache(Grid, '/nonexistent/D2Q9.json'))
+
+    def test_invalid_cache(self):
+        class Grid(object):
+            pass
+
+        path = os.path.join(self.tmpdir, 'D2Q9.json')
+        sym._save_mrt_cache(sym.D2Q9, path)
+        data = json.load(open(path))
+
+        # Expressions are never evaluated as code.
+        marker = os.path.join(self.tmpdir, 'marker')
+        for value in ["open({0!r}, 'w')".format(marker),
+                      ['Symbol', 1], ['open', marker, 'w'],
+                      ['Rational', 1, 0], ['Add']]:
+            bad = dict(data)
+            bad['mrt_equilibrium'] = data['mrt_equilibrium'][:-1] + [value]
+            json.dump(bad, open(path, 'w'))
+            self.assertFalse(sym._load_mrt_cache(Grid, path))
+            self.assertFalse(hasattr(Grid, 'mrt_matrix'))
+        self.assertFalse(os.path.exists(marker))
+
+        # Incomplete data.
+        bad = dict(data)
+        bad['mrt_collision'] = data['mrt_collision'][:-1]
+        json.dump(bad, open(path, 'w'))
+        self.assertFalse(sym._load_mrt_cache(Grid, path))
+
+    def test_failed_preparation(self):
+        class Grid(sym.DxQy):
+            dim = 2
+            Q = 2
+            basis = map(lambda x: Matrix((x,)), [(0, 0), (1, 0)])
+            weights = map(lambda x: Rational(*x), [(1, 2), (1, 2)])
+
+        # There is no vector opposite to (1, 0).
+        self.assertRaises(TypeError, getattr, Grid, 'idx_name')
+        self.assertFalse(Grid._prepared)
+        self.assertFalse('idx_name' in Grid.__dict__)
+        # The preparation is attempted again.
+        self.assertRaises(TypeError, getattr, Grid, 'idx_opposite')
+
+
+class TestCexprCache(unittest.TestCase):
+
+    class Sim(object):
+        S = sym.S
+
+    def setUp(self):
+        self._orig_cache = sym.cexpr_cache
+        sym.cexpr_cache = sym.CexprCache()
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        sym.cexpr_cache = self._orig_cache
+        shutil.rmtree(self.tmpdir)
+
+    def test_memoization(self):
+        ex = sym.S.rho * sym.S.vx**2 + sym.S.vy
+        code = sym.cexpr(self.Sim, False, True, ex, None)
+        self.assertEqual(sym.cexpr_cache.misses, 1)
+        self.assertEqual(sym.cexpr(self.Sim, False, True, ex, None), code)
+        self.assertEqual(sym.cexpr_cache.hits, 1)
+
+        # Different flags result in a separate cache entry.
+        self.assertNotEqual(sym.cexpr(self.Sim, False, False, ex, None), code)
+        self.assertEqual(sym.cexpr_cache.misses, 2)
+
+    def test_disk_store(self):
+        path = os.path.join(self.tmpdir, 'cexpr.json')
+        ex = sym.S.rho * sym.S.vx + 1
+        sym.cexpr_cache.load(path)
+        code = sym.cexpr(self.Sim, False, False, ex, None)
+        sym.cexpr_cache.save()
+
+        cache = sym.CexprCache()
+        cache.load(path)
+        sym.cexpr_cache = cache
+        self.assertEqual(sym.cexpr(self.Sim, False, False, ex, None), code)
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(cache.misses, 0)
+
+
+class TestCSE(unittest.TestCase):
+
+    class Sim(object):
+        S = sym.S
+
+    def setUp(self):
+        sym.kernel_flops.clear()
+
+    def test_count_flops(self):
+        x, y, z = sym.S.vx, sym.S.vy, sym.S.vz
+        self.assertEqual(sym.count_flops(x), 0)
+        self.assertEqual(sym.count_flops(x * y + z), 2)
+        self.assertEqual(sym.count_flops(x**3), 2)
+        self.assertEqual(sym.count_flops(1 / x), 1)
+
+    def test_bgk_equilibrium(self):
+        grid = sym.D3Q19
+        eq = [feq for feq, _ in sym.bgk_equilibrium(grid)[0][0]]
+        temps, vals = sym.cse_cexpr(self.Sim, False, eq, 'feq_', 'test')
+        self.assertTrue(temps)
+        self.assertEqual(len(vals), grid.Q)
+        flops, flops_nocse = sym.kernel_flops['test']
+        self.assertTrue(flops < flops_nocse)
+
+    def test_disabled(self):
+        eq = [feq for feq, _ in sym.bgk_equilibrium(sym.D2Q9)[0][0]]
+        temps, vals = sym.cse_cexpr(self.Sim, False, eq, 'feq_', 'test',
+                enabled=False)
+        self.assertEqual(temps, [])
+        self.assertEqual(vals, [sym.cexpr(self.Sim, False, False, x, None)
+                                for x in eq])
+        flops, flops_nocse = sym.kernel_flops['test']
+        self.assertEqual(flops, flops_nocse)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,49 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from sailfish import timeline
+
+class TestTimeline(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_ring_buffer(self):
+        tl = timeline.Timeline(0, 3)
+        for i in range(5):
+            tl.record('step', i, float(i), i + 0.5)
+        self.assertEqual(len(tl), 3)
+        self.assertEqual([x.iteration for x in tl.spans()], [2, 3, 4])
+
+    def test_merge(self):
+        base = os.path.join(self.tmpdir, 'test')
+        fnames = []
+        for block_id, t0 in ((0, 100.0), (1, 99.0)):
+            tl = timeline.Timeline(block_id, 10)
+            tl.record('step', 0, t0, t0 + 1.0)
+            tl.record('bulk', 0, t0 + 0.5, t0 + 0.75, timeline.TRACK_GPU)
+            tl.save(base)
+            fnames.append(timeline.block_filename(base, block_id))
+            self.assertTrue(os.path.exists(
+                timeline.block_filename(base, block_id, '.csv')))
+
+        merged = timeline.merged_filename(base)
+        timeline.merge_chrome_traces(fnames, merged)
+        events = json.load(open(merged))['traceEvents']
+        spans = [ev for ev in events if ev['ph'] == 'X']
+        self.assertEqual(len(spans), 4)
+        self.assertEqual(min(ev['ts'] for ev in spans), 0.0)
+
+        step0 = [ev for ev in spans if ev['pid'] == 0 and ev['name'] == 'step'][0]
+        self.assertAlmostEqual(step0['ts'], 1e6)
+        self.assertAlmostEqual(step0['dur'], 1e6)
+
+
+if __name__ == '__main__':
+    unittest.main()